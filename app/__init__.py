@@ -5,6 +5,7 @@ from dotenv import load_dotenv
 from flask import Flask
 from flask_login import LoginManager
 from flask_pymongo import PyMongo
+from flask_sock import Sock
 
 TAX_RATE = 8
 CODE_LENGTH = 6
@@ -19,33 +20,84 @@ app = Flask(__name__,
             static_folder='../static')
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 app.config['MONGO_URI'] = os.getenv('MONGO_URI')
+# Optional out-of-process card network, see tools/card_network_sim.py
+app.config['CARD_NETWORK_URL'] = os.getenv('CARD_NETWORK_URL')
+app.config['CARD_NETWORK_POOL_SIZE'] = int(
+    os.getenv('CARD_NETWORK_POOL_SIZE', 10)
+)
+app.config['CARD_NETWORK_TIMEOUT'] = float(
+    os.getenv('CARD_NETWORK_TIMEOUT', 5)
+)
+# Limits around payment calls so a slow network can't stall every worker
+app.config['PAYMENT_CONCURRENCY'] = int(os.getenv('PAYMENT_CONCURRENCY', 4))
+app.config['PAYMENT_DEADLINE'] = float(os.getenv('PAYMENT_DEADLINE', 8))
+app.config['PAYMENT_QUEUE_TIMEOUT'] = float(
+    os.getenv('PAYMENT_QUEUE_TIMEOUT', 2)
+)
+app.config['BREAKER_FAILURE_THRESHOLD'] = int(
+    os.getenv('BREAKER_FAILURE_THRESHOLD', 5)
+)
+app.config['BREAKER_RESET_TIMEOUT'] = float(
+    os.getenv('BREAKER_RESET_TIMEOUT', 30)
+)
+# Threads shared by views that run independent lookups concurrently
+app.config['FANOUT_WORKERS'] = int(os.getenv('FANOUT_WORKERS', 16))
+# 'mongo', or 'memory' to run without a mongod, see app/storage/
+app.config['STORAGE_BACKEND'] = os.getenv('STORAGE_BACKEND', 'mongo')
+# /metrics endpoints, off unless set, and then only for vendors
+app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED') == '1'
+# Request profiling, see app/utils/profiler.py
+app.config['PROFILE_SAMPLE_RATE'] = float(
+    os.getenv('PROFILE_SAMPLE_RATE', 0)
+)
+app.config['PROFILE_INTERVAL'] = float(os.getenv('PROFILE_INTERVAL', 0.005))
+app.config['PROFILE_OVERHEAD'] = float(os.getenv('PROFILE_OVERHEAD', 0.01))
+app.config['PROFILE_MAX_DURATION'] = float(
+    os.getenv('PROFILE_MAX_DURATION', 10)
+)
+app.config['PROFILE_DIR'] = os.getenv(
+    'PROFILE_DIR', str(basedir / 'profiles')
+)
+app.config['PROFILE_TOKEN_MAX_AGE'] = int(
+    os.getenv('PROFILE_TOKEN_MAX_AGE', 3600)
+)
+
+# Per-worker filter of live bill and group codes, see app/utils/code_filter.py
+app.config['CODE_FILTER_REFRESH'] = float(
+    os.getenv('CODE_FILTER_REFRESH', 1)
+)
+app.config['CODE_FILTER_REBUILD'] = float(
+    os.getenv('CODE_FILTER_REBUILD', 600)
+)
+app.config['CODE_FILTER_ERROR_RATE'] = float(
+    os.getenv('CODE_FILTER_ERROR_RATE', 0.01)
+)
 
 mongo = PyMongo(app)
+sock = Sock(app)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'auth.login'
 
-from app.models import User
+from app.storage import store
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    from bson.objectid import ObjectId
-    user_data = mongo.db.users.find_one({'_id': ObjectId(user_id)})
-    if user_data:
-        return User(user_data)
-    return None
+    return store.users.get(user_id)
 
+from app.blueprints.api import api_bp
 from app.blueprints.auth import auth_bp
 from app.blueprints.bills import customer_bill_bp, vendor_bill_bp
 from app.blueprints.customer import customer_bp
 from app.blueprints.vendor import vendor_bp
 
+app.register_blueprint(api_bp)
 app.register_blueprint(auth_bp)
 app.register_blueprint(customer_bill_bp)
 app.register_blueprint(vendor_bill_bp)
 app.register_blueprint(customer_bp)
 app.register_blueprint(vendor_bp)
 
-from app import routes
+from app import commands, routes
@@ -0,0 +1,472 @@
+'''
+JSON API for table-side clients, version 1
+
+The same customer and vendor flows as the HTML views, but each action
+answers with the state it changed (usually the bill) in one small JSON
+body instead of a flash and a redirect. Clients log in through
+/api/v1/login and keep the session cookie. Errors come back as
+{"error": message} with a 4xx status, and bill reads honour If-None-Match
+so polling an unchanged bill costs a 304.
+'''
+from functools import wraps
+
+from bson import ObjectId
+from flask import Blueprint, jsonify, request
+from flask_login import current_user, login_user, logout_user
+
+from app.blueprints.bills import OrderItem
+from app.models import (Bill, BillSummary, BillVersion, GroupMembership,
+                        LoginUser)
+from app.payment import PaymentError
+from app.storage import store
+from app.utils import actions
+from app.utils.code_filter import group_codes
+from app.utils.directory import bill_key, bill_key_for_code
+from app.utils.etag import not_modified, version_tag, with_etag
+from app.utils.live import (assign_item, assign_items, claim_unassigned,
+                            split_evenly)
+from app.utils.menu import PAGE_SIZE, item_json, search_menu
+from app.utils.money import bill_shares, tax_cents
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+CARD_FIELDS = ('card_number', 'expiry_date', 'cardholder_name')
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+@api_bp.errorhandler(ApiError)
+def api_error(error):
+    return jsonify({'error': error.message}), error.status
+
+
+def api_access_required(user_type):
+    '''
+    Like login_required plus the access decorators, but answers with a
+    JSON error instead of redirecting to the login page
+    '''
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not current_user.is_authenticated:
+                raise ApiError(401, "Login required.")
+            if current_user.user_type != user_type:
+                raise ApiError(403, "Access denied.")
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def body():
+    data = request.get_json(silent=True)
+    if data is None:
+        return {}
+    if not isinstance(data, dict):
+        raise ApiError(400, "The request body must be a JSON object.")
+    return data
+
+
+def bill_json(bill):
+    '''
+    A bill's current state, amounts in cents
+    '''
+    shares = bill_shares(bill.contents)
+    return {
+        'id': bill.id,
+        'table_number': bill.table_number,
+        'status': bill.status,
+        'session_code': bill.session_code,
+        'version': bill.version,
+        'subtotal': bill.subtotal,
+        'tax': tax_cents(bill.subtotal),
+        'paid': bill.paid,
+        'items': [
+            {
+                'id': item['_id'],
+                'name': item['name'],
+                'price': item['price'],
+                'quantity': item['quantity'],
+                'assigned_to': item.get('assigned_to', []),
+            }
+            for item in bill.contents
+        ],
+        'shares': shares,
+    }
+
+
+def group_json(group):
+    return {
+        'id': group.id,
+        'name': group.name,
+        'code': group.code,
+        'creator_id': group.creator_id,
+        'members': group.members,
+        'active_bill_id': group.active_bill_id,
+    }
+
+
+def member_group(group_id):
+    '''
+    The group, if the current user is in it
+    '''
+    group = store.groups.get(group_id, GroupMembership)
+    if not group:
+        raise ApiError(404, "Group not found.")
+    if current_user.id not in group.members:
+        raise ApiError(403, "You are not a member of this group.")
+    return group
+
+
+def group_bill_key(group):
+    key = bill_key(group.active_bill_id)
+    if not key:
+        raise ApiError(404, "This group has no active bill.")
+    return key
+
+
+def vendor_bill_key(bill_id, model=BillVersion):
+    '''
+    Key of one of the current vendor's bills, checked by reading it as
+    `model`, so a view reading it again gets it from the identity map
+    '''
+    key = bill_key(bill_id, current_user.id)
+    if not key or not store.bills.get(key, model):
+        raise ApiError(404, "Bill not found.")
+    return key
+
+
+def current_bill(key, etag_parts=None):
+    '''
+    Bill state response, a 304 if the client's ETag is still current
+    '''
+    if etag_parts:
+        version = store.bills.get(key, BillVersion)
+        if not version:
+            raise ApiError(404, "Bill not found.")
+        etag = version_tag('api_bill', *etag_parts, version.version)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+    bill = store.bills.get(key)
+    if not bill:
+        raise ApiError(404, "Bill not found.")
+    response = jsonify(bill_json(bill))
+    return with_etag(response, etag) if etag_parts else response
+
+
+@api_bp.route('/login', methods=['POST'])
+def login():
+    data = body()
+    user = store.users.by_email(str(data.get('email', '')), LoginUser)
+    if not user or not user.check_password(str(data.get('password', ''))):
+        raise ApiError(401, "Invalid email or password.")
+    login_user(user)
+    return jsonify({
+        'id': user.id, 'username': user.username, 'user_type': user.user_type
+    })
+
+
+@api_bp.route('/logout', methods=['POST'])
+def logout():
+    logout_user()
+    return '', 204
+
+
+# Customers
+
+@api_bp.route('/groups', methods=['GET'])
+@api_access_required('customer')
+def list_groups():
+    groups = store.groups.for_member(current_user.id)
+    return jsonify([group_json(group) for group in groups])
+
+
+@api_bp.route('/groups', methods=['POST'])
+@api_access_required('customer')
+def create_group():
+    name = str(body().get('name', '')).strip()
+    if not name:
+        raise ApiError(400, "Group name is required.")
+    group_id = actions.create_group(name, current_user.id)
+    return jsonify(group_json(store.groups.get(group_id))), 201
+
+
+@api_bp.route('/groups/join', methods=['POST'])
+@api_access_required('customer')
+def join_group():
+    code = str(body().get('code', '')).strip().upper()
+    group = group_codes.might_exist(code) and store.groups.by_code(
+        code, GroupMembership
+    )
+    if not group:
+        raise ApiError(404, "Group not found.")
+    if current_user.id in group.members:
+        raise ApiError(409, "You are already a member of this group.")
+    actions.join_group(group, current_user.id)
+    return jsonify(group_json(store.groups.get(group.id)))
+
+
+@api_bp.route('/groups/<group_id>/leave', methods=['POST'])
+@api_access_required('customer')
+def leave_group(group_id):
+    group = store.groups.get(group_id)
+    if not group or current_user.id not in group.members:
+        raise ApiError(404, "Group not found.")
+    if current_user.id == group.creator_id and len(group.members) > 1:
+        raise ApiError(
+            409, "As the creator, you cannot leave while other members "
+                 "are in the group."
+        )
+    actions.leave_group(group, current_user.id)
+    return '', 204
+
+
+@api_bp.route('/groups/<group_id>/bill', methods=['GET'])
+@api_access_required('customer')
+def group_bill(group_id):
+    group = member_group(group_id)
+    return current_bill(
+        group_bill_key(group), ('customer', group_id, group.version)
+    )
+
+
+@api_bp.route('/groups/<group_id>/bill', methods=['POST'])
+@api_access_required('customer')
+def join_bill(group_id):
+    '''
+    Put the group on the bill holding a session code
+    '''
+    group = member_group(group_id)
+    code = str(body().get('session_code', '')).strip().upper()
+    key = bill_key_for_code(code) if code else None
+    bill = store.bills.get(key, BillSummary)
+    if not bill or bill.status not in Bill.UNSETTLED:
+        raise ApiError(404, f"Payment code '{code}' not found.")
+    actions.attach_group(key, group)
+    return current_bill(key)
+
+
+@api_bp.route('/groups/<group_id>/bill/items/<item_id>', methods=['PUT'])
+@api_access_required('customer')
+def split_item(group_id, item_id):
+    '''
+    Assign an item to {"user_ids": [...]}, everyone viewing sees it live
+    '''
+    group = member_group(group_id)
+    user_ids = body().get('user_ids')
+    if not isinstance(user_ids, list) or not all(
+        isinstance(user_id, str) for user_id in user_ids
+    ):
+        raise ApiError(400, "user_ids must be a list of ids.")
+    if not set(user_ids) <= set(group.members):
+        raise ApiError(400, "One or more users are not in this group.")
+    key = group_bill_key(group)
+    if not assign_item(key, item_id, user_ids):
+        raise ApiError(
+            409, "Item not found, or the bill is already being paid."
+        )
+    return current_bill(key)
+
+
+@api_bp.route('/groups/<group_id>/bill/items', methods=['PUT'])
+@api_access_required('customer')
+def split_items(group_id):
+    '''
+    Assign many items at once, {"assignments": {item_id: [user_id, ...]}}
+    '''
+    group = member_group(group_id)
+    assignments = body().get('assignments')
+    if not isinstance(assignments, dict) or not all(
+        isinstance(user_ids, list)
+        and all(isinstance(user_id, str) for user_id in user_ids)
+        for user_ids in assignments.values()
+    ):
+        raise ApiError(400, "assignments must map item ids to lists.")
+    user_ids = {
+        user_id for user_ids in assignments.values() for user_id in user_ids
+    }
+    if not user_ids <= set(group.members):
+        raise ApiError(400, "One or more users are not in this group.")
+    key = group_bill_key(group)
+    if not assign_items(key, assignments):
+        raise ApiError(
+            409, "Item not found, or the bill is already being paid."
+        )
+    return current_bill(key)
+
+
+@api_bp.route('/groups/<group_id>/bill/split-evenly', methods=['POST'])
+@api_access_required('customer')
+def split_bill_evenly(group_id):
+    group = member_group(group_id)
+    key = group_bill_key(group)
+    if not split_evenly(key, group.members):
+        raise ApiError(409, "The bill is already being paid.")
+    return current_bill(key)
+
+
+@api_bp.route('/groups/<group_id>/bill/claim-unassigned', methods=['POST'])
+@api_access_required('customer')
+def claim_unassigned_items(group_id):
+    key = group_bill_key(member_group(group_id))
+    if not claim_unassigned(key, current_user.id):
+        raise ApiError(409, "The bill is already being paid.")
+    return current_bill(key)
+
+
+@api_bp.route('/groups/<group_id>/bill/pay', methods=['POST'])
+@api_access_required('customer')
+def pay(group_id):
+    '''
+    Pay the current user's share with {"token": ..., "cvc": ...} for a
+    saved card or {"card": {...}, "cvc": ...} for a new one
+    '''
+    group = member_group(group_id)
+    key = group_bill_key(group)
+    bill = store.bills.for_payer(key, current_user.id)
+    if not bill:
+        raise ApiError(404, "No active bill found.")
+
+    data = body()
+    card = data.get('token') or data.get('card')
+    # A token string, or new card details as strings
+    valid = isinstance(card, str) or (isinstance(card, dict) and all(
+        isinstance(card.get(field), str) for field in CARD_FIELDS
+    ))
+    if not card or not valid:
+        raise ApiError(400, "A saved card token or card details are needed.")
+    try:
+        amount, state = actions.pay_share(
+            key, bill, current_user, card, str(data.get('cvc', ''))
+        )
+    except KeyError as e:
+        raise ApiError(400, f"Invalid card: missing {e}")
+    except ValueError as e:
+        raise ApiError(400, str(e))
+    except PaymentError as e:
+        raise ApiError(402, str(e))
+    if not state:
+        raise ApiError(
+            409, "This bill was closed while you were paying. "
+                 "You have not been charged."
+        )
+    return jsonify({
+        'amount': amount, 'status': state['status'], 'paid': state['paid']
+    })
+
+
+# Vendors
+
+@api_bp.route('/menu', methods=['GET'])
+@api_access_required('vendor')
+def menu():
+    result = search_menu(
+        current_user.id,
+        query=request.args.get('q', ''),
+        category=request.args.get('category'),
+        page=request.args.get('page', 1, type=int),
+        per_page=request.args.get('per_page', PAGE_SIZE, type=int),
+    )
+    result['items'] = [item_json(item) for item in result['items']]
+    return jsonify(result)
+
+
+@api_bp.route('/bills', methods=['GET'])
+@api_access_required('vendor')
+def list_bills():
+    bills = store.bills.for_vendor(current_user.id, Bill.UNSETTLED)
+    return jsonify([
+        {
+            'id': bill.id,
+            'table_number': bill.table_number,
+            'status': bill.status,
+            'subtotal': bill.subtotal,
+            'paid': bill.paid,
+        }
+        for bill in bills
+    ])
+
+
+@api_bp.route('/bills', methods=['POST'])
+@api_access_required('vendor')
+def create_bill():
+    table_number = body().get('table_number')
+    bill_id = actions.open_bill(
+        current_user.id, None if table_number is None else str(table_number)
+    )
+    response = current_bill(bill_key(bill_id, current_user.id))
+    return response, 201
+
+
+@api_bp.route('/bills/<bill_id>', methods=['GET'])
+@api_access_required('vendor')
+def bill_status(bill_id):
+    # bill_key carries vendor_id, so another vendor's bill isn't found
+    key = bill_key(bill_id, current_user.id)
+    if not key:
+        raise ApiError(404, "Bill not found.")
+    return current_bill(key, ('vendor', current_user.id, bill_id))
+
+
+@api_bp.route('/bills/<bill_id>/items', methods=['POST'])
+@api_access_required('vendor')
+def add_item(bill_id):
+    '''
+    Add {"menu_item_id": ..., "quantity": n} to an open bill
+    '''
+    key = vendor_bill_key(bill_id)
+    data = body()
+    menu_item_id = data.get('menu_item_id')
+    menu_item = (
+        store.menu.get(current_user.id, menu_item_id)
+        if ObjectId.is_valid(menu_item_id) else None
+    )
+    if not menu_item:
+        raise ApiError(404, "Menu item not found.")
+    quantity = data.get('quantity', 1)
+    if not isinstance(quantity, int) or quantity < 1:
+        raise ApiError(400, "Quantity must be a whole number of at least 1.")
+
+    order_item = OrderItem(
+        item_id=str(menu_item["_id"]),
+        name=menu_item["name"],
+        price=menu_item["price"],
+        quantity=quantity,
+        bill_id=bill_id
+    )
+    if not store.bills.add_item(
+        key, order_item.to_dict(), menu_item["price"] * quantity
+    ):
+        raise ApiError(409, "Items can only be added to an open bill.")
+    return current_bill(key), 201
+
+
+@api_bp.route('/bills/<bill_id>/items/<item_id>', methods=['DELETE'])
+@api_access_required('vendor')
+def remove_item(bill_id, item_id):
+    key = vendor_bill_key(bill_id, Bill)
+    bill = store.bills.get(key)
+    item = next(
+        (item for item in bill.contents if item["_id"] == item_id), None
+    )
+    if not item:
+        raise ApiError(404, "Item not found.")
+    if not store.bills.remove_item(
+        key, item_id, item["price"] * item["quantity"]
+    ):
+        raise ApiError(409, "Items can only be removed from an open bill.")
+    return current_bill(key)
+
+
+@api_bp.route('/bills/<bill_id>/void', methods=['POST'])
+@api_access_required('vendor')
+def void(bill_id):
+    key = vendor_bill_key(bill_id)
+    if not actions.void_bill(key):
+        raise ApiError(409, "Only open bills with nothing paid can be voided.")
+    return current_bill(key)
@@ -1,8 +1,8 @@
 from flask import Blueprint, flash, redirect, render_template, request, url_for
 from flask_login import current_user, login_required, login_user, logout_user
 
-from app import mongo
-from app.models import User
+from app.models import LoginUser, User
+from app.storage import store
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -25,14 +25,12 @@ def login():
             return redirect(url_for('auth.login'))
 
         # Find user by email
-        user_data = mongo.db.users.find_one({'email': email})
+        user = store.users.by_email(email, LoginUser)
 
-        if not user_data:
+        if not user:
             flash('Invalid email or password', 'error')
             return redirect(url_for('auth.login'))
 
-        user = User(user_data)
-
         # Check password
         if not user.check_password(password):
             flash('Invalid email or password', 'error')
@@ -72,11 +70,11 @@ def signup():
             return redirect(url_for('auth.signup'))
 
         # Check if user already exists
-        if mongo.db.users.find_one({'email': email}):
+        if store.users.email_taken(email):
             flash('Email already registered', 'error')
             return redirect(url_for('auth.signup'))
 
-        if mongo.db.users.find_one({'username': username}):
+        if store.users.username_taken(username):
             flash('Username already taken', 'error')
             return redirect(url_for('auth.signup'))
 
@@ -94,11 +92,10 @@ def signup():
         )
 
         # Insert into database
-        result = mongo.db.users.insert_one(user_dict)
+        store.users.create(user_dict)
 
-        # Login the new user
-        user_data = mongo.db.users.find_one({'_id': result.inserted_id})
-        user = User(user_data)
+        # Login the new user, create filled in user_dict['_id']
+        user = User(user_dict)
         login_user(user)
 
         flash(
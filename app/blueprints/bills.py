@@ -1,19 +1,24 @@
 import uuid
 from dataclasses import dataclass, field
-from datetime import datetime
 
-import pytz
 from bson import ObjectId
 from flask import Blueprint, flash, redirect, render_template, request, url_for
 from flask_login import current_user, login_required
-from pymongo import ReturnDocument
-from pymongo.errors import DuplicateKeyError
 
-from app import TAX_RATE, mongo
-from app.payment import PaymentError, demo_payment_provider
-from app.utils.code_generator import generate_code
+from app import TAX_RATE
+from app.models import (Bill, BillSummary, BillVersion, GroupMembership,
+                        Wallet)
+from app.payment import PaymentError
+from app.storage import store
+from app.utils import actions
 from app.utils.decorators import (customer_access_required,
                                   vendor_access_required)
+from app.utils.directory import bill_key, bill_key_for_code
+from app.utils.etag import not_modified, version_tag, with_etag
+from app.utils.fanout import gather
+from app.utils.ledger import bill_payments
+from app.utils.menu import search_menu
+from app.utils.money import bill_shares
 
 vendor_bill_bp = Blueprint(
     'vendor_bills', f"vendor_{__name__}", url_prefix='/vendor/bill'
@@ -27,7 +32,7 @@ customer_bill_bp = Blueprint(
 class OrderItem:
     item_id: str
     name: str
-    price: float
+    price: int
     quantity: int
     bill_id: str
     assigned_to: list = field(default_factory=list)
@@ -52,28 +57,12 @@ def create_bill():
     '''
     Create a bill
     '''
-    mongo.db.bills.create_index([("session_code", 1)], unique=True)
-    while True:
-        try:
-            new_bill = {
-                "vendor_id": current_user.id,
-                "table_number": request.form.get("table_number"),
-                "contents": [],
-                "subtotal": 0.0,
-                "status": "pending",
-                "paid": 0.0,
-                "session_code": generate_code(),
-                "created_at": datetime.now(pytz.timezone("US/Eastern"))
-            }
-            new_bill = mongo.db.bills.insert_one(new_bill)
-            break
-        except DuplicateKeyError:
-            pass
-
-    return redirect(
-        url_for("vendor_bills.display_bill", bill_id=new_bill.inserted_id)
+    bill_id = actions.open_bill(
+        current_user.id, request.form.get("table_number")
     )
 
+    return redirect(url_for("vendor_bills.display_bill", bill_id=bill_id))
+
 
 @vendor_bill_bp.route('/detail/<bill_id>', methods=['GET'])
 @login_required
@@ -81,16 +70,24 @@ def display_bill(bill_id):
     '''
     Display information for a bill
     '''
-    bill = mongo.db.bills.find_one({"_id": ObjectId(bill_id)})
-    if not bill or bill["vendor_id"] != current_user.id:
+    key = bill_key(bill_id, current_user.id)
+    bill = store.bills.get(key, BillVersion)
+    if not bill:
         flash("Bill not found.", "error")
         return redirect(url_for("vendor.dashboard"))
 
-    return render_template(
+    etag = version_tag("vendor_bill", current_user.id, bill_id, bill.version)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    bill = store.bills.get(key)
+    return with_etag(render_template(
         'bills/vendor_bill_info.html',
         bill=bill,
+        payments=bill_payments(bill_id),
         tax=TAX_RATE
-    )
+    ), etag)
 
 
 @vendor_bill_bp.route('/add_menu/<bill_id>', methods=['GET'])
@@ -100,16 +97,18 @@ def view_menu_for_bill(bill_id):
     '''
     Render menu to add items to a bill
     '''
-    bill = mongo.db.bills.find_one({"_id": ObjectId(bill_id)})
-    if not bill or bill["vendor_id"] != current_user.id:
+    key = bill_key(bill_id, current_user.id)
+    bill = store.bills.get(key, BillVersion)
+    if not bill:
         flash("Bill not found.", "error")
         return redirect(url_for("vendor.dashboard"))
 
-    menu_items = list(mongo.db.menu_items.find({'vendor_id': current_user.id}))
+    # Only the first page, the search box fetches the rest as needed
+    menu = search_menu(current_user.id)
 
     return render_template('bills/add_to_bill.html',
                            title='Menu Items',
-                           menu_items=menu_items,
+                           menu=menu,
                            bill_id=bill_id)
 
 
@@ -120,15 +119,30 @@ def add_to_bill(bill_id, item_id):
     '''
     Add a menu item to a bill
     '''
-    bill = mongo.db.bills.find_one({"_id": ObjectId(bill_id)})
-    if not bill or bill["vendor_id"] != current_user.id:
+    key = bill_key(bill_id, current_user.id)
+    bill = store.bills.get(key, BillVersion)
+    if not bill:
         flash("Bill not found.", "error")
         return redirect(url_for("vendor.dashboard"))
 
-    menu_item = mongo.db.menu_items.find_one({
-        "_id": ObjectId(item_id)
-    })
-    quantity = float(request.form.get("qty", 1))
+    menu_item = (
+        store.menu.get(current_user.id, item_id)
+        if ObjectId.is_valid(item_id) else None
+    )
+    if not menu_item:
+        flash("Menu item not found.", "error")
+        return redirect(
+            url_for("vendor_bills.view_menu_for_bill", bill_id=bill_id)
+        )
+    try:
+        quantity = int(request.form.get("qty", 1))
+    except ValueError:
+        quantity = 0
+    if quantity < 1:
+        flash("Quantity must be a whole number of at least 1.", "error")
+        return redirect(
+            url_for("vendor_bills.view_menu_for_bill", bill_id=bill_id)
+        )
     new_order_item = OrderItem(
         item_id=str(menu_item["_id"]),
         name=menu_item["name"],
@@ -136,16 +150,13 @@ def add_to_bill(bill_id, item_id):
         quantity=quantity,
         bill_id=bill_id
     )
-    bill = mongo.db.bills.find_one_and_update(
-        {"_id": ObjectId(bill_id)},
-        {
-            "$inc": {"subtotal": menu_item["price"] * quantity},
-            "$push": {"contents": new_order_item.to_dict()}
-        },
-        return_document=ReturnDocument.AFTER
+    added = store.bills.add_item(
+        key, new_order_item.to_dict(), menu_item["price"] * quantity
     )
+    if not added:
+        flash("Items can only be added to an open bill.", "error")
 
-    return redirect(url_for("vendor_bills.display_bill", bill_id=bill["_id"]))
+    return redirect(url_for("vendor_bills.display_bill", bill_id=bill_id))
 
 
 @vendor_bill_bp.route('/delete_from_bill/<bill_id>/<item_id>')
@@ -155,48 +166,43 @@ def delete_from_bill(bill_id, item_id):
     '''
     Delete a specified item from a bill
     '''
-    bill = mongo.db.bills.find_one({"_id": ObjectId(bill_id)})
-    if not bill or bill["vendor_id"] != current_user.id:
+    key = bill_key(bill_id, current_user.id)
+    bill = store.bills.get(key)
+    if not bill:
         flash("Bill not found.", "error")
         return redirect(url_for("vendor.dashboard"))
 
-    bill_contents = (
-        mongo.db.bills.find_one({"_id": ObjectId(bill_id)})["contents"]
-    )
-
     item = next(
-        (item for item in bill_contents if item["_id"] == item_id), None
+        (item for item in bill.contents if item["_id"] == item_id), None
     )
+    if not item:
+        flash("Item not found.", "error")
+        return redirect(url_for("vendor_bills.display_bill", bill_id=bill_id))
 
-    bill = mongo.db.bills.find_one_and_update(
-        {"_id": ObjectId(bill_id)},
-        {
-            "$pull": {"contents": {"_id": item["_id"]}},
-            "$inc": {"subtotal": -item["price"]}
-        }
-    )
-    return redirect(url_for("vendor_bills.display_bill", bill_id=bill["_id"]))
+    if not store.bills.remove_item(
+        key, item["_id"], item["price"] * item["quantity"]
+    ):
+        flash("Items can only be removed from an open bill.", "error")
+    return redirect(url_for("vendor_bills.display_bill", bill_id=bill_id))
 
 
-@vendor_bill_bp.route('/delete/<bill_id>')
+@vendor_bill_bp.route('/void/<bill_id>')
 @login_required
 @vendor_access_required
-def delete(bill_id):
+def void(bill_id):
     '''
-    Delete a bill and remove it from any groups' active_bill_id
+    Void an unpaid bill and remove it from any groups' active_bill_id
     '''
-    bill = mongo.db.bills.find_one({"_id": ObjectId(bill_id)})
-    if not bill or bill["vendor_id"] != current_user.id:
+    key = bill_key(bill_id, current_user.id)
+    bill = store.bills.get(key, BillVersion)
+    if not bill:
         flash("Bill not found.", "error")
         return redirect(url_for("vendor.dashboard"))
 
-    # Remove this bill from any groups that have it as active_bill_id
-    mongo.db.groups.update_many(
-        {"active_bill_id": ObjectId(bill_id)},
-        {"$set": {"active_bill_id": None}}
-    )
+    if not actions.void_bill(key):
+        flash("Only open bills with nothing paid can be voided.", "error")
+        return redirect(url_for("vendor_bills.display_bill", bill_id=bill_id))
 
-    mongo.db.bills.delete_one({"_id": ObjectId(bill_id)})
     return redirect(url_for("vendor.dashboard"))
 
 
@@ -216,8 +222,9 @@ def join_by_code():
             return redirect(url_for("customer.dashboard"))
 
         # Find bill by session_code
-        bill = mongo.db.bills.find_one({"session_code": session_code})
-        if not bill:
+        key = bill_key_for_code(session_code)
+        bill = store.bills.get(key, BillSummary)
+        if not bill or bill.status not in Bill.UNSETTLED:
             flash(
                 f"Payment code '{session_code}' not found."
                 " Please check and try again.",
@@ -228,23 +235,20 @@ def join_by_code():
             ))
 
         # Verify group exists and user is a member
-        group = mongo.db.groups.find_one({"_id": ObjectId(group_id)})
+        group = store.groups.get(group_id, GroupMembership)
         if not group:
             flash("Group not found.", "error")
             return redirect(url_for("customer.dashboard"))
 
-        if current_user.id not in group.get('members', []):
+        if current_user.id not in group.members:
             flash("You are not a member of this group.", "error")
             return redirect(url_for("customer.dashboard"))
 
-        # Attach group to bill
-        mongo.db.groups.update_one(
-            {"_id": ObjectId(group_id)},
-            {"$set": {"active_bill_id": ObjectId(bill['_id'])}}
-        )
+        # Attach group to bill, its members can then pay it
+        actions.attach_group(key, group)
 
         flash(
-            f'Group "{group["name"]}" joined Bill '
+            f'Group "{group.name}" joined Bill '
             f'(Code: {session_code}) successfully!',
             "success"
         )
@@ -255,67 +259,51 @@ def join_by_code():
         return redirect(url_for("customer.dashboard"))
 
 
-@customer_bill_bp.route('/pay_bill_menu/<bill_id>', methods=['GET'])
+@customer_bill_bp.route(
+    '/pay_bill_menu/<group_id>/<bill_id>', methods=['GET']
+)
 @login_required
 @customer_access_required
-def pay_bill_menu(bill_id):
+def pay_bill_menu(group_id, bill_id):
     '''
     Open payment page for a customer
     '''
-
-    payment_methods = mongo.db.users.find_one(
-        {"_id": ObjectId(current_user.id)}
-    )["payment_methods"]
-
-    bill_group = mongo.db.groups.find_one(
-        {'active_bill_id': ObjectId(bill_id)}
+    # Payment methods and the bill are independent lookups, and the bill
+    # is only found if the customer is one of its members
+    user_id = current_user.id
+    wallet, bill = gather(
+        lambda: store.users.get(user_id, Wallet),
+        lambda: store.bills.for_payer(bill_key(bill_id), user_id)
     )
-    if not bill_group or current_user.id not in bill_group["members"]:
+    if not bill:
         flash("No active bill found", "error")
         return redirect(url_for('customer.dashboard'))
 
-    bill = mongo.db.bills.find_one({"_id": ObjectId(bill_id)})
-    subtotal = 0
-    for item in bill["contents"]:
-        if current_user.id in item["assigned_to"]:
-            subtotal += (
-                item["price"] * item["quantity"] / len(item["assigned_to"])
-            )
+    amount = bill_shares(bill.contents).get(current_user.id, 0)
 
     return render_template(
         "customer/payment_menu.html",
-        tax=TAX_RATE,
-        subtotal=subtotal,
+        amount=amount,
         bill_id=bill_id,
-        group_id=bill_group["_id"],
-        payment_methods=payment_methods
+        group_id=group_id,
+        payment_methods=wallet.payment_methods
     )
 
 
-@customer_bill_bp.route('/pay_bill/<bill_id>', methods=['POST'])
+@customer_bill_bp.route('/pay_bill/<group_id>/<bill_id>', methods=['POST'])
 @login_required
 @customer_access_required
-def pay_bill(bill_id):
+def pay_bill(group_id, bill_id):
     '''
     Pay a bill
     '''
-
-    bill_group = mongo.db.groups.find_one(
-        {'active_bill_id': ObjectId(bill_id)}
-    )
-    if not bill_group or current_user.id not in bill_group["members"]:
+    # One read authorizes the payer and prices their share
+    key = bill_key(bill_id)
+    bill = store.bills.for_payer(key, current_user.id)
+    if not bill:
         flash("No active bill found", "error")
         return redirect(url_for('customer.dashboard'))
 
-    bill = mongo.db.bills.find_one({"_id": ObjectId(bill_id)})
-    subtotal = 0
-    for item in bill["contents"]:
-        if current_user.id in item["assigned_to"]:
-            subtotal += (
-                item["price"] * item["quantity"] / len(item["assigned_to"])
-            )
-    subtotal *= 1 + TAX_RATE / 100
-
     try:
         selection = request.form.get("payment_option")
         if selection == "new":
@@ -324,31 +312,26 @@ def pay_bill(bill_id):
                 "expiry_date": request.form["expiry_date"],
                 "cardholder_name": request.form["cardholder_name"]
             }
-            paid = demo_payment_provider.make_payment(
-                card, request.form["cvc"], subtotal
-            )
+            cvc = request.form["cvc"]
         else:
-            card = selection
-            paid = demo_payment_provider.make_payment(
-                card, request.form["cvc-input"], subtotal
-            )
+            card, cvc = selection, request.form["cvc-input"]
 
-        bill = mongo.db.bills.find_one_and_update(
-            {"_id": ObjectId(bill_id)}, {"$inc": {"paid": paid}},
-            return_document=ReturnDocument.AFTER
-        )
-
-        if bill["paid"] >= bill["subtotal"] * (1 + TAX_RATE / 100):
-            mongo.db.bills.delete_one({"_id": ObjectId(bill_id)})
-            mongo.db.groups.find_one_and_update(
-                {'active_bill_id': ObjectId(bill_id)},
-                {"$set": {"active_bill_id": None}}
+        _, state = actions.pay_share(key, bill, current_user, card, cvc)
+        if not state:
+            # Voided or settled since the read above, nothing was charged
+            flash(
+                "This bill was closed while you were paying. "
+                "You have not been charged.", "error"
             )
+            return redirect(url_for('customer.dashboard'))
 
         flash("Payment successful!", "success")
         return redirect(url_for('customer.dashboard'))
-    except PaymentError as e:
+    except (PaymentError, ValueError) as e:
         flash(str(e), "error")
         return redirect(
-            url_for('customer_bills.pay_bill_menu', bill_id=bill_id)
+            url_for(
+                'customer_bills.pay_bill_menu',
+                group_id=group_id, bill_id=bill_id
+            )
         )
@@ -1,15 +1,25 @@
+import json
 from dataclasses import dataclass
 from datetime import datetime
 
-from bson.objectid import ObjectId
 from flask import Blueprint, flash, redirect, render_template, request, url_for
 from flask_login import current_user, login_required
-from pymongo.errors import DuplicateKeyError
 
-from app import TAX_RATE, mongo
+from app import TAX_RATE, sock
+from app.models import BillVersion, GroupMembership, Member, Wallet
 from app.payment import PaymentError, demo_payment_provider
-from app.utils.code_generator import generate_code
+from app.storage import store
+from app.utils import actions
+from app.utils.code_filter import group_codes
 from app.utils.decorators import customer_access_required
+from app.utils.directory import bill_key
+from app.utils.etag import not_modified, version_tag, with_etag
+from app.utils.fanout import gather
+from app.utils.ledger import payment_history
+from app.utils.live import (POLL_INTERVAL, assign_item, assign_items,
+                            claim_unassigned, pending, split_evenly,
+                            subscribe, unsubscribe)
+from app.utils.money import bill_shares
 
 customer_bp = Blueprint('customer', __name__, url_prefix='/customer')
 
@@ -40,19 +50,15 @@ def dashboard():
     shows user's groups
     '''
     # Find all groups where user is a member
-    groups = mongo.db.groups.find({'members': current_user.id})
-    groups_list = list(groups)
-
-    payment_methods = (
-        mongo.db.users.find_one({"_id": ObjectId(current_user.id)})
-        ["payment_methods"]
-    )
+    groups = store.groups.for_member(current_user.id)
+    wallet = store.users.get(current_user.id, Wallet)
 
     return render_template('customer/dashboard.html',
                            title='My Groups',
-                           groups=groups_list,
+                           groups=groups,
                            user_id=current_user.id,
-                           payment_methods=payment_methods)
+                           payment_methods=wallet.payment_methods,
+                           payments=payment_history(current_user.id))
 
 
 @customer_bp.route('/group/create', methods=['GET', 'POST'])
@@ -63,7 +69,6 @@ def create_group():
     Create a new group
     '''
     if request.method == 'POST':
-        mongo.db.groups.create_index([("code", 1)], unique=True)
         # Get form data
         group_name = request.form.get('group_name')
 
@@ -72,23 +77,7 @@ def create_group():
             flash('Group name is required', 'error')
             return redirect(url_for('customer.create_group'))
 
-        while True:
-            try:
-                # Create group document
-                new_group = {
-                    'name': group_name.strip(),
-                    'creator_id': current_user.id,
-                    'members': [current_user.id],
-                    'active_bill_id': None,
-                    'active': True,
-                    'created_at': None,
-                    'code': generate_code()
-                }
-                # Insert into MongoDB
-                mongo.db.groups.insert_one(new_group)
-                break
-            except DuplicateKeyError:
-                pass
+        actions.create_group(group_name.strip(), current_user.id)
 
         flash(f'Group "{group_name}" created successfully!', 'success')
         return redirect(url_for('customer.dashboard'))
@@ -113,9 +102,10 @@ def join_group():
             return redirect(url_for('customer.join_group'))
 
         try:
-            # Find the group
-            group = mongo.db.groups.find_one(
-                {'code': group_id.strip().upper()}
+            # Find the group, typos and guesses are turned away in memory
+            code = group_id.strip().upper()
+            group = group_codes.might_exist(code) and store.groups.by_code(
+                code, GroupMembership
             )
 
             if not group:
@@ -127,17 +117,14 @@ def join_group():
                 return redirect(url_for('customer.join_group'))
 
             # Check if user is already a member
-            if current_user.id in group.get('members', []):
+            if current_user.id in group.members:
                 flash('You are already a member of this group!', 'error')
                 return redirect(url_for('customer.dashboard'))
 
-            # Add user to group members
-            mongo.db.groups.update_one(
-                {'_id': group["_id"]},
-                {'$push': {'members': current_user.id}}
-            )
+            # Add user to group members, and to the bill the group is on
+            actions.join_group(group, current_user.id)
 
-            flash(f'Successfully joined group "{group["name"]}"!', 'success')
+            flash(f'Successfully joined group "{group.name}"!', 'success')
             return redirect(url_for('customer.dashboard'))
 
         except Exception:
@@ -156,48 +143,52 @@ def group_detail(group_id):
     Show group details including members and active bill
     '''
     # Find the group
-    group = mongo.db.groups.find_one({'_id': ObjectId(group_id)})
+    group = store.groups.get(group_id)
 
     if not group:
         flash('Group not found.', 'error')
         return redirect(url_for('customer.dashboard'))
 
     # Check if current user is a member
-    if current_user.id not in group.get('members', []):
+    if current_user.id not in group.members:
         flash('You are not a member of this group.', 'error')
         return redirect(url_for('customer.dashboard'))
 
-    # Get member details
-    member_ids = [ObjectId(m) for m in group.get('members', [])]
-    members = list(mongo.db.users.find({'_id': {'$in': member_ids}}))
+    # Only the bill's version is needed to tell if the page changed
+    bill_version = key = None
+    if group.active_bill_id:
+        key = bill_key(group.active_bill_id)
+        bill_version = store.bills.get(key, BillVersion)
+    etag = version_tag(
+        'group_detail', current_user.id, group_id, group.version,
+        group.active_bill_id, bill_version and bill_version.version
+    )
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    # Member details and the active bill don't depend on each other
+    members, active_bill = gather(
+        lambda: store.users.get_many(group.members, Member),
+        lambda: bill_version and store.bills.get(key)
+    )
 
-    # Get active bill if exists
-    active_bill = None
-    subtotal = 0
-    if group.get('active_bill_id'):
-        active_bill = mongo.db.bills.find_one(
-            {'_id': ObjectId(group['active_bill_id'])}
-        )
-        if active_bill:
-            for item in active_bill["contents"]:
-                if current_user.id in item["assigned_to"]:
-                    subtotal += (
-                        item["price"] * item["quantity"]
-                        / len(item["assigned_to"])
-                    )
+    share = 0
+    if active_bill:
+        share = bill_shares(active_bill.contents).get(current_user.id, 0)
 
-    return render_template(
+    return with_etag(render_template(
         'customer/group_detail.html',
-        title=group['name'],
+        title=group.name,
         group=group,
         members=members,
         active_bill=active_bill,
         is_creator=(
-            current_user.id == group['creator_id']
+            current_user.id == group.creator_id
         ),
-        subtotal=subtotal,
+        share=share,
         tax=TAX_RATE
-    )
+    ), etag)
 
 
 @customer_bp.route('/group/<group_id>/leave', methods=['POST'])
@@ -208,21 +199,21 @@ def leave_group(group_id):
     Leave a group
     '''
     try:
-        group = mongo.db.groups.find_one({'_id': ObjectId(group_id)})
+        group = store.groups.get(group_id)
 
         if not group:
             flash('Group not found.', 'error')
             return redirect(url_for('customer.dashboard'))
 
         # Check if user is a member
-        if current_user.id not in group.get('members', []):
+        if current_user.id not in group.members:
             flash('You are not a member of this group.', 'error')
             return redirect(url_for('customer.dashboard'))
 
         # Prevent creator from leaving if there are other members
         if (
-            current_user.id == group['creator_id']
-            and len(group.get('members', [])) > 1
+            current_user.id == group.creator_id
+            and len(group.members) > 1
         ):
             flash(
                 'As the creator, you cannot leave while '
@@ -233,17 +224,10 @@ def leave_group(group_id):
                 url_for('customer.group_detail', group_id=group_id)
             )
 
-        # Remove user from group
-        mongo.db.groups.update_one(
-            {'_id': ObjectId(group_id)},
-            {'$pull': {'members': current_user.id}})
+        # Remove user from group and its bill, deleting it if left empty
+        actions.leave_group(group, current_user.id)
 
-        # If this was the last member, delete the group
-        updated_group = mongo.db.groups.find_one({'_id': ObjectId(group_id)})
-        if len(updated_group.get('members', [])) == 0:
-            mongo.db.groups.delete_one({'_id': ObjectId(group_id)})
-
-        flash(f'You have left the group "{group["name"]}".', 'success')
+        flash(f'You have left the group "{group.name}".', 'success')
         return redirect(url_for('customer.dashboard'))
 
     except Exception:
@@ -259,46 +243,102 @@ def display_bill(group_id):
         flash('Access denied. Customer account required.', 'error')
         return redirect(url_for('vendor.dashboard'))
 
-    group = mongo.db.groups.find_one({"_id": ObjectId(group_id)})
+    group = store.groups.get(group_id, GroupMembership)
     if not group:
         flash("Group not found.", "error")
         return redirect(url_for("customer.dashboard"))
 
-    if current_user.id not in group.get("members", []):
+    if current_user.id not in group.members:
         flash("You are not a member of this group.", "error")
         return redirect(url_for("customer.dashboard"))
 
-    bill = mongo.db.bills.find_one(
-        {"_id": ObjectId(group.get("active_bill_id"))}
+    key = bill_key(group.active_bill_id)
+    bill = store.bills.get(key, BillVersion)
+    if not bill:
+        flash("Bill not found.", "error")
+        return redirect(url_for("customer.dashboard"))
+
+    etag = version_tag(
+        "display_bill", current_user.id, group_id, group.version,
+        bill.id, bill.version
+    )
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    bill, found = gather(
+        lambda: store.bills.get(key),
+        lambda: store.users.get_many(group.members, Member)
     )
     if not bill:
         flash("Bill not found.", "error")
         return redirect(url_for("customer.dashboard"))
 
-    users = []
-    for userid in group.get("members", []):
-        users.append(mongo.db.users.find_one(
-            {"_id": ObjectId(userid)}
-        ))
-
-    # display subtotals
-    subtotals = {}
-    for member in group.get("members"):
-        subtotals[member] = 0.0
-    for item in bill.get("contents"):
-        for userid in item.get('assigned_to'):
-            subtotals[userid] += round(float(
-                (item.get('price')*item.get('quantity'))
-                / len(item.get('assigned_to'))
-            ), 2)
-    return render_template(
+    # Keep members in group order
+    found = {user.id: user for user in found}
+    users = [
+        found[userid] for userid in group.members
+        if userid in found
+    ]
+
+    # What each member owes, tax included
+    shares = bill_shares(bill.contents)
+    return with_etag(render_template(
         "bills/display_bill.html",
         bill=bill,
         tax=TAX_RATE,
         group=group,
-        subtotals=subtotals,
+        shares=shares,
         users=users
-    )
+    ), etag)
+
+
+@sock.route('/bill/live/<group_id>', bp=customer_bp)
+@login_required
+@customer_access_required
+def live_bill(ws, group_id):
+    '''
+    Push split changes on the group's bill to this viewer as JSON deltas,
+    and apply the assignments it sends: {"item_id": ..., "user_ids": [...]}
+    '''
+    group = store.groups.get(group_id, GroupMembership)
+    if not group or current_user.id not in group.members:
+        return
+    key = bill_key(group.active_bill_id)
+    if not key:
+        return
+
+    subscriber = subscribe(key["_id"])
+    try:
+        while True:
+            message = ws.receive(timeout=POLL_INTERVAL)
+            if message:
+                try:
+                    change = json.loads(message)
+                    item_id, user_ids = change["item_id"], change["user_ids"]
+                    if not isinstance(user_ids, list):
+                        raise TypeError(user_ids)
+                except (ValueError, KeyError, TypeError):
+                    ws.send(json.dumps(
+                        {"type": "error", "message": "Invalid change."}
+                    ))
+                    continue
+                if not set(user_ids) <= set(group.members):
+                    ws.send(json.dumps({
+                        "type": "error",
+                        "message": "One or more selected users are not "
+                                   "in this group."
+                    }))
+                elif not assign_item(key, item_id, user_ids):
+                    ws.send(json.dumps({
+                        "type": "error",
+                        "message": "Item not found, or the bill is already "
+                                   "being paid."
+                    }))
+            for delta in pending(subscriber):
+                ws.send(delta)
+    finally:
+        unsubscribe(key["_id"], subscriber)
 
 
 @customer_bp.route(
@@ -306,8 +346,8 @@ def display_bill(group_id):
 )
 @login_required
 def show_split_interface(group_id, bill_id, item_id):
-    group = mongo.db.groups.find_one({"_id": ObjectId(group_id)})
-    bill = mongo.db.bills.find_one({"_id": ObjectId(bill_id)})
+    group = store.groups.get(group_id, GroupMembership)
+    bill = store.bills.get(bill_key(bill_id))
 
     if not group or not bill:
         flash("Invalid group or bill.", "error")
@@ -316,7 +356,7 @@ def show_split_interface(group_id, bill_id, item_id):
     # Find the target item
     target_item = next(
         (
-            it for it in bill.get("contents", [])
+            it for it in bill.contents
             if str(it["_id"]) == str(item_id)
         ),
         None
@@ -325,16 +365,12 @@ def show_split_interface(group_id, bill_id, item_id):
         flash("Item not found.", "error")
         return redirect(url_for("customer.display_bill", group_id=group_id))
 
-    assigned_users = []
-    for id in target_item.get("assigned_to", []):
-        assigned_users.append(mongo.db.users.find_one({"_id": ObjectId(id)}))
+    assigned_users = store.users.get_many(
+        target_item.get("assigned_to", []), Member
+    )
 
     # Load group members for display
-    members = list(
-        mongo.db.users.find(
-            {"_id": {"$in": [ObjectId(uid) for uid in group["members"]]}}
-        )
-    )
+    members = store.users.get_many(group.members, Member)
 
     return render_template(
         "bills/split_bill.html",
@@ -353,30 +389,122 @@ def show_split_interface(group_id, bill_id, item_id):
 def split_bill(group_id, bill_id, item_id):
     user_ids = request.form.getlist("user_ids")
 
-    group = mongo.db.groups.find_one({"_id": ObjectId(group_id)})
+    group = store.groups.get(group_id, GroupMembership)
     if not group:
         flash("Group not found.", "error")
         return redirect(url_for("customer.dashboard"))
 
-    bill = mongo.db.bills.find_one({"_id": ObjectId(bill_id)})
+    key = bill_key(bill_id)
+    bill = store.bills.get(key, BillVersion)
     if not bill:
         flash("Bill not found.", "error")
         return redirect(url_for("customer.dashboard"))
 
     # Verify all selected users belong to this group
     for uid in user_ids:
-        if uid not in group["members"]:
+        if uid not in group.members:
             flash("One or more selected users are not in this group.", "error")
             return redirect(
                 url_for("customer.display_bill", group_id=group_id)
             )
 
-    # Update the bill’s item to assign all selected members
-    mongo.db.bills.update_one(
-        {"_id": ObjectId(bill_id), "contents._id": item_id},
-        {"$set": {"contents.$.assigned_to": user_ids}}
+    # Assign all selected members, members viewing the bill see it live
+    if not assign_item(key, item_id, user_ids):
+        flash("Item not found, or the bill is already being paid.", "error")
+        return redirect(url_for("customer.display_bill", group_id=group_id))
+
+    flash("Bill successfully split among selected members!", "success")
+    return redirect(url_for("customer.display_bill", group_id=group_id))
+
+
+@customer_bp.route('/bill/split_matrix/<group_id>', methods=['GET'])
+@login_required
+@customer_access_required
+def show_split_matrix(group_id):
+    '''
+    Every item against every member, to assign the whole bill at once
+    '''
+    group = store.groups.get(group_id, GroupMembership)
+    if not group or current_user.id not in group.members:
+        flash("Group not found.", "error")
+        return redirect(url_for("customer.dashboard"))
+
+    bill, members = gather(
+        lambda: store.bills.get(bill_key(group.active_bill_id)),
+        lambda: store.users.get_many(group.members, Member)
+    )
+    if not bill:
+        flash("Bill not found.", "error")
+        return redirect(url_for("customer.dashboard"))
+
+    return render_template(
+        "bills/split_matrix.html",
+        group=group,
+        bill=bill,
+        members=members
+    )
+
+
+@customer_bp.route('/bill/split_matrix/<group_id>', methods=['POST'])
+@login_required
+@customer_access_required
+def split_matrix(group_id):
+    '''
+    Assign every item in the submitted matrix in one update
+    '''
+    assignments = {
+        item_id: request.form.getlist(f"assign-{item_id}")
+        for item_id in request.form.getlist("items")
+    }
+    return bulk_split(
+        group_id, lambda key, members: assign_items(key, assignments),
+        [user_id for user_ids in assignments.values() for user_id in user_ids]
+    )
+
+
+@customer_bp.route('/bill/split_evenly/<group_id>', methods=['POST'])
+@login_required
+@customer_access_required
+def split_bill_evenly(group_id):
+    '''
+    Split every item evenly among all the group's members
+    '''
+    return bulk_split(group_id, split_evenly)
+
+
+@customer_bp.route('/bill/claim_unassigned/<group_id>', methods=['POST'])
+@login_required
+@customer_access_required
+def claim_unassigned_items(group_id):
+    '''
+    Assign every item nobody has taken yet to the current user
+    '''
+    return bulk_split(
+        group_id, lambda key, members: claim_unassigned(key, current_user.id)
     )
 
+
+def bulk_split(group_id, split, user_ids=()):
+    '''
+    Check `user_ids` against the group once, then apply `split` to the
+    group's bill as a single update
+    '''
+    group = store.groups.get(group_id, GroupMembership)
+    if not group or current_user.id not in group.members:
+        flash("Group not found.", "error")
+        return redirect(url_for("customer.dashboard"))
+
+    if not set(user_ids) <= set(group.members):
+        flash("One or more selected users are not in this group.", "error")
+        return redirect(url_for("customer.display_bill", group_id=group_id))
+
+    key = bill_key(group.active_bill_id)
+    if not key or not split(key, group.members):
+        flash(
+            "Nothing to split, or the bill is already being paid.", "error"
+        )
+        return redirect(url_for("customer.display_bill", group_id=group_id))
+
     flash("Bill successfully split among selected members!", "success")
     return redirect(url_for("customer.display_bill", group_id=group_id))
 
@@ -402,10 +530,7 @@ def add_payment_method():
         cardholder_name=request.form["cardholder_name"]
     )
 
-    mongo.db.users.find_one_and_update(
-        {"_id": ObjectId(current_user.id)},
-        {"$push": {"payment_methods": new_card.to_dict()}}
-    )
+    store.users.add_payment_method(current_user.id, new_card.to_dict())
 
     return redirect(url_for("customer.dashboard"))
 
@@ -425,10 +550,7 @@ def delete_payment_method(token):
     Delete a payment method
     '''
 
-    mongo.db.users.find_one_and_update(
-        {"_id": ObjectId(current_user.id)},
-        {"$pull": {"payment_methods": {"token": token}}}
-    )
+    store.users.remove_payment_method(current_user.id, token)
 
     demo_payment_provider.delete_card(token)
 
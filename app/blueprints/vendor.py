@@ -1,9 +1,16 @@
-from bson.objectid import ObjectId
-from flask import Blueprint, flash, redirect, render_template, request, url_for
+from flask import (Blueprint, Response, flash, jsonify, redirect,
+                   render_template, request, stream_with_context, url_for)
 from flask_login import current_user, login_required
 
-from app import TAX_RATE, mongo
+from app import TAX_RATE
+from app.models import Bill
+from app.storage import store
 from app.utils.decorators import vendor_access_required
+from app.utils.export import (EXPORT_FORMATS, bill_cursor, export_lines,
+                              parse_date)
+from app.utils.menu import PAGE_SIZE, item_json, search_menu
+from app.utils.money import to_cents
+from app.utils.rollups import todays_revenue
 
 vendor_bp = Blueprint('vendor', __name__, url_prefix='/vendor')
 
@@ -16,31 +23,53 @@ def dashboard():
     Vendor dashboard - shows active bills and menu items
     '''
     # Get vendor's active bills
-    active_bills = list(mongo.db.bills.find({
-        'vendor_id': current_user.id,
-        'status': {'$in': ['pending', 'active']}
-        })
-    )
+    active_bills = store.bills.for_vendor(current_user.id, Bill.UNSETTLED)
 
-    # Get completed bills count
-    # completed_count = mongo.db.bills.count_documents({
-    #     'vendor_id': current_user.id,
-    #     'status': 'completed'
-    # })
+    # Today's settled bills and revenue, pre-aggregated by the rollup job
+    today = todays_revenue(current_user.id) or {}
 
     # Get menu items count
-    menu_items_count = mongo.db.menu_items.count_documents(
-        {'vendor_id': current_user.id}
-    )
+    menu_items_count = store.menu.count(current_user.id)
 
     return render_template('vendor/dashboard.html',
                            title='Vendor Dashboard',
                            active_bills=active_bills,
-                           # completed_count=completed_count,
+                           today=today,
                            menu_items_count=menu_items_count,
                            tax=TAX_RATE)
 
 
+@vendor_bp.route('/export')
+@login_required
+@vendor_access_required
+def export_bills():
+    '''
+    Stream the vendor's bill history as CSV or JSONL
+    optionally filtered to a created_at date range
+    '''
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        flash('Unknown export format.', 'error')
+        return redirect(url_for('vendor.dashboard'))
+
+    try:
+        start = parse_date(request.args.get('start'))
+        end = parse_date(request.args.get('end'))
+    except ValueError:
+        flash('Dates must be in YYYY-MM-DD format.', 'error')
+        return redirect(url_for('vendor.dashboard'))
+
+    bills = bill_cursor(current_user.id, start, end)
+    return Response(
+        stream_with_context(export_lines(bills, export_format)),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={
+            'Content-Disposition':
+                f'attachment; filename=bills.{export_format}'
+        }
+    )
+
+
 @vendor_bp.route('/menu')
 @login_required
 @vendor_access_required
@@ -49,13 +78,31 @@ def menu():
     Vendor menu items management
     '''
     # Get all menu items for this vendor
-    menu_items = list(mongo.db.menu_items.find({'vendor_id': current_user.id}))
+    menu_items = store.menu.for_vendor(current_user.id)
 
     return render_template('vendor/menu.html',
                            title='Menu Items',
                            menu_items=menu_items)
 
 
+@vendor_bp.route('/menu/search')
+@login_required
+@vendor_access_required
+def search_menu_items():
+    '''
+    JSON page of menu items matching `q`, optionally in one `category`
+    '''
+    result = search_menu(
+        current_user.id,
+        query=request.args.get('q', ''),
+        category=request.args.get('category'),
+        page=request.args.get('page', 1, type=int),
+        per_page=request.args.get('per_page', PAGE_SIZE, type=int),
+    )
+    result['items'] = [item_json(item) for item in result['items']]
+    return jsonify(result)
+
+
 @vendor_bp.route('/menu/add', methods=['GET', 'POST'])
 @login_required
 @vendor_access_required
@@ -75,8 +122,8 @@ def add_menu_item():
             return redirect(url_for('vendor.add_menu_item'))
 
         try:
-            price_float = float(price)
-            if price_float <= 0:
+            price_cents = to_cents(price)
+            if price_cents <= 0:
                 flash('Price must be greater than 0.', 'error')
                 return redirect(url_for('vendor.add_menu_item'))
         except ValueError:
@@ -87,13 +134,13 @@ def add_menu_item():
         menu_item = {
             'vendor_id': current_user.id,
             'name': name.strip(),
-            'price': price_float,
+            'price': price_cents,
             'description': description.strip(),
             'category': category,
             'available': True
         }
 
-        mongo.db.menu_items.insert_one(menu_item)
+        store.menu.create(menu_item)
         flash(f'Menu item "{name}" added successfully', 'success')
         return redirect(url_for('vendor.menu'))
 
@@ -109,15 +156,13 @@ def delete_menu_item(item_id):
     '''
     try:
         # Verify ownership
-        item = mongo.db.menu_items.find_one({
-            '_id': ObjectId(item_id),
-            'vendor_id': current_user.id})
+        item = store.menu.get(current_user.id, item_id)
 
         if not item:
             flash('Menu item not found.', 'error')
             return redirect(url_for('vendor.menu'))
 
-        mongo.db.menu_items.delete_one({'_id': ObjectId(item_id)})
+        store.menu.delete(current_user.id, item_id)
         flash('Menu item deleted successfully!', 'success')
 
     except Exception:
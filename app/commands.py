@@ -0,0 +1,239 @@
+'''
+flask CLI commands, e.g. `flask build-assets`
+'''
+import os
+import time
+
+import click
+
+from app import app
+from app.utils.assets import build_assets
+from app.utils.directory import (backfill_directory, explain_targets,
+                                 hot_queries, shard_collections)
+from app.utils.export import (EXPORT_BATCH_SIZE, EXPORT_FORMATS, bill_cursor,
+                              export_lines, parse_date)
+from app.utils.ledger import rebuild_paid
+from app.utils.lifecycle import (SWEEP_BATCH_SIZE, SWEEP_DUTY_CYCLE,
+                                 migrate_bill_status, sweep)
+from app.utils.money import migrate_to_cents
+from app.utils.profiler import profile_token
+from app.utils.reconcile import RECONCILE_BATCH_SIZE, reconcile_subtotals
+from app.utils.rollups import rollup_daily_revenue
+from app.utils.seed import SEED_BATCH_SIZE, Scale, seed
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    '''
+    Fingerprint and precompress static files into static/dist
+    '''
+    manifest = build_assets(app.static_folder)
+    for logical, hashed in manifest.items():
+        click.echo(f"{logical} -> {hashed}")
+
+
+@app.cli.command('export-bills')
+@click.argument('vendor_id')
+@click.option('--format', 'export_format', default='csv',
+              type=click.Choice(list(EXPORT_FORMATS)))
+@click.option('--start', help='First day to include, YYYY-MM-DD')
+@click.option('--end', help='Last day to include, YYYY-MM-DD')
+@click.option('--batch-size', default=EXPORT_BATCH_SIZE, show_default=True)
+@click.option('--output', type=click.File('w'), default='-')
+def export_bills_command(vendor_id, export_format, start, end, batch_size,
+                         output):
+    '''
+    Stream a vendor's bill history to a file or stdout
+    '''
+    try:
+        start, end = parse_date(start), parse_date(end)
+    except ValueError:
+        raise click.BadParameter('dates must be in YYYY-MM-DD format')
+
+    bills = bill_cursor(vendor_id, start, end, batch_size)
+    for line in export_lines(bills, export_format):
+        output.write(line)
+
+
+@app.cli.command('rollup-revenue')
+def rollup_revenue_command():
+    '''
+    Update the per-vendor daily revenue rollups from settled bills
+    '''
+    start, end = rollup_daily_revenue()
+    click.echo(f"Rolled up bills completed {start:%Y-%m-%d %H:%M} - {end}")
+
+
+@app.cli.command('rebuild-paid')
+@click.argument('bill_id', required=False)
+def rebuild_paid_command(bill_id):
+    '''
+    Re-derive bill.paid from the payments ledger
+    '''
+    rebuild_paid(bill_id)
+    click.echo(f"Rebuilt paid totals for {bill_id or 'all bills'}")
+
+
+@app.cli.command('reconcile-subtotals')
+@click.option('--batch-size', default=RECONCILE_BATCH_SIZE, show_default=True)
+@click.option('--dry-run', is_flag=True,
+              help='Report drifted bills without correcting them')
+@click.option('--all', 'every', is_flag=True,
+              help='Check every unsettled bill, not only changed ones')
+def reconcile_subtotals_command(batch_size, dry_run, every):
+    '''
+    Recompute open bills' subtotals from their contents, fixing any drift
+    '''
+    checked, report = reconcile_subtotals(batch_size, dry_run, every)
+    for bill in report:
+        click.echo(
+            f"{bill['bill_id']} vendor {bill['vendor_id']} table "
+            f"{bill['table_number']}: {bill['subtotal']} -> "
+            f"{bill['computed']} ({bill['drift']:+d} cents)"
+        )
+    fixed = 'would be corrected' if dry_run else 'corrected'
+    click.echo(f"Checked {checked} bills, {len(report)} {fixed}")
+
+
+@app.cli.command('migrate-money')
+def migrate_money_command():
+    '''
+    Convert stored float dollar amounts to integer cents
+    '''
+    migrate_to_cents()
+    click.echo("Amounts converted to cents, re-run `flask rollup-revenue`")
+
+
+@app.cli.command('migrate-bill-status')
+def migrate_bill_status_command():
+    '''
+    Move legacy pending/completed bills onto the open/settled lifecycle
+    '''
+    updated = migrate_bill_status()
+    click.echo(f"Updated {updated} bills, closed bills' codes released")
+
+
+@app.cli.command('sweep')
+@click.option('--batch-size', default=SWEEP_BATCH_SIZE, show_default=True)
+@click.option('--duty-cycle', default=SWEEP_DUTY_CYCLE, show_default=True,
+              type=click.FloatRange(0, 1, min_open=True),
+              help='Fraction of the time spent on database work')
+@click.option('--every', default=0, show_default=True,
+              help='Keep running, sweeping every this many seconds')
+def sweep_command(batch_size, duty_cycle, every):
+    '''
+    Void abandoned bills, clear dangling group links, delete dead groups
+    '''
+    while True:
+        counts = sweep(batch_size=batch_size, duty_cycle=duty_cycle)
+        click.echo(', '.join(f"{name} {n}" for name, n in counts.items()))
+        if not every:
+            break
+        time.sleep(every)
+
+
+@app.cli.command('backfill-directory')
+def backfill_directory_command():
+    '''
+    Add bill directory and group code entries for bills and groups that
+    predate them
+    '''
+    backfill_directory()
+    click.echo("Bill directory and group codes are up to date")
+
+
+@app.cli.command('shard-collections')
+def shard_collections_command():
+    '''
+    Shard bills, menu items and groups, run against a mongos
+    '''
+    shard_collections()
+    click.echo("Collections sharded")
+
+
+@app.cli.command('shard-check')
+def shard_check_command():
+    '''
+    Explain the hot route queries and fail if any would hit every shard
+    '''
+    queries = hot_queries()
+    if not queries:
+        raise click.ClickException('need at least one bill and group')
+
+    scattered = 0
+    for (collection, query), shards in explain_targets(queries).items():
+        if shards is None:
+            raise click.ClickException('not connected to a mongos')
+        if len(shards) > 1:
+            scattered += 1
+        click.echo(f"{collection} {query} -> {', '.join(shards)}")
+    if scattered:
+        raise click.ClickException(f"{scattered} queries are scatter-gather")
+
+
+@app.cli.command('profile-token')
+@click.option('--note', default='', help='Who or what the token is for')
+def profile_token_command(note):
+    '''
+    Print a signed X-Profile header value for profiling requests on demand
+    '''
+    click.echo(profile_token(note))
+
+
+@app.cli.command('seed')
+@click.option('--vendors', default=Scale.vendors, show_default=True)
+@click.option('--customers', default=Scale.customers, show_default=True)
+@click.option('--groups', default=Scale.groups, show_default=True)
+@click.option('--bills', default=Scale.bills, show_default=True)
+@click.option('--menu-size', default=Scale.menu_size, show_default=True)
+@click.option('--items-per-bill', default=Scale.items_per_bill,
+              show_default=True, help='Average line items on a bill')
+@click.option('--open-fraction', default=Scale.open_fraction,
+              show_default=True, type=click.FloatRange(0, 1),
+              help='Share of bills still open, at most one per group')
+@click.option('--vendor-skew', default=Scale.vendor_skew, show_default=True,
+              type=click.FloatRange(0),
+              help='Zipf exponent of bills per vendor, 0 for uniform')
+@click.option('--large-group-rate', default=Scale.large_group_rate,
+              show_default=True, type=click.FloatRange(0, 1),
+              help='Share of groups that are very large')
+@click.option('--large-group-size', default=Scale.large_group_size,
+              show_default=True)
+@click.option('--days', default=Scale.days, show_default=True,
+              help='Days of bill history')
+@click.option('--seed', 'random_seed', default=Scale.seed, show_default=True)
+@click.option('--password', default='seed-password', show_default=True,
+              help='Password of every generated user')
+@click.option('--workers', default=os.cpu_count(), show_default=True,
+              help='Processes generating and inserting data')
+@click.option('--batch-size', default=SEED_BATCH_SIZE, show_default=True)
+def seed_command(vendors, customers, groups, bills, menu_size,
+                 items_per_bill, open_fraction, vendor_skew,
+                 large_group_rate, large_group_size, days, random_seed,
+                 password, workers, batch_size):
+    '''
+    Fill an empty database with synthetic data for scaling tests
+    '''
+    scale = Scale(
+        vendors=vendors, customers=customers, groups=groups, bills=bills,
+        menu_size=menu_size, items_per_bill=items_per_bill,
+        open_fraction=open_fraction, vendor_skew=vendor_skew,
+        large_group_rate=large_group_rate,
+        large_group_size=large_group_size, days=days, seed=random_seed
+    )
+    started = time.monotonic()
+
+    def progress(counts):
+        click.echo(
+            ', '.join(f"{name} {n}" for name, n in counts.items()) + '\r',
+            nl=False
+        )
+
+    try:
+        counts = seed(scale, password, workers, batch_size, progress)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo()
+    elapsed = time.monotonic() - started
+    click.echo(f"Inserted {sum(counts.values())} documents in {elapsed:.0f}s,"
+               f" log in as vendor0@seed.example or customer0@seed.example")
@@ -1,24 +1,119 @@
+from copy import copy
 from datetime import datetime
 
 import pytz
-from flask_login import UserMixin
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from app import mongo
 
-class User(UserMixin):
+MISSING = object()
+
+
+class NotLoaded(LookupError):
+    '''
+    A model slot read that its projection left out
+
+    Not an AttributeError, so templates fail on it instead of rendering
+    the field as blank.
+    '''
+
+
+class Model:
+    '''
+    Base for slotted models built from MongoDB documents
+
+    `fields` make up the projection and are the only slots loaded. Reading
+    any other slot raises NotLoaded rather than going back to the database
+    for it: read the document with a model that lists the field instead.
+    A use case that needs fewer fields subclasses the model, narrows
+    `fields` and sets `__slots__ = ()`.
+    '''
+    __slots__ = ('id',)
+    collection = None
+    fields = ()
+    defaults = {}
+    converters = {}
+
+    def __init__(self, data):
+        self.id = str(data.get('_id', ''))
+        for name in self.fields:
+            self._load(name, data)
+
+    def _load(self, name, data):
+        value = data.get(name, MISSING)
+        if value is MISSING:
+            value = copy(self.defaults.get(name))
+        elif name in self.converters:
+            value = self.converters[name](value)
+        setattr(self, name, value)
+
+    def __getattr__(self, name):
+        # Only reached when a slot hasn't been loaded
+        if name not in self.slot_names():
+            raise AttributeError(name)
+        raise NotLoaded(
+            f"{type(self).__name__}.{name} is not in its fields, read the "
+            f"{self.collection} document with a model that has it"
+        )
+
+    @classmethod
+    def slot_names(cls):
+        return {
+            name for klass in cls.__mro__
+            for name in getattr(klass, '__slots__', ())
+        }
+
+    @classmethod
+    def projection(cls):
+        return dict.fromkeys(cls.fields, 1)
+
+    @classmethod
+    def find_one(cls, query):
+        # A lookup key that didn't resolve (see app/utils/directory.py)
+        if query is None:
+            return None
+        data = mongo.db[cls.collection].find_one(query, cls.projection())
+        return cls(data) if data else None
+
+    @classmethod
+    def find(cls, query, sort=None, limit=0):
+        cursor = mongo.db[cls.collection].find(query, cls.projection())
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        return [cls(data) for data in cursor]
+
+
+def _str_or_none(value):
+    return str(value) if value else None
+
+
+class User(Model):
     '''
     User model
+
+    password_hash and payment_methods are only loaded by the models that
+    list them (LoginUser, Wallet)
     '''
-    def __init__(self, user_data):
-        self.id = str(user_data.get('_id', ''))
-        self.username = user_data.get('username', '')
-        self.email = user_data.get('email', '')
-        self.password_hash = user_data.get('password_hash', '')
-        self.user_type = user_data.get('user_type', 'customer')
-        # self.phone = user_data.get('phone', '')
-        self.payment_methods = user_data.get('payment_methods', [])
-        self.vendor_name = user_data.get('vendor_name', '')
-        # self.created_at = user_data.get('created_at', datetime.utcnow())
+    collection = 'users'
+    fields = ('username', 'email', 'user_type', 'vendor_name')
+    __slots__ = fields + ('password_hash', 'payment_methods')
+    defaults = {
+        'username': '',
+        'email': '',
+        'user_type': 'customer',
+        'vendor_name': '',
+        'password_hash': '',
+        'payment_methods': [],
+        # 'phone': '',
+        # 'created_at': datetime.utcnow()
+    }
+
+    # Flask-Login interface
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
 
     def set_password(self, password):
         return generate_password_hash(password)
@@ -53,7 +148,31 @@ class User(UserMixin):
         return user_dict
 
 
-class Group:
+class LoginUser(User):
+    '''
+    User checked against a password at login
+    '''
+    __slots__ = ()
+    fields = User.fields + ('password_hash',)
+
+
+class Member(User):
+    '''
+    User as listed among a group's members
+    '''
+    __slots__ = ()
+    fields = ('username',)
+
+
+class Wallet(User):
+    '''
+    A customer's saved payment methods
+    '''
+    __slots__ = ()
+    fields = ('payment_methods',)
+
+
+class Group(Model):
     '''
     Group model
 
@@ -62,56 +181,159 @@ class Group:
     - group.members -> list of Customer IDs (user_type='customer')
     - group.active_bill_id -> links to Bill (created by a vendor)
     '''
-    def __init__(self, group_data):
-        self.id = str(group_data.get('_id', ''))
-        self.name = group_data.get('name', '')
-        self.creator_id = str(group_data.get('creator_id', ''))
-        self.members = [str(m) for m in group_data.get('members', [])]
-        self.active_bill_id = (
-            str(group_data.get('active_bill_id', ''))
-            if group_data.get('active_bill_id') else None
-        )
-        self.active = group_data.get('active', True)
-        self.code = group_data.get('code', "")
-        # self.created_at = group_data.get('created_at', datetime.utcnow())
+    collection = 'groups'
+    fields = (
+        'name', 'creator_id', 'members', 'active_bill_id', 'active', 'code',
+        'version'
+    )
+    __slots__ = fields
+    defaults = {
+        'name': '',
+        'creator_id': '',
+        'members': [],
+        'active_bill_id': None,
+        'active': True,
+        'code': '',
+        'version': 0,
+        # 'created_at': datetime.utcnow()
+    }
+    converters = {
+        'creator_id': str,
+        'members': lambda members: [str(m) for m in members],
+        'active_bill_id': _str_or_none,
+    }
 
 
-class Bill:
+class GroupMembership(Group):
+    '''
+    Just enough of a group to check membership and find its bill
+    '''
+    __slots__ = ()
+    fields = ('name', 'members', 'active_bill_id', 'version')
+
+
+class Bill(Model):
     '''
     Bill model
 
     Relationships:
     - bill.vendor_id -> links to Vendor (User with user_type='vendor')
-    - Group.active_bill_id -> links to this Bill (uni-directional)
-    '''
-    def __init__(self, bill_data):
-        self.id = str(bill_data.get('_id', ''))
-        self.vendor_id = str(bill_data.get('vendor_id', ''))
-        self.table_number = str(bill_data.get('table_number', ''))
-        self.contents = bill_data.get('contents', [])
-        self.subtotal = bill_data.get('subtotal', 0.0)
-        self.status = bill_data.get('status', 'pending')
-        self.session_code = bill_data.get('session_code', '')
-        self.paid = bill_data.get('paid', 0)
-        # self.estimated_total = bill_data.get('estimated_total', 0.0)
-        # self.final_total = bill_data.get('final_total', 0.0)
-        self.created_at = bill_data.get(
-            'created_at', datetime.now(pytz.timezone('US/Eastern'))
-        )
-        # self.updated_at = bill_data.get('updated_at', datetime.utcnow())
+    - Group.active_bill_id -> links to this Bill
+    - bill.members -> ids of everyone in the groups paying it, kept on the
+      bill so the pay path authorizes and prices in one read
+
+    Lifecycle: open -> settling on the first payment -> settled once paid
+    in full, or open -> voided by the vendor. Only open bills take items
+    and splits, and every transition is a conditional update on status.
+    '''
+    OPEN = 'open'
+    SETTLING = 'settling'
+    SETTLED = 'settled'
+    VOIDED = 'voided'
+    UNSETTLED = (OPEN, SETTLING)
+
+    collection = 'bills'
+    fields = (
+        'vendor_id', 'table_number', 'contents', 'subtotal', 'status',
+        'session_code', 'paid', 'members', 'version', 'created_at'
+    )
+    __slots__ = fields + ('completed_at', 'voided_at')
+    defaults = {
+        'vendor_id': '',
+        'table_number': '',
+        'contents': [],
+        # Amounts are integer cents, see app/utils/money.py
+        'subtotal': 0,
+        'status': OPEN,
+        'session_code': '',
+        'paid': 0,
+        'members': [],
+        'version': 0,
+        'created_at': None,
+        'completed_at': None,
+        'voided_at': None,
+        # 'estimated_total': 0.0,
+        # 'final_total': 0.0,
+        # 'updated_at': datetime.utcnow()
+    }
+    converters = {
+        'vendor_id': str,
+        'table_number': str,
+    }
+
+
+class BillVersion(Bill):
+    '''
+    Bill ownership and version, for conditional GETs
+    '''
+    __slots__ = ()
+    fields = ('vendor_id', 'version')
+
+
+class BillCharge(Bill):
+    '''
+    What the pay path needs to price a payer's share
+    '''
+    __slots__ = ()
+    fields = ('contents', 'subtotal', 'paid', 'status')
 
 
-class Payment:
+class BillSummary(Bill):
+    '''
+    Bill as listed on the vendor dashboard, without its line items
+    '''
+    __slots__ = ()
+    fields = ('table_number', 'subtotal', 'status', 'paid')
+
+
+class Payment(Model):
     '''
     Payment model
+
+    Payments are an append-only ledger, bill.paid is a cached total of
+    the payments recorded against the bill.
+
+    Relationships:
+    - payment.bill_id -> links to Bill
+    - payment.user_id -> links to Customer (User with user_type='customer')
     '''
-    def __init__(self, payment_data):
-        self.id = str(payment_data.get('_id', ''))
-        self.bill_id = str(payment_data.get('bill_id', ''))
-        self.user_id = str(payment_data.get('user_id', ''))
-        self.amount = payment_data.get('amount', 0.0)
-        self.status = payment_data.get('status', 'pending')
-        self.payment_method = payment_data.get('payment_method', {})
-        self.items_paid = payment_data.get('items_paid', [])
-        # self.created_at = payment_data.get('created_at', datetime.utcnow())
-        self.completed_at = payment_data.get('completed_at', None)
+    collection = 'payments'
+    fields = (
+        'bill_id', 'user_id', 'username', 'amount', 'status',
+        'payment_method', 'items_paid', 'completed_at'
+    )
+    __slots__ = fields
+    defaults = {
+        'bill_id': '',
+        'user_id': '',
+        'username': '',
+        'amount': 0,
+        'status': 'pending',
+        'payment_method': {},
+        'items_paid': [],
+        # 'created_at': datetime.utcnow()
+        'completed_at': None,
+    }
+    converters = {
+        'bill_id': str,
+        'user_id': str,
+    }
+
+    @staticmethod
+    def create_payment_dict(
+        bill_id, user_id, username, amount, payment_method, items_paid
+    ):
+        '''
+        Create payment dict to save in MongoDB
+        payment_method only ever holds a token or the last four digits
+        '''
+        return {
+            'bill_id': bill_id,
+            'user_id': user_id,
+            'username': username,
+            'amount': amount,
+            'status': 'completed',
+            'payment_method': payment_method,
+            'items_paid': items_paid,
+            'completed_at': datetime.now(pytz.timezone('US/Eastern'))
+        }
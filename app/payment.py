@@ -1,10 +1,15 @@
+import threading
+import time
 import uuid
 from dataclasses import dataclass
 from datetime import datetime
 
+import requests
 from cryptography.fernet import Fernet
+from requests.adapters import HTTPAdapter
 
-from app import mongo
+from app import app
+from app.storage import store
 
 # This would never be stored IRL like this, and would go in a .env file
 # It is only left here because nobody wants to type 32 characters for a demo
@@ -32,6 +37,14 @@ class PaymentError(Exception):
     pass
 
 
+class PaymentUnavailable(PaymentError):
+    '''
+    The network could not answer (timeout, overload, outage),
+    as opposed to declining the card
+    '''
+    pass
+
+
 class PaymentProvider:
     def __init__(self, card_network):
         self.card_network = card_network
@@ -66,9 +79,10 @@ class PaymentProvider:
         '''
         self.card_network.delete_token(token)
 
-    def make_payment(self, card, cvc, amount):
+    def make_payment(self, card, cvc, amount, timeout=None):
         '''
         Make a payment with a card
+        timeout bounds the network call where the network supports it
         '''
         if isinstance(card, dict):
             if len(card["card_number"]) != 16:
@@ -78,7 +92,9 @@ class PaymentProvider:
 
         try:
             self.card_network.validate_card(card, cvc)
-            return self.card_network.make_payment(card, cvc, amount)
+            return self.card_network.make_payment(
+                card, cvc, amount, timeout=timeout
+            )
         except PaymentError:
             raise
 
@@ -104,19 +120,18 @@ class CardNetwork:
         '''
         Register a token representing a card
         '''
-        mongo.db.cards.create_index([("token", 1)], unique=True)
         try:
             self.check_cvc(card, cvc)
             self.check_expiry(card.expiry_date)
         except PaymentError:
             raise
-        mongo.db.cards.insert_one(card.to_dict())
+        store.cards.create(card.to_dict())
 
     def delete_token(self, token):
         '''
         Simulate deleting a saved card
         '''
-        mongo.db.cards.delete_one({"token": token})
+        store.cards.delete(token)
 
     def validate_card(self, card, cvc):
         '''
@@ -124,7 +139,7 @@ class CardNetwork:
         '''
         # Token
         if isinstance(card, str):
-            card = mongo.db.cards.find_one({"token": card})
+            card = store.cards.get(card)
             if not card:
                 raise PaymentError("Card not found")
             if len(fernet.decrypt(card["card_number"]).decode()) != 16:
@@ -136,14 +151,14 @@ class CardNetwork:
             except PaymentError:
                 raise
 
-    def make_payment(self, card, cvc, amount):
+    def make_payment(self, card, cvc, amount, timeout=None):
         '''
         Simulated function call to make a payment
         This would be done at the bank level but is simulated here
         '''
         # Token
         if isinstance(card, str):
-            card = mongo.db.cards.find_one({"token": card})
+            card = store.cards.get(card)
             if not card:
                 raise PaymentError("Card not found")
             card["card_number"] = fernet.decrypt(card["card_number"]).decode()
@@ -159,5 +174,233 @@ class CardNetwork:
         return amount
 
 
-demo_card_network = CardNetwork()
+class RemoteCardNetwork(CardNetwork):
+    '''
+    Card network that authorizes charges over HTTP, e.g. against
+    tools/card_network_sim.py. Cards are still stored and checked locally,
+    only the authorization goes over the wire, through a pooled keep-alive
+    session shared by every request in the worker.
+    '''
+    def __init__(self, base_url, pool_size, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def authorize(self, token, amount, timeout=None):
+        '''
+        Ask the remote network to authorize a charge, within `timeout`
+        seconds if given (a deadline's remaining time) and never longer
+        than the network's own timeout
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        if timeout <= 0:
+            # The caller's deadline has already passed
+            raise PaymentUnavailable("Payment network unavailable, try again")
+        try:
+            response = self.session.post(
+                f"{self.base_url}/authorize",
+                json={"token": token, "amount": amount},
+                timeout=min(timeout, self.timeout)
+            )
+        except requests.RequestException:
+            raise PaymentUnavailable("Payment network unavailable, try again")
+
+        if response.status_code == 402:
+            raise PaymentError(response.json().get("error", "Card declined"))
+        if response.status_code != 200:
+            raise PaymentUnavailable("Payment network unavailable, try again")
+        return response.json()["amount"]
+
+    def make_payment(self, card, cvc, amount, timeout=None):
+        '''
+        Run the local card checks, then authorize remotely
+        '''
+        super().make_payment(card, cvc, amount)
+        token = card if isinstance(card, str) else None
+        return self.authorize(token, amount, timeout=timeout)
+
+
+class CircuitBreaker:
+    '''
+    Fails fast while the card network is unhealthy
+
+    Opens after `failure_threshold` consecutive failures. Once open, one
+    probe call is let through every `reset_timeout` seconds, and the first
+    probe that succeeds closes it again.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        '''
+        Whether a call may go to the network right now
+        '''
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            # Let one probe through and hold everyone else for another window
+            self.state = self.HALF_OPEN
+            self.opened_at = time.monotonic()
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if (
+                self.state == self.HALF_OPEN
+                or self.failures >= self.failure_threshold
+            ):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class PaymentMetrics:
+    '''
+    In-process counters for the payment gateway
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {
+            "calls": 0, "succeeded": 0, "declined": 0, "unavailable": 0,
+            "rejected_open": 0, "queue_timeouts": 0
+        }
+        self.in_flight = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def observe_wait(self, seconds):
+        with self.lock:
+            self.queue_wait_total += seconds
+            self.queue_wait_max = max(self.queue_wait_max, seconds)
+
+    def snapshot(self):
+        with self.lock:
+            waited = self.counts["calls"] + self.counts["queue_timeouts"]
+            return {
+                **self.counts,
+                "in_flight": self.in_flight,
+                "queue_wait_avg": (
+                    self.queue_wait_total / waited if waited else 0.0
+                ),
+                "queue_wait_max": self.queue_wait_max,
+            }
+
+
+class PaymentGateway:
+    '''
+    Bounds how much of the web worker pool payments can tie up
+
+    At most `concurrency` calls reach the provider at once, a caller waits
+    at most `queue_timeout` seconds for a slot, the whole call is held to
+    `deadline` seconds, and the circuit breaker fails fast while the
+    network is down.
+    '''
+    def __init__(self, provider, concurrency, deadline, queue_timeout,
+                 breaker):
+        self.provider = provider
+        self.deadline = deadline
+        self.queue_timeout = queue_timeout
+        self.breaker = breaker
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.metrics = PaymentMetrics()
+
+    def make_payment(self, card, cvc, amount):
+        '''
+        Make a payment through the provider within the gateway's limits
+        '''
+        if not self.breaker.allow():
+            self.metrics.count("rejected_open")
+            raise PaymentUnavailable(
+                "Payments are temporarily unavailable, try again shortly"
+            )
+
+        started = time.monotonic()
+        acquired = self.slots.acquire(
+            timeout=min(self.queue_timeout, self.deadline)
+        )
+        waited = time.monotonic() - started
+        self.metrics.observe_wait(waited)
+        if acquired and waited >= self.deadline:
+            # The wait used up the whole deadline, the network isn't to blame
+            self.slots.release()
+            acquired = False
+        if not acquired:
+            self.metrics.count("queue_timeouts")
+            raise PaymentUnavailable("Payments are busy, try again shortly")
+
+        self.metrics.count("calls")
+        with self.metrics.lock:
+            self.metrics.in_flight += 1
+        try:
+            paid = self.provider.make_payment(
+                card, cvc, amount, timeout=self.deadline - waited
+            )
+        except PaymentUnavailable:
+            self.breaker.record_failure()
+            self.metrics.count("unavailable")
+            raise
+        except (PaymentError, ValueError):
+            # A decline means the network is answering
+            self.breaker.record_success()
+            self.metrics.count("declined")
+            raise
+        finally:
+            with self.metrics.lock:
+                self.metrics.in_flight -= 1
+            self.slots.release()
+
+        self.breaker.record_success()
+        self.metrics.count("succeeded")
+        return paid
+
+    def snapshot(self):
+        '''
+        Metrics plus breaker state, for /metrics/payments
+        '''
+        return {**self.metrics.snapshot(), "breaker": self.breaker.state}
+
+
+if app.config.get('CARD_NETWORK_URL'):
+    demo_card_network = RemoteCardNetwork(
+        app.config['CARD_NETWORK_URL'],
+        pool_size=app.config['CARD_NETWORK_POOL_SIZE'],
+        timeout=app.config['CARD_NETWORK_TIMEOUT']
+    )
+else:
+    demo_card_network = CardNetwork()
 demo_payment_provider = PaymentProvider(demo_card_network)
+payment_gateway = PaymentGateway(
+    demo_payment_provider,
+    concurrency=app.config['PAYMENT_CONCURRENCY'],
+    deadline=app.config['PAYMENT_DEADLINE'],
+    queue_timeout=app.config['PAYMENT_QUEUE_TIMEOUT'],
+    breaker=CircuitBreaker(
+        failure_threshold=app.config['BREAKER_FAILURE_THRESHOLD'],
+        reset_timeout=app.config['BREAKER_RESET_TIMEOUT']
+    )
+)
@@ -1,7 +1,18 @@
-from flask import redirect, render_template, url_for
+from flask import jsonify, redirect, render_template, url_for
 from flask_login import current_user
 
 from app import app
+from app.payment import payment_gateway
+from app.utils.assets import asset_url, send_asset
+from app.utils.code_filter import bill_codes, group_codes
+from app.utils.decorators import metrics_access_required
+from app.utils.money import format_cents, tax_cents, total_cents
+from app.utils.profiler import profiler
+
+app.add_template_global(asset_url)
+app.add_template_global(tax_cents)
+app.add_template_global(total_cents)
+app.add_template_filter(format_cents, 'money')
 
 
 @app.route('/')
@@ -17,3 +28,41 @@ def index():
             return redirect(url_for('customer.dashboard'))
 
     return render_template('index.html', title='Home')
+
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    '''
+    Fingerprinted static assets with far-future caching
+    '''
+    return send_asset(filename)
+
+
+@app.route('/metrics/payments')
+@metrics_access_required
+def payment_metrics():
+    '''
+    Payment gateway queue wait, outcomes and circuit breaker state
+    '''
+    return jsonify(payment_gateway.snapshot())
+
+
+@app.route('/metrics/profiler')
+@metrics_access_required
+def profiler_metrics():
+    '''
+    Request profiler counts and remaining overhead budget
+    '''
+    return jsonify(profiler.snapshot())
+
+
+@app.route('/metrics/codes')
+@metrics_access_required
+def code_metrics():
+    '''
+    Code lookups turned away in memory by this worker, and filter sizes
+    '''
+    return jsonify({
+        'bills': bill_codes.snapshot(),
+        'groups': group_codes.snapshot(),
+    })
@@ -0,0 +1,18 @@
+'''
+storage backends
+
+`store` holds one repository per collection (users, groups, bills,
+directory, menu, cards, payments, revenue). STORAGE_BACKEND picks MongoDB
+(the default) or the in-memory backend, see app/storage/base.py for the
+interface. Repeat reads within a request are answered from an identity
+map, see app/storage/identity.py.
+'''
+from app import app
+from app.storage.identity import map_identities
+
+if app.config['STORAGE_BACKEND'] == 'memory':
+    from app.storage.memory import MemoryStore as Store
+else:
+    from app.storage.mongo import MongoStore as Store
+
+store = map_identities(Store())
@@ -0,0 +1,348 @@
+'''
+repository interfaces
+
+Views talk to storage through these instead of `mongo.db`, so the same
+code runs against MongoDB or the in-memory backend. Ids are passed as
+strings or ObjectIds, bill lookups take a shard key from
+app/utils/directory.py, and reads return the model class the caller asks
+for (a narrow view such as Member or BillVersion where that is enough).
+Every method is atomic on its own, like a single-document Mongo write.
+The interfaces are abstract, so a backend missing a method fails when its
+store is built rather than on the first request that calls it.
+'''
+from abc import ABC, abstractmethod
+
+from app.models import Bill, BillCharge, BillSummary, Group, User
+
+
+class UserRepository(ABC):
+    @abstractmethod
+    def get(self, user_id, model=User):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_many(self, user_ids, model=User):
+        '''
+        Users with the given ids, in no particular order
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def by_email(self, email, model=User):
+        raise NotImplementedError
+
+    @abstractmethod
+    def email_taken(self, email):
+        raise NotImplementedError
+
+    @abstractmethod
+    def username_taken(self, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def create(self, user):
+        '''
+        Insert a user dict, filling in its _id
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_payment_method(self, user_id, payment_method):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_payment_method(self, user_id, token):
+        raise NotImplementedError
+
+
+class GroupRepository(ABC):
+    @abstractmethod
+    def get(self, group_id, model=Group, active_bill_id=None):
+        '''
+        Group by id, optionally only if `active_bill_id` is its bill
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def by_code(self, code, model=Group):
+        raise NotImplementedError
+
+    @abstractmethod
+    def for_member(self, user_id, model=Group):
+        raise NotImplementedError
+
+    @abstractmethod
+    def codes_since(self, since=None):
+        '''
+        Codes of groups created from ObjectId `since` on, or of every group
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def create(self, group):
+        '''
+        Insert a group dict, raising DuplicateKeyError if its code is taken
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_member(self, group_id, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_member(self, group_id, user_id):
+        '''
+        Remove a member, returning the ids of those left
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, group_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def attach_bill(self, group_id, bill_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def detach_bill(self, group_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def detach_bill_everywhere(self, bill_id):
+        '''
+        Clear `bill_id` from every group that has it as its active bill
+        '''
+        raise NotImplementedError
+
+
+class BillRepository(ABC):
+    @abstractmethod
+    def get(self, key, model=Bill):
+        '''
+        Bill by shard key, None if the key is None or matches nothing
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def for_vendor(self, vendor_id, statuses, model=BillSummary):
+        raise NotImplementedError
+
+    @abstractmethod
+    def history(self, vendor_id, fields, start=None, end=None,
+                batch_size=None):
+        '''
+        A vendor's bills created in [start, end) as documents with `fields`,
+        oldest first, read `batch_size` at a time
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def create(self, bill):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_item(self, key, item, amount):
+        '''
+        Append a line item and add `amount` cents to the subtotal of an
+        open bill, returning whether it was
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_item(self, key, item_id, amount):
+        '''
+        Pull a line item and take `amount` cents off the subtotal of an
+        open bill, returning whether it was
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def assign_item(self, key, item_id, user_ids):
+        '''
+        Set an item's assignees on an open bill, returning the bill's
+        contents and version from before the change, or None if the bill
+        isn't open or has no such item
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def assign_items(self, key, assignments):
+        '''
+        Set the assignees of several items of an open bill in one update,
+        `assignments` mapping item ids to user ids. Returns the same as
+        assign_item, or None if the bill isn't open or lacks any of them
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def assign_all(self, key, user_ids):
+        '''
+        Assign every item of an open bill to `user_ids` in one update
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def assign_unassigned(self, key, user_ids):
+        '''
+        Assign the items of an open bill that nobody has yet to `user_ids`
+        in one update
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def for_payer(self, key, user_id, model=BillCharge):
+        '''
+        Unsettled bill that `user_id` is one of the members of, or None
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_members(self, key, user_ids):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_member(self, key, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def pay(self, key, user_id, amount, completed_at):
+        '''
+        Add a member's payment to an unsettled bill, marking it settled if
+        that covers the total and settling otherwise, as one conditional
+        update. Returns the bill's status and paid after, or None if the
+        bill was closed or the payer isn't a member
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def unpay(self, key, user_id, amount):
+        '''
+        Take back a payment added with `pay` whose charge then failed,
+        putting the bill back to settling or open if that leaves it short.
+        Returns the bill's status and paid after, or None
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def void(self, key, voided_at):
+        '''
+        Void an open bill with nothing paid, returning whether it was
+        '''
+        raise NotImplementedError
+
+
+class DirectoryRepository(ABC):
+    '''
+    bill id -> vendor id and session code, see app/utils/directory.py
+    '''
+    @abstractmethod
+    def register(self, bill_id, vendor_id, session_code):
+        '''
+        Raises DuplicateKeyError if the session code is taken
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, bill_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def by_code(self, session_code):
+        raise NotImplementedError
+
+    @abstractmethod
+    def codes_since(self, since=None):
+        '''
+        Session codes still held by bills opened from ObjectId `since` on,
+        or by every bill
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_code(self, bill_id):
+        '''
+        Drop a closed bill's session code so it can be handed out again,
+        keeping the entry for lookups by id
+        '''
+        raise NotImplementedError
+
+
+class MenuRepository(ABC):
+    @abstractmethod
+    def for_vendor(self, vendor_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def count(self, vendor_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, vendor_id, item_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def search(self, vendor_id, words=(), prefix=None, category=None,
+               skip=0, limit=20):
+        '''
+        One page of a vendor's menu matching any of `words` in the name or
+        description, best match first, and with a name or description word
+        starting with `prefix`. With neither, the whole menu by name.
+        Returns {'items', 'total', 'categories'}, where categories counts
+        the matches in every category so the category filter can show them.
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def create(self, item):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, vendor_id, item_id):
+        raise NotImplementedError
+
+
+class CardRepository(ABC):
+    @abstractmethod
+    def create(self, card):
+        '''
+        Raises DuplicateKeyError if the token is taken
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, token):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, token):
+        raise NotImplementedError
+
+
+class PaymentRepository(ABC):
+    @abstractmethod
+    def create(self, payment):
+        raise NotImplementedError
+
+    @abstractmethod
+    def for_bill(self, bill_id):
+        '''
+        Payments on a bill, oldest first
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def for_user(self, user_id, limit):
+        '''
+        A user's most recent payments, newest first
+        '''
+        raise NotImplementedError
+
+
+class RevenueRepository(ABC):
+    @abstractmethod
+    def get(self, rollup_id):
+        '''
+        A vendor's rolled-up revenue for one day, see app/utils/rollups.py
+        '''
+        raise NotImplementedError
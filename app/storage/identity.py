@@ -0,0 +1,161 @@
+'''
+request-scoped identity map
+
+Within a request the same user, group, bill or directory entry is often
+looked up more than once: once to check access and again to act on it.
+`store`'s users, groups, bills and directory repositories are wrapped so
+that a `get` is answered from the documents already read in this request
+when one of them has the fields asked for, and goes to the backend
+otherwise. A model read with more fields serves reads of its narrower
+views (a Bill serves a BillVersion), not the other way round.
+
+Any other method is passed through, and unless it is listed as a read it
+is taken to be a write and drops everything cached from its collection
+for the rest of the request, so a read after a write always sees it.
+
+There is deliberately no unit of work holding writes back for the end of
+the request. Each write is a conditional atomic update, filtered on the
+bill's status, a membership or a version, and the view acts on whether
+it matched before it answers (a 409, a flash, a charge or not), so none
+of them can wait. Nor is there anything to coalesce: apart from a failed
+charge being taken back off the bill, no request writes the same document
+twice.
+
+The map lives on `flask.g` and only inside a request. Lookups run on
+fan-out threads (app/utils/fanout.py) or from CLI commands go straight to
+the backend.
+'''
+from flask import g, has_request_context
+
+from app.models import Bill, Group, User
+
+
+class IdentityMap:
+    '''
+    Documents read in this request, by collection and id, with the model
+    fields each was read with (None for a whole raw document)
+    '''
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, collection, doc_id, model=None):
+        entry = self.entries.get((collection, str(doc_id)))
+        if entry:
+            entity, fields = entry
+            if fields is None or set(model.fields) <= fields:
+                return entity
+        return None
+
+    def put(self, collection, doc_id, entity, model=None):
+        fields = set(model.fields) if model else None
+        self.entries[(collection, str(doc_id))] = (entity, fields)
+
+    def forget(self, collection):
+        self.entries = {
+            key: entry for key, entry in self.entries.items()
+            if key[0] != collection
+        }
+
+
+def identity_map():
+    '''
+    This request's identity map, None outside a request
+    '''
+    if not has_request_context():
+        return None
+    if 'identity_map' not in g:
+        g.identity_map = IdentityMap()
+    return g.identity_map
+
+
+class MappedRepository:
+    '''
+    Wraps a repository so its `get`s go through the identity map
+    '''
+    collection = None
+    # Methods that don't write, everything else drops the collection
+    reads = ()
+
+    def __init__(self, repository):
+        self.repository = repository
+
+    def __getattr__(self, name):
+        method = getattr(self.repository, name)
+        if name in self.reads or not callable(method):
+            return method
+
+        def write(*args, **kwargs):
+            identities = identity_map()
+            if identities:
+                identities.forget(self.collection)
+            return method(*args, **kwargs)
+        return write
+
+    def _get(self, doc_id, model, load):
+        identities = identity_map()
+        if identities is None:
+            return load()
+        entity = identities.get(self.collection, doc_id, model)
+        if entity is None:
+            entity = load()
+            if entity is not None:
+                identities.put(self.collection, doc_id, entity, model)
+        return entity
+
+
+class MappedUserRepository(MappedRepository):
+    collection = 'users'
+    reads = ('get_many', 'by_email', 'email_taken', 'username_taken')
+
+    def get(self, user_id, model=User):
+        return self._get(
+            user_id, model, lambda: self.repository.get(user_id, model)
+        )
+
+
+class MappedGroupRepository(MappedRepository):
+    collection = 'groups'
+    reads = ('by_code', 'for_member', 'codes_since')
+
+    def get(self, group_id, model=Group, active_bill_id=None):
+        group = self._get(
+            group_id, model, lambda: self.repository.get(group_id, model)
+        )
+        if group and active_bill_id and (
+            group.active_bill_id != str(active_bill_id)
+        ):
+            return None
+        return group
+
+
+class MappedBillRepository(MappedRepository):
+    collection = 'bills'
+    reads = ('for_vendor', 'history', 'for_payer')
+
+    def get(self, key, model=Bill):
+        if key is None:
+            return None
+        return self._get(
+            key['_id'], model, lambda: self.repository.get(key, model)
+        )
+
+
+class MappedDirectoryRepository(MappedRepository):
+    collection = 'bill_directory'
+    reads = ('by_code', 'codes_since')
+
+    def get(self, bill_id):
+        return self._get(
+            bill_id, None, lambda: self.repository.get(bill_id)
+        )
+
+
+def map_identities(store):
+    '''
+    Put the identity map in front of `store`'s document repositories
+    '''
+    store.users = MappedUserRepository(store.users)
+    store.groups = MappedGroupRepository(store.groups)
+    store.bills = MappedBillRepository(store.bills)
+    store.directory = MappedDirectoryRepository(store.directory)
+    return store
@@ -0,0 +1,33 @@
+'''
+MongoDB-only jobs
+
+The maintenance and aggregation jobs (sweeps, rollups, reconciliation,
+ledger rebuilds, migrations, sharding, seeding) work on `mongo.db`
+directly rather than through `store`. `mongo_only` makes them refuse to
+run under the in-memory backend instead of reaching for a MongoDB that
+isn't there.
+'''
+from functools import wraps
+
+import click
+
+from app import app
+
+
+class MongoOnly(click.ClickException):
+    '''
+    A MongoDB job run with STORAGE_BACKEND=memory
+
+    A ClickException, so the CLI reports it as an error message.
+    '''
+
+
+def mongo_only(job):
+    @wraps(job)
+    def run(*args, **kwargs):
+        if app.config['STORAGE_BACKEND'] == 'memory':
+            raise MongoOnly(
+                f"{job.__name__} needs MongoDB, unset STORAGE_BACKEND=memory"
+            )
+        return job(*args, **kwargs)
+    return run
@@ -0,0 +1,580 @@
+'''
+in-memory repositories
+
+Same semantics as the MongoDB ones (ObjectId ids, unique codes raising
+DuplicateKeyError, documents copied in and out, each call atomic) without
+a mongod, for profiling the views' own overhead and for large local load
+runs. Everything lives in this process and is gone when it exits. The
+aggregation jobs (exports, rollups, ledger rebuilds) still need MongoDB,
+so the vendor dashboard's "Completed Today" card stays empty here.
+'''
+import re
+import threading
+from collections import Counter, defaultdict
+from copy import deepcopy
+from datetime import datetime
+
+import pytz
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from app.models import Bill, BillCharge, BillSummary, Group, Payment, User
+from app.storage import base
+from app.utils.money import total_cents
+
+
+def _duplicate(field):
+    return DuplicateKeyError(f"duplicate key: {field}", 11000)
+
+
+class MemoryUserRepository(base.UserRepository):
+    def __init__(self, lock):
+        self.lock = lock
+        self.docs = {}
+        self.by_email_index = {}
+        self.usernames = set()
+
+    def get(self, user_id, model=User):
+        with self.lock:
+            doc = self.docs.get(ObjectId(user_id))
+            return model(deepcopy(doc)) if doc else None
+
+    def get_many(self, user_ids, model=User):
+        with self.lock:
+            docs = [self.docs.get(ObjectId(u)) for u in user_ids]
+            return [model(deepcopy(d)) for d in docs if d]
+
+    def by_email(self, email, model=User):
+        with self.lock:
+            user_id = self.by_email_index.get(email)
+            return self.get(user_id, model) if user_id else None
+
+    def email_taken(self, email):
+        return email in self.by_email_index
+
+    def username_taken(self, username):
+        return username in self.usernames
+
+    def create(self, user):
+        with self.lock:
+            user.setdefault('_id', ObjectId())
+            self.docs[user['_id']] = deepcopy(user)
+            self.by_email_index.setdefault(user['email'], user['_id'])
+            self.usernames.add(user['username'])
+
+    def add_payment_method(self, user_id, payment_method):
+        with self.lock:
+            doc = self.docs.get(ObjectId(user_id))
+            if doc:
+                doc.setdefault('payment_methods', []).append(
+                    deepcopy(payment_method)
+                )
+
+    def remove_payment_method(self, user_id, token):
+        with self.lock:
+            doc = self.docs.get(ObjectId(user_id))
+            if doc:
+                doc['payment_methods'] = [
+                    method for method in doc.get('payment_methods', [])
+                    if method.get('token') != token
+                ]
+
+
+class MemoryGroupRepository(base.GroupRepository):
+    def __init__(self, lock):
+        self.lock = lock
+        self.docs = {}
+        self.codes = {}
+        self.by_member = defaultdict(set)
+
+    def _doc(self, group_id):
+        return self.docs.get(ObjectId(group_id))
+
+    def get(self, group_id, model=Group, active_bill_id=None):
+        with self.lock:
+            doc = self._doc(group_id)
+            if not doc:
+                return None
+            if active_bill_id and (
+                doc.get('active_bill_id') != ObjectId(active_bill_id)
+            ):
+                return None
+            return model(deepcopy(doc))
+
+    def by_code(self, code, model=Group):
+        with self.lock:
+            group_id = self.codes.get(code)
+            return self.get(group_id, model) if group_id else None
+
+    def for_member(self, user_id, model=Group):
+        with self.lock:
+            return [
+                model(deepcopy(self.docs[group_id]))
+                for group_id in self.by_member[user_id]
+            ]
+
+    def codes_since(self, since=None):
+        with self.lock:
+            return [
+                code for code, group_id in self.codes.items()
+                if not since or group_id >= since
+            ]
+
+    def create(self, group):
+        with self.lock:
+            if group['code'] in self.codes:
+                raise _duplicate('code')
+            group.setdefault('_id', ObjectId())
+            self.docs[group['_id']] = deepcopy(group)
+            self.codes[group['code']] = group['_id']
+            for user_id in group['members']:
+                self.by_member[user_id].add(group['_id'])
+
+    def add_member(self, group_id, user_id):
+        with self.lock:
+            doc = self._doc(group_id)
+            if doc:
+                doc['members'].append(user_id)
+                doc['last_active_at'] = datetime.now(pytz.utc)
+                doc['version'] = doc.get('version', 0) + 1
+                self.by_member[user_id].add(doc['_id'])
+
+    def remove_member(self, group_id, user_id):
+        with self.lock:
+            doc = self._doc(group_id)
+            if not doc:
+                return []
+            doc['members'] = [m for m in doc['members'] if m != user_id]
+            doc['version'] = doc.get('version', 0) + 1
+            self.by_member[user_id].discard(doc['_id'])
+            return list(doc['members'])
+
+    def delete(self, group_id):
+        with self.lock:
+            doc = self.docs.pop(ObjectId(group_id), None)
+            if doc:
+                self.codes.pop(doc['code'], None)
+                for user_id in doc['members']:
+                    self.by_member[user_id].discard(doc['_id'])
+
+    def _set_bill(self, doc, bill_id):
+        doc['active_bill_id'] = bill_id
+        doc['last_active_at'] = datetime.now(pytz.utc)
+        doc['version'] = doc.get('version', 0) + 1
+
+    def attach_bill(self, group_id, bill_id):
+        with self.lock:
+            doc = self._doc(group_id)
+            if doc:
+                self._set_bill(doc, ObjectId(bill_id))
+
+    def detach_bill(self, group_id):
+        with self.lock:
+            doc = self._doc(group_id)
+            if doc:
+                self._set_bill(doc, None)
+
+    def detach_bill_everywhere(self, bill_id):
+        with self.lock:
+            for doc in self.docs.values():
+                if doc.get('active_bill_id') == ObjectId(bill_id):
+                    self._set_bill(doc, None)
+
+
+def _created_in(doc, start, end):
+    created_at = doc.get('created_at')
+    if created_at is None:
+        return not (start or end)
+    return (not start or created_at >= start) and (
+        not end or created_at < end
+    )
+
+
+class MemoryBillRepository(base.BillRepository):
+    def __init__(self, lock):
+        self.lock = lock
+        self.docs = {}
+        self.by_vendor = defaultdict(set)
+
+    def _doc(self, key):
+        if key is None:
+            return None
+        doc = self.docs.get(key['_id'])
+        if doc and doc['vendor_id'] == key['vendor_id']:
+            return doc
+        return None
+
+    def get(self, key, model=Bill):
+        with self.lock:
+            doc = self._doc(key)
+            return model(deepcopy(doc)) if doc else None
+
+    def for_vendor(self, vendor_id, statuses, model=BillSummary):
+        with self.lock:
+            return [
+                model(deepcopy(self.docs[bill_id]))
+                for bill_id in self.by_vendor[vendor_id]
+                if self.docs[bill_id]['status'] in statuses
+            ]
+
+    def history(self, vendor_id, fields, start=None, end=None,
+                batch_size=None):
+        with self.lock:
+            docs = [
+                doc for doc in map(self.docs.get, self.by_vendor[vendor_id])
+                if _created_in(doc, start, end)
+            ]
+            docs.sort(key=lambda doc: (
+                doc.get('created_at') is not None,
+                doc.get('created_at') or 0
+            ))
+            return [
+                {'_id': doc['_id'], **{
+                    name: deepcopy(doc[name]) for name in fields if name in doc
+                }}
+                for doc in docs
+            ]
+
+    def create(self, bill):
+        with self.lock:
+            bill.setdefault('_id', ObjectId())
+            self.docs[bill['_id']] = deepcopy(bill)
+            self.by_vendor[bill['vendor_id']].add(bill['_id'])
+
+    def _open(self, key):
+        doc = self._doc(key)
+        return doc if doc and doc['status'] == Bill.OPEN else None
+
+    def add_item(self, key, item, amount):
+        with self.lock:
+            doc = self._open(key)
+            if not doc:
+                return False
+            doc['contents'].append(deepcopy(item))
+            doc['subtotal'] += amount
+            doc['needs_reconcile'] = True
+            doc['version'] = doc.get('version', 0) + 1
+            return True
+
+    def remove_item(self, key, item_id, amount):
+        with self.lock:
+            doc = self._open(key)
+            if not doc:
+                return False
+            doc['contents'] = [
+                item for item in doc['contents'] if item['_id'] != item_id
+            ]
+            doc['subtotal'] -= amount
+            doc['needs_reconcile'] = True
+            doc['version'] = doc.get('version', 0) + 1
+            return True
+
+    def assign_item(self, key, item_id, user_ids):
+        with self.lock:
+            doc = self._open(key)
+            item = doc and next(
+                (item for item in doc['contents'] if item['_id'] == item_id),
+                None
+            )
+            if not item:
+                return None
+            before = deepcopy({
+                '_id': doc['_id'],
+                'contents': doc['contents'],
+                'version': doc.get('version', 0)
+            })
+            item['assigned_to'] = list(user_ids)
+            doc['version'] = doc.get('version', 0) + 1
+            return before
+
+    def _assign(self, key, assignments):
+        with self.lock:
+            doc = self._open(key)
+            if not doc:
+                return None
+            assignments = assignments(doc['contents'])
+            if assignments is None:
+                return None
+            before = deepcopy({
+                '_id': doc['_id'],
+                'contents': doc['contents'],
+                'version': doc.get('version', 0)
+            })
+            for item in doc['contents']:
+                if item['_id'] in assignments:
+                    item['assigned_to'] = list(assignments[item['_id']])
+            doc['version'] = doc.get('version', 0) + 1
+            return before
+
+    def assign_items(self, key, assignments):
+        def matrix(contents):
+            item_ids = {item['_id'] for item in contents}
+            if not assignments or not item_ids.issuperset(assignments):
+                return None
+            return assignments
+        return self._assign(key, matrix)
+
+    def assign_all(self, key, user_ids):
+        return self._assign(key, lambda contents: {
+            item['_id']: user_ids for item in contents
+        })
+
+    def assign_unassigned(self, key, user_ids):
+        return self._assign(key, lambda contents: {
+            item['_id']: user_ids for item in contents
+            if not item.get('assigned_to')
+        })
+
+    def _payable(self, key, user_id):
+        doc = self._doc(key)
+        if (
+            doc and doc['status'] in Bill.UNSETTLED
+            and user_id in doc.get('members', [])
+        ):
+            return doc
+        return None
+
+    def for_payer(self, key, user_id, model=BillCharge):
+        with self.lock:
+            doc = self._payable(key, user_id)
+            return model(deepcopy(doc)) if doc else None
+
+    def add_members(self, key, user_ids):
+        with self.lock:
+            doc = self._doc(key)
+            if doc:
+                members = doc.setdefault('members', [])
+                members.extend(u for u in user_ids if u not in members)
+                doc['version'] = doc.get('version', 0) + 1
+
+    def remove_member(self, key, user_id):
+        with self.lock:
+            doc = self._doc(key)
+            if doc:
+                doc['members'] = [
+                    u for u in doc.get('members', []) if u != user_id
+                ]
+                doc['version'] = doc.get('version', 0) + 1
+
+    def pay(self, key, user_id, amount, completed_at):
+        with self.lock:
+            doc = self._payable(key, user_id)
+            if not doc:
+                return None
+            doc['paid'] += amount
+            if doc['paid'] >= total_cents(doc['subtotal']):
+                doc['status'] = Bill.SETTLED
+                doc['completed_at'] = completed_at
+            else:
+                doc['status'] = Bill.SETTLING
+            doc['version'] = doc.get('version', 0) + 1
+            return {
+                '_id': doc['_id'],
+                'status': doc['status'],
+                'paid': doc['paid']
+            }
+
+    def unpay(self, key, user_id, amount):
+        with self.lock:
+            doc = self._doc(key)
+            if (
+                not doc or user_id not in doc.get('members', [])
+                or doc['paid'] < amount
+            ):
+                return None
+            doc['paid'] -= amount
+            if doc['paid'] < total_cents(doc['subtotal']):
+                doc['status'] = Bill.SETTLING if doc['paid'] else Bill.OPEN
+                doc['completed_at'] = None
+            doc['version'] = doc.get('version', 0) + 1
+            return {
+                '_id': doc['_id'],
+                'status': doc['status'],
+                'paid': doc['paid']
+            }
+
+    def void(self, key, voided_at):
+        with self.lock:
+            doc = self._open(key)
+            if not doc or doc['paid'] != 0:
+                return False
+            doc['status'] = Bill.VOIDED
+            doc['voided_at'] = voided_at
+            doc['version'] = doc.get('version', 0) + 1
+            return True
+
+
+class MemoryDirectoryRepository(base.DirectoryRepository):
+    def __init__(self, lock):
+        self.lock = lock
+        self.docs = {}
+        self.codes = {}
+
+    def register(self, bill_id, vendor_id, session_code):
+        with self.lock:
+            if session_code in self.codes or bill_id in self.docs:
+                raise _duplicate('session_code')
+            self.docs[bill_id] = {
+                '_id': bill_id,
+                'vendor_id': vendor_id,
+                'session_code': session_code
+            }
+            self.codes[session_code] = bill_id
+
+    def get(self, bill_id):
+        entry = self.docs.get(ObjectId(bill_id))
+        return dict(entry) if entry else None
+
+    def by_code(self, session_code):
+        bill_id = self.codes.get(session_code)
+        return self.get(bill_id) if bill_id else None
+
+    def codes_since(self, since=None):
+        with self.lock:
+            return [
+                code for code, bill_id in self.codes.items()
+                if not since or bill_id >= since
+            ]
+
+    def release_code(self, bill_id):
+        with self.lock:
+            entry = self.docs.get(ObjectId(bill_id))
+            if entry and 'session_code' in entry:
+                self.codes.pop(entry.pop('session_code'), None)
+
+
+class MemoryMenuRepository(base.MenuRepository):
+    def __init__(self, lock):
+        self.lock = lock
+        self.by_vendor = defaultdict(dict)
+
+    def for_vendor(self, vendor_id):
+        with self.lock:
+            return deepcopy(list(self.by_vendor[vendor_id].values()))
+
+    def count(self, vendor_id):
+        return len(self.by_vendor[vendor_id])
+
+    def get(self, vendor_id, item_id):
+        with self.lock:
+            item = self.by_vendor[vendor_id].get(ObjectId(item_id))
+            return deepcopy(item)
+
+    def search(self, vendor_id, words=(), prefix=None, category=None,
+               skip=0, limit=20):
+        words = {word.lower() for word in words}
+        prefix = prefix.lower() if prefix else None
+        with self.lock:
+            items = list(self.by_vendor[vendor_id].values())
+        matches = []
+        for item in items:
+            name = re.findall(r'\w+', item['name'].lower())
+            description = re.findall(
+                r'\w+', item.get('description', '').lower()
+            )
+            # Name words count for more, like the weights on the text index
+            score = (
+                3 * len(words.intersection(name))
+                + len(words.intersection(description))
+            )
+            if words and not score:
+                continue
+            if prefix and not any(
+                word.startswith(prefix) for word in name + description
+            ):
+                continue
+            matches.append((-score, item['name'], item))
+        categories = Counter(item['category'] for _, _, item in matches)
+        if category:
+            matches = [
+                match for match in matches if match[2]['category'] == category
+            ]
+        matches.sort(key=lambda match: match[:2])
+        page = matches[skip:skip + limit]
+        return {
+            'items': deepcopy([item for _, _, item in page]),
+            'total': len(matches),
+            'categories': [
+                {'name': name, 'count': count}
+                for name, count in sorted(categories.items())
+            ],
+        }
+
+    def create(self, item):
+        with self.lock:
+            item.setdefault('_id', ObjectId())
+            self.by_vendor[item['vendor_id']][item['_id']] = deepcopy(item)
+
+    def delete(self, vendor_id, item_id):
+        with self.lock:
+            self.by_vendor[vendor_id].pop(ObjectId(item_id), None)
+
+
+class MemoryCardRepository(base.CardRepository):
+    def __init__(self, lock):
+        self.lock = lock
+        self.docs = {}
+
+    def create(self, card):
+        with self.lock:
+            if card['token'] in self.docs:
+                raise _duplicate('token')
+            card.setdefault('_id', ObjectId())
+            self.docs[card['token']] = deepcopy(card)
+
+    def get(self, token):
+        with self.lock:
+            return deepcopy(self.docs.get(token))
+
+    def delete(self, token):
+        with self.lock:
+            self.docs.pop(token, None)
+
+
+class MemoryPaymentRepository(base.PaymentRepository):
+    def __init__(self, lock):
+        self.lock = lock
+        self.by_bill = defaultdict(list)
+        self.by_user = defaultdict(list)
+
+    def create(self, payment):
+        with self.lock:
+            payment.setdefault('_id', ObjectId())
+            self.by_bill[payment['bill_id']].append(deepcopy(payment))
+            self.by_user[payment['user_id']].append(deepcopy(payment))
+
+    def for_bill(self, bill_id):
+        with self.lock:
+            payments = sorted(
+                self.by_bill[ObjectId(bill_id)],
+                key=lambda p: p['completed_at']
+            )
+            return [Payment(deepcopy(p)) for p in payments]
+
+    def for_user(self, user_id, limit):
+        with self.lock:
+            payments = sorted(
+                self.by_user[user_id],
+                key=lambda p: p['completed_at'], reverse=True
+            )[:limit]
+            return [Payment(deepcopy(p)) for p in payments]
+
+
+class MemoryRevenueRepository(base.RevenueRepository):
+    def get(self, rollup_id):
+        # Rollups are a MongoDB aggregation job, nothing fills these here
+        return None
+
+
+class MemoryStore:
+    def __init__(self):
+        # One lock, so a call is atomic across the indexes it touches
+        lock = threading.RLock()
+        self.users = MemoryUserRepository(lock)
+        self.groups = MemoryGroupRepository(lock)
+        self.bills = MemoryBillRepository(lock)
+        self.directory = MemoryDirectoryRepository(lock)
+        self.menu = MemoryMenuRepository(lock)
+        self.cards = MemoryCardRepository(lock)
+        self.payments = MemoryPaymentRepository(lock)
+        self.revenue = MemoryRevenueRepository()
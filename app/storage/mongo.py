@@ -0,0 +1,519 @@
+'''
+MongoDB repositories
+
+Reads project down to the fields of the model asked for, and bill and
+menu queries always carry vendor_id so they stay on one shard.
+'''
+import re
+from datetime import datetime
+
+import pytz
+from bson import ObjectId
+from pymongo import DESCENDING, ReturnDocument
+
+from app import mongo
+from app.models import Bill, BillCharge, BillSummary, Group, Payment, User
+from app.storage import base
+from app.utils.money import total_expr
+
+SHARD_KEYS = {
+    'bills': {'vendor_id': 1, '_id': 1},
+    'menu_items': {'vendor_id': 1, '_id': 1},
+    'groups': {'_id': 'hashed'},
+}
+
+_indexes_ready = False
+
+
+def ensure_indexes():
+    '''
+    Unique codes and tokens, shard keys, open-bill, reconcile, bill export,
+    revenue rollup, menu search and payment history indexes, once per
+    process
+    '''
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    mongo.db.groups.create_index([("active_bill_id", 1)])
+    # Groups without a bill by last activity, for the sweeper
+    mongo.db.groups.create_index(
+        [("active_bill_id", 1), ("last_active_at", 1)]
+    )
+    mongo.db.cards.create_index([("token", 1)], unique=True)
+    # Closed bills give their codes back, so only open ones are indexed
+    mongo.db.bill_directory.create_index(
+        [("session_code", 1)], unique=True,
+        partialFilterExpression={'session_code': {'$type': 'string'}}
+    )
+    # The dashboard's open bills, however much history a vendor has
+    mongo.db.bills.create_index(
+        [("vendor_id", 1), ("status", 1)],
+        partialFilterExpression={'status': {'$in': list(Bill.UNSETTLED)}}
+    )
+    # Open bills by age, for the sweeper in app/utils/lifecycle.py
+    mongo.db.bills.create_index(
+        [("status", 1), ("created_at", 1)],
+        partialFilterExpression={'status': {'$in': list(Bill.UNSETTLED)}}
+    )
+    # Bills whose contents changed since reconcile_subtotals last ran
+    mongo.db.bills.create_index(
+        [("needs_reconcile", 1)],
+        partialFilterExpression={'needs_reconcile': True}
+    )
+    # A vendor's bill history by date, for exports
+    mongo.db.bills.create_index([("vendor_id", 1), ("created_at", 1)])
+    # Bills completed since the last revenue rollup
+    mongo.db.bills.create_index([("status", 1), ("completed_at", 1)])
+    for collection, key in SHARD_KEYS.items():
+        # Unique so $merge can match on the full shard key
+        mongo.db[collection].create_index(
+            list(key.items()), unique='hashed' not in key.values()
+        )
+    # Menu search, text queries always carry vendor_id for the prefix
+    mongo.db.menu_items.create_index(
+        [("vendor_id", 1), ("name", "text"), ("description", "text")],
+        weights={'name': 3}, name='menu_search'
+    )
+    mongo.db.menu_items.create_index(
+        [("vendor_id", 1), ("category", 1), ("name", 1)]
+    )
+    mongo.db.payments.create_index([("bill_id", 1), ("completed_at", 1)])
+    mongo.db.payments.create_index(
+        [("user_id", 1), ("completed_at", DESCENDING)]
+    )
+    _indexes_ready = True
+
+
+class MongoUserRepository(base.UserRepository):
+    def get(self, user_id, model=User):
+        return model.find_one({'_id': ObjectId(user_id)})
+
+    def get_many(self, user_ids, model=User):
+        return model.find({'_id': {'$in': [ObjectId(u) for u in user_ids]}})
+
+    def by_email(self, email, model=User):
+        return model.find_one({'email': email})
+
+    def email_taken(self, email):
+        return mongo.db.users.find_one({'email': email}, {'_id': 1}) is not None
+
+    def username_taken(self, username):
+        return mongo.db.users.find_one(
+            {'username': username}, {'_id': 1}
+        ) is not None
+
+    def create(self, user):
+        mongo.db.users.insert_one(user)
+
+    def add_payment_method(self, user_id, payment_method):
+        mongo.db.users.update_one(
+            {'_id': ObjectId(user_id)},
+            {'$push': {'payment_methods': payment_method}}
+        )
+
+    def remove_payment_method(self, user_id, token):
+        mongo.db.users.update_one(
+            {'_id': ObjectId(user_id)},
+            {'$pull': {'payment_methods': {'token': token}}}
+        )
+
+
+class MongoGroupRepository(base.GroupRepository):
+    def get(self, group_id, model=Group, active_bill_id=None):
+        query = {'_id': ObjectId(group_id)}
+        if active_bill_id:
+            query['active_bill_id'] = ObjectId(active_bill_id)
+        return model.find_one(query)
+
+    def by_code(self, code, model=Group):
+        entry = mongo.db.group_codes.find_one({'_id': code})
+        return model.find_one({'_id': entry['group_id']}) if entry else None
+
+    def for_member(self, user_id, model=Group):
+        return model.find({'members': user_id})
+
+    def codes_since(self, since=None):
+        query = {'_id': {'$gte': since}} if since else {}
+        return [
+            group['code']
+            for group in mongo.db.groups.find(query, {'_id': 0, 'code': 1})
+        ]
+
+    def create(self, group):
+        # Codes are claimed in the unsharded group_codes, keyed on the code,
+        # since groups is sharded on its _id
+        group.setdefault('_id', ObjectId())
+        mongo.db.group_codes.insert_one(
+            {'_id': group['code'], 'group_id': group['_id']}
+        )
+        mongo.db.groups.insert_one(group)
+
+    def add_member(self, group_id, user_id):
+        mongo.db.groups.update_one(
+            {'_id': ObjectId(group_id)},
+            {
+                '$push': {'members': user_id},
+                '$set': {'last_active_at': datetime.now(pytz.utc)},
+                '$inc': {'version': 1}
+            }
+        )
+
+    def remove_member(self, group_id, user_id):
+        group = mongo.db.groups.find_one_and_update(
+            {'_id': ObjectId(group_id)},
+            {'$pull': {'members': user_id}, '$inc': {'version': 1}},
+            projection={'members': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        return group['members'] if group else []
+
+    def delete(self, group_id):
+        group = mongo.db.groups.find_one_and_delete(
+            {'_id': ObjectId(group_id)}, projection={'code': 1}
+        )
+        if group:
+            mongo.db.group_codes.delete_one({'_id': group['code']})
+
+    def attach_bill(self, group_id, bill_id):
+        mongo.db.groups.update_one(
+            {'_id': ObjectId(group_id)},
+            {
+                '$set': {
+                    'active_bill_id': ObjectId(bill_id),
+                    'last_active_at': datetime.now(pytz.utc)
+                },
+                '$inc': {'version': 1}
+            }
+        )
+
+    def detach_bill(self, group_id):
+        mongo.db.groups.update_one(
+            {'_id': ObjectId(group_id)},
+            {
+                '$set': {
+                    'active_bill_id': None,
+                    'last_active_at': datetime.now(pytz.utc)
+                },
+                '$inc': {'version': 1}
+            }
+        )
+
+    def detach_bill_everywhere(self, bill_id):
+        # Groups aren't keyed by bill, so this one goes to every shard
+        mongo.db.groups.update_many(
+            {'active_bill_id': ObjectId(bill_id)},
+            {
+                '$set': {
+                    'active_bill_id': None,
+                    'last_active_at': datetime.now(pytz.utc)
+                },
+                '$inc': {'version': 1}
+            }
+        )
+
+
+class MongoBillRepository(base.BillRepository):
+    def get(self, key, model=Bill):
+        return model.find_one(key)
+
+    def for_vendor(self, vendor_id, statuses, model=BillSummary):
+        return model.find(
+            {'vendor_id': vendor_id, 'status': {'$in': list(statuses)}}
+        )
+
+    def history(self, vendor_id, fields, start=None, end=None,
+                batch_size=None):
+        ensure_indexes()
+        query = {'vendor_id': vendor_id}
+        created_at = {}
+        if start:
+            created_at['$gte'] = start
+        if end:
+            created_at['$lt'] = end
+        if created_at:
+            query['created_at'] = created_at
+
+        cursor = mongo.db.bills.find(query, dict.fromkeys(fields, 1))
+        cursor = cursor.sort('created_at', 1)
+        return cursor.batch_size(batch_size) if batch_size else cursor
+
+    def create(self, bill):
+        mongo.db.bills.insert_one(bill)
+
+    def add_item(self, key, item, amount):
+        return mongo.db.bills.update_one({**key, 'status': Bill.OPEN}, {
+            '$inc': {'subtotal': amount, 'version': 1},
+            '$push': {'contents': item},
+            '$set': {'needs_reconcile': True}
+        }).matched_count == 1
+
+    def remove_item(self, key, item_id, amount):
+        return mongo.db.bills.update_one({**key, 'status': Bill.OPEN}, {
+            '$pull': {'contents': {'_id': item_id}},
+            '$inc': {'subtotal': -amount, 'version': 1},
+            '$set': {'needs_reconcile': True}
+        }).matched_count == 1
+
+    def assign_item(self, key, item_id, user_ids):
+        return mongo.db.bills.find_one_and_update(
+            {**key, 'status': Bill.OPEN, 'contents._id': item_id},
+            {
+                '$set': {'contents.$.assigned_to': user_ids},
+                '$inc': {'version': 1}
+            },
+            projection={'contents': 1, 'version': 1},
+            return_document=ReturnDocument.BEFORE
+        )
+
+    def _assign(self, key, query, assignments, array_filters=None):
+        return mongo.db.bills.find_one_and_update(
+            {**key, 'status': Bill.OPEN, **query},
+            {'$set': assignments, '$inc': {'version': 1}},
+            array_filters=array_filters,
+            projection={'contents': 1, 'version': 1},
+            return_document=ReturnDocument.BEFORE
+        )
+
+    def assign_items(self, key, assignments):
+        if not assignments:
+            return None
+        # One array filter per item, picking it out by id
+        names = {
+            item_id: f'item{n}' for n, item_id in enumerate(assignments)
+        }
+        return self._assign(
+            key, {'contents._id': {'$all': list(assignments)}},
+            {
+                f'contents.$[{names[item_id]}].assigned_to': user_ids
+                for item_id, user_ids in assignments.items()
+            },
+            [{f'{name}._id': item_id} for item_id, name in names.items()]
+        )
+
+    def assign_all(self, key, user_ids):
+        return self._assign(
+            key, {}, {'contents.$[].assigned_to': user_ids}
+        )
+
+    def assign_unassigned(self, key, user_ids):
+        return self._assign(
+            key, {}, {'contents.$[free].assigned_to': user_ids},
+            [{'free.assigned_to': {'$in': [None, []]}}]
+        )
+
+    def for_payer(self, key, user_id, model=BillCharge):
+        if key is None:
+            return None
+        return model.find_one({
+            **key, 'members': user_id,
+            'status': {'$in': list(Bill.UNSETTLED)}
+        })
+
+    def add_members(self, key, user_ids):
+        if key is None:
+            return
+        mongo.db.bills.update_one(key, {
+            '$addToSet': {'members': {'$each': list(user_ids)}},
+            '$inc': {'version': 1}
+        })
+
+    def remove_member(self, key, user_id):
+        if key is None:
+            return
+        mongo.db.bills.update_one(key, {
+            '$pull': {'members': user_id}, '$inc': {'version': 1}
+        })
+
+    def pay(self, key, user_id, amount, completed_at):
+        # Every expression sees the bill from before the update
+        paid = {'$add': ['$paid', amount]}
+        covered = {'$gte': [paid, total_expr('$subtotal')]}
+        return mongo.db.bills.find_one_and_update(
+            {
+                **key, 'members': user_id,
+                'status': {'$in': list(Bill.UNSETTLED)}
+            },
+            [{'$set': {
+                'paid': paid,
+                'status': {'$cond': [covered, Bill.SETTLED, Bill.SETTLING]},
+                'completed_at': {
+                    '$cond': [covered, completed_at, '$completed_at']
+                },
+                'version': {'$add': ['$version', 1]},
+            }}],
+            projection={'status': 1, 'paid': 1},
+            return_document=ReturnDocument.AFTER
+        )
+
+    def unpay(self, key, user_id, amount):
+        paid = {'$subtract': ['$paid', amount]}
+        covered = {'$gte': [paid, total_expr('$subtotal')]}
+        return mongo.db.bills.find_one_and_update(
+            {**key, 'members': user_id, 'paid': {'$gte': amount}},
+            [{'$set': {
+                'paid': paid,
+                'status': {'$switch': {
+                    'branches': [
+                        {'case': covered, 'then': '$status'},
+                        {'case': {'$gt': [paid, 0]}, 'then': Bill.SETTLING},
+                    ],
+                    'default': Bill.OPEN,
+                }},
+                'completed_at': {'$cond': [covered, '$completed_at', None]},
+                'version': {'$add': ['$version', 1]},
+            }}],
+            projection={'status': 1, 'paid': 1},
+            return_document=ReturnDocument.AFTER
+        )
+
+    def void(self, key, voided_at):
+        return mongo.db.bills.update_one(
+            {**key, 'status': Bill.OPEN, 'paid': 0},
+            {
+                '$set': {'status': Bill.VOIDED, 'voided_at': voided_at},
+                '$inc': {'version': 1}
+            }
+        ).modified_count == 1
+
+
+class MongoDirectoryRepository(base.DirectoryRepository):
+    def register(self, bill_id, vendor_id, session_code):
+        ensure_indexes()
+        mongo.db.bill_directory.insert_one({
+            '_id': bill_id,
+            'vendor_id': vendor_id,
+            'session_code': session_code
+        })
+
+    def get(self, bill_id):
+        return mongo.db.bill_directory.find_one({'_id': ObjectId(bill_id)})
+
+    def by_code(self, session_code):
+        return mongo.db.bill_directory.find_one(
+            {'session_code': session_code}
+        )
+
+    def codes_since(self, since=None):
+        query = {'session_code': {'$type': 'string'}}
+        if since:
+            query['_id'] = {'$gte': since}
+        return [
+            entry['session_code'] for entry in mongo.db.bill_directory.find(
+                query, {'_id': 0, 'session_code': 1}
+            )
+        ]
+
+    def release_code(self, bill_id):
+        mongo.db.bill_directory.update_one(
+            {'_id': ObjectId(bill_id)}, {'$unset': {'session_code': ''}}
+        )
+
+
+class MongoMenuRepository(base.MenuRepository):
+    def for_vendor(self, vendor_id):
+        return list(mongo.db.menu_items.find({'vendor_id': vendor_id}))
+
+    def count(self, vendor_id):
+        return mongo.db.menu_items.count_documents({'vendor_id': vendor_id})
+
+    def get(self, vendor_id, item_id):
+        return mongo.db.menu_items.find_one(
+            {'_id': ObjectId(item_id), 'vendor_id': vendor_id}
+        )
+
+    def search(self, vendor_id, words=(), prefix=None, category=None,
+               skip=0, limit=20):
+        ensure_indexes()
+        match = {'vendor_id': vendor_id}
+        if words:
+            match['$text'] = {'$search': ' '.join(words)}
+        if prefix:
+            # The text index only matches whole words, so a half-typed one
+            # is matched here, over items vendor_id and $text narrowed to
+            word_start = {
+                '$regex': r'(^|\W)' + re.escape(prefix), '$options': 'i'
+            }
+            match['$or'] = [{'name': word_start}, {'description': word_start}]
+        in_category = [{'$match': {'category': category}}] if category else []
+        order = (
+            {'score': {'$meta': 'textScore'}, 'name': 1} if words
+            else {'name': 1}
+        )
+        # One round trip for the page, its total and the category counts
+        result = next(mongo.db.menu_items.aggregate([
+            {'$match': match},
+            {'$facet': {
+                'items': in_category + [
+                    {'$sort': order}, {'$skip': skip}, {'$limit': limit}
+                ],
+                'total': in_category + [{'$count': 'count'}],
+                'categories': [
+                    {'$group': {'_id': '$category', 'count': {'$sum': 1}}},
+                    {'$sort': {'_id': 1}},
+                ],
+            }},
+        ]))
+        return {
+            'items': result['items'],
+            'total': result['total'][0]['count'] if result['total'] else 0,
+            'categories': [
+                {'name': group['_id'], 'count': group['count']}
+                for group in result['categories']
+            ],
+        }
+
+    def create(self, item):
+        mongo.db.menu_items.insert_one(item)
+
+    def delete(self, vendor_id, item_id):
+        mongo.db.menu_items.delete_one(
+            {'_id': ObjectId(item_id), 'vendor_id': vendor_id}
+        )
+
+
+class MongoCardRepository(base.CardRepository):
+    def create(self, card):
+        ensure_indexes()
+        mongo.db.cards.insert_one(card)
+
+    def get(self, token):
+        return mongo.db.cards.find_one({'token': token})
+
+    def delete(self, token):
+        mongo.db.cards.delete_one({'token': token})
+
+
+class MongoPaymentRepository(base.PaymentRepository):
+    def create(self, payment):
+        ensure_indexes()
+        mongo.db.payments.insert_one(payment)
+
+    def for_bill(self, bill_id):
+        ensure_indexes()
+        return Payment.find(
+            {'bill_id': ObjectId(bill_id)}, sort=[('completed_at', 1)]
+        )
+
+    def for_user(self, user_id, limit):
+        ensure_indexes()
+        return Payment.find(
+            {'user_id': user_id},
+            sort=[('completed_at', DESCENDING)], limit=limit
+        )
+
+
+class MongoRevenueRepository(base.RevenueRepository):
+    def get(self, rollup_id):
+        return mongo.db.daily_revenue.find_one({'_id': rollup_id})
+
+
+class MongoStore:
+    def __init__(self):
+        self.users = MongoUserRepository()
+        self.groups = MongoGroupRepository()
+        self.bills = MongoBillRepository()
+        self.directory = MongoDirectoryRepository()
+        self.menu = MongoMenuRepository()
+        self.cards = MongoCardRepository()
+        self.payments = MongoPaymentRepository()
+        self.revenue = MongoRevenueRepository()
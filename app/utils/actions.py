@@ -0,0 +1,166 @@
+'''
+state changes shared by the HTML views and the JSON API
+
+Each function is one user action against storage, with the follow-on
+writes it implies (bill members kept in step with group members, codes
+released when a bill closes). Views check access, call these and decide
+how to answer: a flash and redirect, or a JSON body.
+'''
+from datetime import datetime
+
+import pytz
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from app.models import Bill
+from app.payment import payment_gateway
+from app.storage import store
+from app.utils.code_filter import group_codes
+from app.utils.code_generator import generate_code
+from app.utils.directory import bill_key, register_bill, unregister_bill
+from app.utils.ledger import record_payment
+from app.utils.money import bill_shares
+
+
+def create_group(name, creator_id):
+    '''
+    Start a group with its creator as the only member, returning its id
+    '''
+    while True:
+        try:
+            group = {
+                'name': name,
+                'creator_id': creator_id,
+                'members': [creator_id],
+                'active_bill_id': None,
+                'active': True,
+                'created_at': None,
+                'last_active_at': datetime.now(pytz.utc),
+                'version': 0,
+                'code': generate_code()
+            }
+            store.groups.create(group)
+            group_codes.add(group['code'])
+            return group['_id']
+        except DuplicateKeyError:
+            pass
+
+
+def join_group(group, user_id):
+    '''
+    Add a user to a group, and to the bill the group is on
+    '''
+    store.groups.add_member(group.id, user_id)
+    if group.active_bill_id:
+        store.bills.add_members(bill_key(group.active_bill_id), [user_id])
+
+
+def leave_group(group, user_id):
+    '''
+    Take a user out of a group and its bill, deleting the group if it's
+    left empty. Returns whether it was deleted
+    '''
+    remaining = store.groups.remove_member(group.id, user_id)
+    if group.active_bill_id:
+        store.bills.remove_member(bill_key(group.active_bill_id), user_id)
+    if len(remaining) == 0:
+        store.groups.delete(group.id)
+        return True
+    return False
+
+
+def open_bill(vendor_id, table_number):
+    '''
+    Create an empty open bill with a fresh session code, returning its id
+    '''
+    # Session codes are claimed in the unsharded bill directory
+    bill_id = ObjectId()
+    while True:
+        try:
+            session_code = generate_code()
+            register_bill(bill_id, vendor_id, session_code)
+            break
+        except DuplicateKeyError:
+            pass
+
+    store.bills.create({
+        "_id": bill_id,
+        "vendor_id": vendor_id,
+        "table_number": table_number,
+        "contents": [],
+        "subtotal": 0,
+        "status": Bill.OPEN,
+        "paid": 0,
+        "members": [],
+        "version": 0,
+        "session_code": session_code,
+        "created_at": datetime.now(pytz.timezone("US/Eastern"))
+    })
+    return bill_id
+
+
+def attach_group(key, group):
+    '''
+    Put a group on a bill, its members can then split and pay it
+    '''
+    store.groups.attach_bill(group.id, key['_id'])
+    store.bills.add_members(key, group.members)
+
+
+def void_bill(key):
+    '''
+    Void an open bill with nothing paid, detaching it from every group
+    Returns False if the bill couldn't be voided
+    '''
+    if not store.bills.void(key, datetime.now(pytz.timezone("US/Eastern"))):
+        return False
+    store.groups.detach_bill_everywhere(key['_id'])
+    unregister_bill(key['_id'])
+    return True
+
+
+def pay_share(key, bill, user, card, cvc):
+    '''
+    Charge a member their share of a bill read with `for_payer`. `card` is
+    a saved card's token or the details of a new card.
+    Returns (amount charged, {'status', 'paid'} after the payment), the
+    latter None, with nothing charged, if the bill has closed since
+    Raises PaymentError (or ValueError for bad card details or nothing to
+    pay) if the charge fails, the bill is then left as it was
+    '''
+    amount = bill_shares(bill.contents).get(user.id, 0)
+    if amount <= 0:
+        raise ValueError("You have no items on this bill to pay for.")
+    items_paid = [
+        item["_id"] for item in bill.contents
+        if user.id in item["assigned_to"]
+    ]
+
+    # The share goes on the bill before the card is charged, so a bill
+    # voided or settled since the read above is never charged for
+    state = store.bills.pay(
+        key, user.id, amount, datetime.now(pytz.timezone("US/Eastern"))
+    )
+    if not state:
+        return 0, None
+    try:
+        paid = payment_gateway.make_payment(card, cvc, amount)
+    except Exception:
+        store.bills.unpay(key, user.id, amount)
+        raise
+
+    if isinstance(card, dict):
+        payment_method = {
+            "type": "card", "last_four": card["card_number"][-4:]
+        }
+    else:
+        payment_method = {"type": "saved", "token": card}
+    # The ledger is the source of truth, bill.paid caches its total
+    record_payment(key['_id'], user, paid, payment_method, items_paid)
+
+    # Settled bills stay as history for exports and revenue rollups.
+    # Only the payment that settled it releases its groups and the code
+    if state["status"] == Bill.SETTLED:
+        store.groups.detach_bill_everywhere(key['_id'])
+        unregister_bill(key['_id'])
+    return paid, state
@@ -0,0 +1,134 @@
+'''
+fingerprinted, precompressed static assets
+
+`build_assets` copies every file in the static folder to static/dist under a
+content-hashed name and writes gzip/brotli variants next to it. Templates ask
+for `asset_url('styles.css')`, which resolves through the manifest, and
+`send_asset` serves the best precompressed variant with immutable caching.
+'''
+import gzip
+import hashlib
+import json
+import mimetypes
+import shutil
+from functools import lru_cache
+from pathlib import Path
+
+from flask import abort, current_app, request, send_file, url_for
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, .br variants are skipped without it
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+HASH_LENGTH = 12
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.html'}
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Preferred order when the client accepts several encodings
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def fingerprint(path):
+    '''
+    Return the name of a file with a short content hash inserted
+    e.g. styles.css -> styles.1a2b3c4d5e6f.css
+    '''
+    digest = hashlib.sha256(path.read_bytes()).hexdigest()[:HASH_LENGTH]
+    return path.with_name(f"{path.stem}.{digest}{path.suffix}").name
+
+
+def compress(path):
+    '''
+    Write .gz (and .br when available) variants of a file,
+    keeping only the ones that are actually smaller
+    '''
+    data = path.read_bytes()
+    variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data, quality=11)
+
+    for suffix, compressed in variants.items():
+        if len(compressed) < len(data):
+            Path(f"{path}{suffix}").write_bytes(compressed)
+
+
+def build_assets(static_folder):
+    '''
+    Fingerprint and precompress every static file into static/dist
+    Returns the manifest mapping logical names to hashed names
+    '''
+    static_folder = Path(static_folder)
+    dist = static_folder / DIST_DIR
+    if dist.exists():
+        shutil.rmtree(dist)
+    dist.mkdir()
+
+    manifest = {}
+    for path in sorted(static_folder.rglob('*')):
+        if not path.is_file() or dist in path.parents:
+            continue
+        logical = path.relative_to(static_folder).as_posix()
+        target = dist / path.relative_to(static_folder).parent / (
+            fingerprint(path)
+        )
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(path, target)
+        if path.suffix in COMPRESSIBLE:
+            compress(target)
+        manifest[logical] = target.relative_to(dist).as_posix()
+
+    (dist / MANIFEST_NAME).write_text(json.dumps(manifest, indent=2))
+    load_manifest.cache_clear()
+    return manifest
+
+
+@lru_cache(maxsize=1)
+def load_manifest(static_folder):
+    '''
+    Read the manifest once per process, empty if assets were never built
+    '''
+    try:
+        path = Path(static_folder) / DIST_DIR / MANIFEST_NAME
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def asset_url(filename):
+    '''
+    URL of the fingerprinted asset, falling back to the plain static
+    file when `flask build-assets` has not been run
+    '''
+    manifest = load_manifest(current_app.static_folder)
+    if filename in manifest:
+        return url_for('asset', filename=manifest[filename])
+    return url_for('static', filename=filename)
+
+
+def send_asset(filename):
+    '''
+    Send a fingerprinted asset, using a precompressed variant
+    when the client accepts it
+    '''
+    dist = Path(current_app.static_folder) / DIST_DIR
+    path = (dist / filename).resolve()
+    if dist.resolve() not in path.parents or not path.is_file():
+        abort(404)
+
+    mimetype = mimetypes.guess_type(path.name)[0]
+    encoding = None
+    for name, suffix in ENCODINGS:
+        variant = Path(f"{path}{suffix}")
+        if request.accept_encodings[name] and variant.is_file():
+            path, encoding = variant, name
+            break
+
+    response = send_file(path, mimetype=mimetype, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,185 @@
+'''
+in-memory gate in front of code lookups on the join paths
+
+Every worker keeps a Bloom filter of the live bill and group codes, so a
+typo or a guessed code is turned away without a query. A code has to pass
+its check character (see app/utils/code_generator.py) and then the filter;
+only codes the filter might hold are looked up in the database.
+
+Codes issued by this worker are added as they are made. Codes issued by
+other workers are picked up by an incremental refresh, which reads the
+codes created since the last one and runs at most once every
+CODE_FILTER_REFRESH seconds, on a miss. A code is therefore only wrongly
+turned away if it is younger than that. Closed bills' codes can't be taken
+out of a Bloom filter, so it is rebuilt from scratch every
+CODE_FILTER_REBUILD seconds, or sooner once it fills up. Codes made before
+check characters existed are kept in a small exact set of their own.
+'''
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+from bson import ObjectId
+
+from app import app
+from app.storage import store
+from app.utils.code_generator import valid_code
+
+# Smallest number of codes a filter is sized for
+MIN_CAPACITY = 1024
+# Codes from other workers can land with slightly older ObjectIds than the
+# last refresh, so each refresh reaches back this far
+REFRESH_OVERLAP = timedelta(seconds=5)
+
+
+class BloomFilter:
+    '''
+    Fixed-size Bloom filter over strings, `error_rate` false positives at
+    `capacity` entries
+    '''
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.size / 8))
+        self.count = 0
+
+    def _positions(self, value):
+        # Two halves of one digest, combined into k positions
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return (
+            (first + i * second) % self.size for i in range(self.hashes)
+        )
+
+    def add(self, value):
+        # Refreshes overlap, so only count what wasn't there already
+        if value in self:
+            return
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value)
+        )
+
+
+class CodeFilter:
+    '''
+    Which codes might exist, filled from `load(since)` (a repository's
+    codes_since)
+    '''
+    def __init__(self, load, refresh_interval, rebuild_interval, error_rate):
+        self.load = load
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.legacy = set()
+        self.refreshed = self.rebuilt = 0.0
+        self.since = None
+        self.counts = {'rejected_malformed': 0, 'rejected_filter': 0,
+                       'passed': 0, 'refreshes': 0, 'rebuilds': 0}
+
+    def _add(self, code):
+        if valid_code(code):
+            self.bloom.add(code)
+        else:
+            self.legacy.add(code)
+
+    def _rebuild(self, now):
+        codes = self.load()
+        self.bloom = BloomFilter(
+            max(MIN_CAPACITY, 2 * len(codes)), self.error_rate
+        )
+        self.legacy = set()
+        for code in codes:
+            self._add(code)
+        self.rebuilt = now
+        self.counts['rebuilds'] += 1
+
+    def _refresh(self):
+        '''
+        Pull in codes created since the last refresh, rebuilding instead
+        when the filter is due or full. Call with the lock held
+        '''
+        now = time.monotonic()
+        started = datetime.now(pytz.utc)
+        if (
+            self.bloom is None
+            or now - self.rebuilt > self.rebuild_interval
+            or self.bloom.count > self.bloom.capacity
+        ):
+            self._rebuild(now)
+        else:
+            for code in self.load(self.since):
+                self._add(code)
+            self.counts['refreshes'] += 1
+        self.refreshed = now
+        self.since = ObjectId.from_datetime(started - REFRESH_OVERLAP)
+
+    def add(self, code):
+        '''
+        Note a code this worker just issued
+        '''
+        with self.lock:
+            if self.bloom is None:
+                self._refresh()
+            self._add(code)
+
+    def might_exist(self, code):
+        '''
+        False if `code` certainly isn't live, True if it's worth a lookup
+        '''
+        with self.lock:
+            if self.bloom is None:
+                self._refresh()
+            if code in self.legacy:
+                return self._passed()
+            if not valid_code(code):
+                self.counts['rejected_malformed'] += 1
+                return False
+            if code in self.bloom:
+                return self._passed()
+            # Maybe issued by another worker since the last refresh
+            if time.monotonic() - self.refreshed > self.refresh_interval:
+                self._refresh()
+                if code in self.bloom:
+                    return self._passed()
+            self.counts['rejected_filter'] += 1
+            return False
+
+    def _passed(self):
+        self.counts['passed'] += 1
+        return True
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                **self.counts,
+                'codes': self.bloom.count if self.bloom else 0,
+                'legacy_codes': len(self.legacy),
+            }
+
+
+def code_filter(load):
+    return CodeFilter(
+        load,
+        refresh_interval=app.config['CODE_FILTER_REFRESH'],
+        rebuild_interval=app.config['CODE_FILTER_REBUILD'],
+        error_rate=app.config['CODE_FILTER_ERROR_RATE'],
+    )
+
+
+bill_codes = code_filter(store.directory.codes_since)
+group_codes = code_filter(store.groups.codes_since)
@@ -1,14 +1,44 @@
 '''
 generates random codes for bills, groups, etc.
+
+The last character of a code is an ISO 7064 MOD 37,36 check character
+over the others, so any one mistyped character and almost every swap of
+neighbouring characters is caught by `valid_code` without looking the
+code up.
 '''
-import random
+import secrets
 import string
 from app import app
 
 CODE_LENGTH = app.config.get('CODE_LENGTH', 6)
+ALPHABET = string.ascii_uppercase + string.digits
+
+
+def check_character(body):
+    '''
+    ISO 7064 MOD 37,36 check character for `body`
+    '''
+    modulus = len(ALPHABET)
+    product = modulus
+    for char in body:
+        total = (product + ALPHABET.index(char)) % modulus or modulus
+        product = total * 2 % (modulus + 1)
+    return ALPHABET[(modulus + 1 - product) % modulus]
 
 
 def generate_code():
-    return "".join(
-        random.choices(string.ascii_uppercase + string.digits, k=CODE_LENGTH)
+    body = "".join(
+        secrets.choice(ALPHABET) for _ in range(CODE_LENGTH - 1)
+    )
+    return body + check_character(body)
+
+
+def valid_code(code):
+    '''
+    Whether `code` is well formed and its check character matches
+    '''
+    return (
+        len(code) == CODE_LENGTH
+        and all(char in ALPHABET for char in code)
+        and check_character(code[:-1]) == code[-1]
     )
@@ -2,8 +2,8 @@
 Custom Flask decorators for authentication and authorization
 """
 from functools import wraps
-from flask import flash, redirect, url_for
-from flask_login import current_user
+from flask import abort, current_app, flash, redirect, url_for
+from flask_login import current_user, login_required
 
 
 def vendor_access_required(f):
@@ -32,3 +32,18 @@ def customer_access_required(f):
             return redirect(url_for("index"))
         return f(*args, **kwargs)
     return decorated_function
+
+
+def metrics_access_required(f):
+    '''
+    decorator for the /metrics endpoints
+    404s unless METRICS_ENABLED is set, then only logged-in vendors get in
+    '''
+    guarded = login_required(vendor_access_required(f))
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_app.config['METRICS_ENABLED']:
+            abort(404)
+        return guarded(*args, **kwargs)
+    return decorated_function
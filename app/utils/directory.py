@@ -0,0 +1,169 @@
+'''
+shard-key routing for bills and menu items
+
+`bills` and `menu_items` are sharded on (vendor_id, _id), so every query
+against them carries vendor_id and goes to a single shard. Customers only
+know a bill's id or its session code, so both resolve to a vendor through
+`bill_directory`, a small unsharded collection keyed on the bill id with a
+unique index on session_code. Session code uniqueness lives here as well,
+a sharded collection can only enforce unique indexes prefixed by its key.
+Only open bills hold a code, closing a bill hands it back.
+
+Groups are sharded on a hashed _id, so their codes are kept unique the same
+way, in the unsharded `group_codes` collection keyed on the code.
+'''
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import OperationFailure
+
+from app import mongo
+from app.models import Bill
+from app.storage import store
+from app.storage.jobs import mongo_only
+from app.storage.mongo import SHARD_KEYS, ensure_indexes
+from app.utils.code_filter import bill_codes
+
+
+def register_bill(bill_id, vendor_id, session_code):
+    '''
+    Claim a session code for a new bill
+    Raises DuplicateKeyError if the code is taken
+    '''
+    store.directory.register(bill_id, vendor_id, session_code)
+    bill_codes.add(session_code)
+
+
+def unregister_bill(bill_id):
+    '''
+    Release a settled or voided bill's session code
+    '''
+    store.directory.release_code(bill_id)
+
+
+def bill_key(bill_id, vendor_id=None):
+    '''
+    Shard-targeted filter for a bill, looking up its vendor in the
+    directory when the caller doesn't know it. None if there is no such bill
+    '''
+    if not bill_id:
+        return None
+    try:
+        bill_id = ObjectId(bill_id)
+    except (InvalidId, TypeError):
+        return None
+    if vendor_id is None:
+        entry = store.directory.get(bill_id)
+        if not entry:
+            return None
+        vendor_id = entry['vendor_id']
+    return {'_id': bill_id, 'vendor_id': vendor_id}
+
+
+def bill_key_for_code(session_code):
+    '''
+    Shard-targeted filter for the bill holding a session code, or None
+    '''
+    # Typos and guesses are turned away without a query
+    if not bill_codes.might_exist(session_code):
+        return None
+    entry = store.directory.by_code(session_code)
+    if not entry:
+        return None
+    return {'_id': entry['_id'], 'vendor_id': entry['vendor_id']}
+
+
+@mongo_only
+def backfill_directory():
+    '''
+    Add directory entries for bills created before the directory existed,
+    and group_codes entries for groups created before it existed
+    '''
+    ensure_indexes()
+    mongo.db.groups.aggregate([
+        {'$project': {'_id': '$code', 'group_id': '$_id'}},
+        {'$merge': {
+            'into': 'group_codes',
+            'on': '_id',
+            'whenMatched': 'keepExisting',
+            'whenNotMatched': 'insert'
+        }}
+    ])
+    mongo.db.bills.aggregate([
+        {'$project': {'vendor_id': 1, 'session_code': {'$cond': [
+            {'$in': ['$status', list(Bill.UNSETTLED)]},
+            '$session_code', '$$REMOVE'
+        ]}}},
+        {'$merge': {
+            'into': 'bill_directory',
+            'on': '_id',
+            'whenMatched': 'keepExisting',
+            'whenNotMatched': 'insert'
+        }}
+    ])
+
+
+@mongo_only
+def shard_collections():
+    '''
+    Shard bills, menu items and groups on their keys
+    Only works through a mongos
+    '''
+    backfill_directory()
+    # Unique across a sharded collection needs the shard key as a prefix
+    for collection, index in (('bills', 'session_code_1'),
+                              ('groups', 'code_1')):
+        try:
+            mongo.db[collection].drop_index(index)
+        except OperationFailure:
+            pass
+
+    admin = mongo.cx.admin
+    admin.command('enableSharding', mongo.db.name)
+    for collection, key in SHARD_KEYS.items():
+        admin.command(
+            'shardCollection', f"{mongo.db.name}.{collection}", key=key,
+            unique='hashed' not in key.values()
+        )
+
+
+@mongo_only
+def explain_targets(queries):
+    '''
+    For each (collection, filter), the shards a find would be sent to,
+    None when not connected to a sharded cluster
+    '''
+    targets = {}
+    for collection, query in queries:
+        plan = mongo.db.command(
+            'explain', {'find': collection, 'filter': query},
+            verbosity='queryPlanner'
+        )['queryPlanner']['winningPlan']
+        shards = plan.get('shards')
+        targets[collection, str(query)] = (
+            [shard['shardName'] for shard in shards] if shards else None
+        )
+    return targets
+
+
+@mongo_only
+def hot_queries():
+    '''
+    The filters the busiest routes send, built from a sample bill
+    '''
+    entry = mongo.db.bill_directory.find_one(
+        {'session_code': {'$type': 'string'}}
+    )
+    group = mongo.db.groups.find_one({}, {'_id': 1, 'code': 1})
+    if not entry or not group:
+        return []
+    vendor_id = entry['vendor_id']
+    return [
+        ('groups', {'_id': group['_id']}),
+        ('group_codes', {'_id': group['code']}),
+        ('bill_directory', {'_id': entry['_id']}),
+        ('bill_directory', {'session_code': entry['session_code']}),
+        ('bills', bill_key(entry['_id'], vendor_id)),
+        ('bills', {'vendor_id': vendor_id,
+                   'status': {'$in': list(Bill.UNSETTLED)}}),
+        ('menu_items', {'vendor_id': vendor_id}),
+    ]
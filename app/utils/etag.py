@@ -0,0 +1,64 @@
+'''
+conditional GET helpers for views keyed on document versions
+
+Bills and groups carry a `version` counter that every update bumps with
+`$inc`, so a view can build its ETag from a couple of tiny projected reads
+and answer `If-None-Match` with a 304 before running the full queries.
+'''
+import hashlib
+from functools import lru_cache
+from pathlib import Path
+
+from flask import current_app, make_response, request, session
+
+CACHE_CONTROL = 'private, no-cache'
+
+
+@lru_cache(maxsize=1)
+def template_digest():
+    '''
+    Hash of the templates, so a deploy that changes the markup
+    invalidates tags handed out by the previous version
+    '''
+    digest = hashlib.blake2b(digest_size=8)
+    # template_folder is relative to the app package, not the working
+    # directory
+    folder = Path(current_app.root_path, current_app.template_folder)
+    for path in sorted(folder.rglob('*.html')):
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def version_tag(*parts):
+    '''
+    Build an ETag from the ids and versions a view depends on
+    '''
+    key = ':'.join(str(part) for part in (template_digest(), *parts))
+    return hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
+
+
+def not_modified(etag):
+    '''
+    Return a 304 response if the client already has this version,
+    None if the view has to render
+    '''
+    # Pending flash messages are part of the page, so always render them
+    if session.get('_flashes'):
+        return None
+    if not request.if_none_match.contains(etag):
+        return None
+
+    response = make_response('', 304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+def with_etag(body, etag):
+    '''
+    Attach the ETag to a rendered page
+    '''
+    response = make_response(body)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
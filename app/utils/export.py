@@ -0,0 +1,120 @@
+'''
+streams a vendor's bill history as CSV or JSONL
+
+Everything here is a generator fed by a batched Mongo cursor, so an export
+holds one batch of bills in memory no matter how much history there is
+(the in-memory backend hands over a list).
+CSV amounts are in dollars, JSONL lines are the stored documents (cents).
+'''
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytz
+
+from app.storage import store
+from app.utils.money import format_cents
+
+EXPORT_BATCH_SIZE = 500
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+CSV_COLUMNS = [
+    'bill_id', 'created_at', 'table_number', 'session_code', 'status',
+    'subtotal', 'paid', 'item_id', 'name', 'price', 'quantity', 'assigned_to'
+]
+BILL_PROJECTION = {
+    'table_number': 1, 'session_code': 1, 'status': 1, 'subtotal': 1,
+    'paid': 1, 'created_at': 1, 'contents': 1
+}
+TIMEZONE = pytz.timezone('US/Eastern')
+
+
+def parse_date(value):
+    '''
+    Parse a YYYY-MM-DD filter as local midnight, None if empty
+    Raises ValueError on a malformed date
+    '''
+    if not value:
+        return None
+    return TIMEZONE.localize(datetime.strptime(value, '%Y-%m-%d'))
+
+
+def bill_cursor(vendor_id, start=None, end=None,
+                batch_size=EXPORT_BATCH_SIZE):
+    '''
+    Cursor over a vendor's bills created in [start, end], oldest first
+    `end` is inclusive of the whole day
+    '''
+    return store.bills.history(
+        vendor_id, BILL_PROJECTION, start,
+        end + timedelta(days=1) if end else None, batch_size
+    )
+
+
+def line_items(bills):
+    '''
+    Flatten bills into one row per line item
+    Bills without items still produce a row so they show up in the export
+    '''
+    for bill in bills:
+        row = {
+            'bill_id': str(bill['_id']),
+            'created_at': bill['created_at'].isoformat(),
+            'table_number': bill.get('table_number', ''),
+            'session_code': bill.get('session_code', ''),
+            'status': bill.get('status', ''),
+            'subtotal': format_cents(bill.get('subtotal', 0)),
+            'paid': format_cents(bill.get('paid', 0)),
+        }
+        contents = bill.get('contents') or [{}]
+        for item in contents:
+            yield {
+                **row,
+                'item_id': item.get('item_id', ''),
+                'name': item.get('name', ''),
+                'price': format_cents(item['price']) if item else '',
+                'quantity': item.get('quantity', ''),
+                'assigned_to': ' '.join(item.get('assigned_to', [])),
+            }
+
+
+def csv_lines(bills):
+    '''
+    Yield the CSV export one line at a time, reusing a single small buffer
+    '''
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS)
+
+    def drain():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    writer.writeheader()
+    yield drain()
+    for row in line_items(bills):
+        writer.writerow(row)
+        yield drain()
+
+
+def jsonl_lines(bills):
+    '''
+    Yield one JSON document per bill, line items embedded
+    '''
+    for bill in bills:
+        bill['_id'] = str(bill['_id'])
+        bill['created_at'] = bill['created_at'].isoformat()
+        yield json.dumps(bill, default=str) + '\n'
+
+
+def export_lines(bills, export_format):
+    '''
+    Dispatch to the writer for `export_format` ('csv' or 'jsonl')
+    '''
+    if export_format == 'jsonl':
+        return jsonl_lines(bills)
+    return csv_lines(bills)
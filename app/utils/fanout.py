@@ -0,0 +1,27 @@
+'''
+runs a view's independent Mongo lookups concurrently
+
+Views are sync, so rather than an async driver the lookups fan out over a
+small shared thread pool: the request then waits for the slowest query
+instead of the sum of all of them. The callables run outside the request
+context, so read anything like current_user.id before building them.
+'''
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app
+
+executor = ThreadPoolExecutor(
+    max_workers=app.config['FANOUT_WORKERS'], thread_name_prefix='fanout'
+)
+
+
+def gather(*calls):
+    '''
+    Run zero-argument callables concurrently, results in call order
+    The first runs on the calling thread so a lone call costs no hand-off
+    '''
+    if not calls:
+        return []
+    first, *rest = calls
+    futures = [executor.submit(call) for call in rest]
+    return [first(), *(future.result() for future in futures)]
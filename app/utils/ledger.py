@@ -0,0 +1,94 @@
+'''
+append-only payment ledger
+
+Every successful charge is inserted into `payments` and never modified.
+`bill.paid` is a cached total of that ledger, `rebuild_paid` re-derives it.
+'''
+from bson import ObjectId
+
+from app import mongo
+from app.models import Payment
+from app.storage import store
+from app.storage.jobs import mongo_only
+from app.storage.mongo import ensure_indexes
+from app.utils.directory import backfill_directory, bill_key
+
+HISTORY_LIMIT = 10
+
+
+def record_payment(bill_id, user, amount, payment_method, items_paid):
+    '''
+    Append a completed payment to the ledger
+    '''
+    payment = Payment.create_payment_dict(
+        bill_id=ObjectId(bill_id),
+        user_id=user.id,
+        username=user.username,
+        amount=amount,
+        payment_method=payment_method,
+        items_paid=items_paid
+    )
+    store.payments.create(payment)
+    return Payment(payment)
+
+
+def bill_payments(bill_id):
+    '''
+    Payments made on a bill, oldest first
+    '''
+    return store.payments.for_bill(bill_id)
+
+
+def payment_history(user_id, limit=HISTORY_LIMIT):
+    '''
+    A customer's most recent payments
+    '''
+    return store.payments.for_user(user_id, limit)
+
+
+@mongo_only
+def rebuild_paid(bill_id=None):
+    '''
+    Re-derive bill.paid from the ledger, for one bill or for every
+    bill that has payments
+    '''
+    ensure_indexes()
+    if bill_id:
+        key = bill_key(bill_id)
+        if not key:
+            return
+        totals = list(mongo.db.payments.aggregate([
+            {"$match": {"bill_id": ObjectId(bill_id)}},
+            {"$group": {"_id": None, "paid": {"$sum": "$amount"}}}
+        ]))
+        mongo.db.bills.update_one(
+            key,
+            {
+                "$set": {"paid": totals[0]["paid"] if totals else 0},
+                "$inc": {"version": 1}
+            }
+        )
+        return
+
+    # bills is sharded on (vendor_id, _id), so $merge has to match on both
+    backfill_directory()
+    mongo.db.payments.aggregate([
+        {"$group": {"_id": "$bill_id", "paid": {"$sum": "$amount"}}},
+        {"$lookup": {
+            "from": "bill_directory",
+            "localField": "_id",
+            "foreignField": "_id",
+            "as": "entry"
+        }},
+        {"$unwind": "$entry"},
+        {"$project": {"paid": 1, "vendor_id": "$entry.vendor_id"}},
+        {"$merge": {
+            "into": "bills",
+            "on": ["vendor_id", "_id"],
+            "whenMatched": [{"$set": {
+                "paid": "$$new.paid",
+                "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}
+            }}],
+            "whenNotMatched": "discard"
+        }}
+    ])
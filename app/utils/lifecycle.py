@@ -0,0 +1,245 @@
+'''
+bill lifecycle maintenance
+
+Bills move open -> settling -> settled, or open -> voided (see the Bill
+model), and only unsettled bills hold a session code in the directory.
+`migrate_bill_status` brings bills written before the lifecycle existed,
+which were all 'pending' until paid and then 'completed', into line, and
+fills in the members of open bills from the groups attached to them.
+
+`sweep` is the background clean-up: it voids open bills nobody paid,
+clears group links to bills that are no longer open and deletes
+long-idle groups. It works in small batches and sleeps between them so it
+keeps the database busy for at most a set fraction of the time.
+'''
+import time
+from datetime import datetime, timedelta
+
+import pytz
+from bson import ObjectId
+from pymongo import ASCENDING, UpdateMany
+
+from app import mongo
+from app.models import Bill
+from app.storage import store
+from app.storage.jobs import mongo_only
+from app.storage.mongo import ensure_indexes
+from app.utils.directory import bill_key
+
+LEGACY_STATUSES = ['pending', 'active']
+RELEASE_BATCH_SIZE = 1000
+
+SWEEP_BATCH_SIZE = 500
+# Fraction of wall time the sweep may spend on database work
+SWEEP_DUTY_CYCLE = 0.1
+# Open bills with nothing paid this long after opening are abandoned
+STALE_BILL_AGE = timedelta(hours=12)
+# Groups without a bill that haven't been joined or had one attached or
+# detached for this long are dead
+IDLE_GROUP_AGE = timedelta(days=30)
+
+
+@mongo_only
+def migrate_bill_status():
+    '''
+    Map legacy statuses onto the lifecycle, give closed bills' session
+    codes back, rebuild the directory's code index as a partial one and
+    copy group members onto the bills they're paying
+    Returns the number of bills updated
+    '''
+    result = mongo.db.bills.bulk_write([
+        UpdateMany(
+            {'status': {'$in': LEGACY_STATUSES}, 'paid': {'$gt': 0}},
+            {'$set': {'status': Bill.SETTLING}}
+        ),
+        UpdateMany(
+            {'status': {'$in': LEGACY_STATUSES}},
+            {'$set': {'status': Bill.OPEN}}
+        ),
+        UpdateMany(
+            {'status': 'completed'}, {'$set': {'status': Bill.SETTLED}}
+        ),
+    ], ordered=True)
+
+    # The old index made codes unique across every bill ever created
+    index = mongo.db.bill_directory.index_information().get('session_code_1')
+    if index and 'partialFilterExpression' not in index:
+        mongo.db.bill_directory.drop_index('session_code_1')
+
+    closed = mongo.db.bills.find(
+        {'status': {'$in': [Bill.SETTLED, Bill.VOIDED]}}, {'_id': 1},
+        batch_size=RELEASE_BATCH_SIZE
+    )
+    batch = []
+    for bill in closed:
+        batch.append(bill['_id'])
+        if len(batch) == RELEASE_BATCH_SIZE:
+            release_codes(batch)
+            batch = []
+    if batch:
+        release_codes(batch)
+
+    ensure_indexes()
+    backfill_members()
+    return result.modified_count
+
+
+def backfill_members():
+    groups = mongo.db.groups.find(
+        {'active_bill_id': {'$ne': None}}, {'active_bill_id': 1, 'members': 1}
+    )
+    for group in groups:
+        store.bills.add_members(
+            bill_key(group['active_bill_id']), group['members']
+        )
+
+
+def release_codes(bill_ids):
+    mongo.db.bill_directory.update_many(
+        {'_id': {'$in': bill_ids}, 'session_code': {'$exists': True}},
+        {'$unset': {'session_code': ''}}
+    )
+
+
+def detach_bills(bill_ids, now):
+    return mongo.db.groups.update_many(
+        {'active_bill_id': {'$in': bill_ids}},
+        {
+            '$set': {'active_bill_id': None, 'last_active_at': now},
+            '$inc': {'version': 1}
+        }
+    ).modified_count
+
+
+class Throttle:
+    '''
+    Paces batches so work takes at most `duty_cycle` of wall time
+    '''
+    def __init__(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self.started = time.monotonic()
+
+    def pace(self):
+        '''
+        Call after each batch, sleeps in proportion to how long it took
+        '''
+        worked = time.monotonic() - self.started
+        time.sleep(worked * (1 / self.duty_cycle - 1))
+        self.started = time.monotonic()
+
+
+def void_stale_bills(now, batch_size, throttle):
+    '''
+    Void open bills with nothing paid that were opened before
+    STALE_BILL_AGE ago, releasing their codes and groups
+    Returns the number voided
+    '''
+    stale = {
+        'status': Bill.OPEN, 'paid': 0,
+        'created_at': {'$lt': now - STALE_BILL_AGE}
+    }
+    voided = 0
+    while True:
+        ids = [bill['_id'] for bill in mongo.db.bills.find(
+            stale, {'_id': 1}
+        ).limit(batch_size)]
+        if not ids:
+            return voided
+        # The filter is repeated, a bill paid since the find is left alone
+        mongo.db.bills.update_many({**stale, '_id': {'$in': ids}}, {
+            '$set': {'status': Bill.VOIDED, 'voided_at': now},
+            '$inc': {'version': 1}
+        })
+        ids = mongo.db.bills.distinct('_id', {
+            '_id': {'$in': ids}, 'status': Bill.VOIDED, 'voided_at': now
+        })
+        if ids:
+            release_codes(ids)
+            detach_bills(ids, now)
+        voided += len(ids)
+        throttle.pace()
+
+
+def clear_dangling_links(now, batch_size, throttle):
+    '''
+    Clear active_bill_id on groups whose bill is settled, voided or gone
+    Returns the number of groups updated
+    '''
+    cleared = 0
+    last_id = None
+    while True:
+        query = {'active_bill_id': {'$ne': None}}
+        if last_id:
+            query['_id'] = {'$gt': last_id}
+        groups = list(mongo.db.groups.find(
+            query, {'active_bill_id': 1}
+        ).sort('_id', ASCENDING).limit(batch_size))
+        if not groups:
+            return cleared
+        last_id = groups[-1]['_id']
+
+        bill_ids = {group['active_bill_id'] for group in groups}
+        unsettled = set(mongo.db.bills.distinct('_id', {
+            '_id': {'$in': list(bill_ids)},
+            'status': {'$in': list(Bill.UNSETTLED)}
+        }))
+        dangling = list(bill_ids - unsettled)
+        if dangling:
+            cleared += detach_bills(dangling, now)
+        throttle.pace()
+
+
+def compact_groups(now, batch_size, throttle):
+    '''
+    Delete groups without a bill that were last active before
+    IDLE_GROUP_AGE ago. leave_group already deletes groups nobody is left
+    in. Returns the number deleted
+    '''
+    idle_since = now - IDLE_GROUP_AGE
+    # Every branch is served by the (active_bill_id, last_active_at) index
+    dead = {'$or': [
+        {'active_bill_id': None, 'last_active_at': {'$lt': idle_since}},
+        # Groups from before last_active_at count from their creation
+        {
+            'active_bill_id': None,
+            'last_active_at': {'$exists': False},
+            '_id': {'$lt': ObjectId.from_datetime(idle_since)}
+        },
+    ]}
+    deleted = 0
+    while True:
+        codes = {group['_id']: group['code'] for group in mongo.db.groups.find(
+            dead, {'code': 1}
+        ).limit(batch_size)}
+        if not codes:
+            return deleted
+        ids = list(codes)
+        deleted += mongo.db.groups.delete_many(
+            {'$and': [dead, {'_id': {'$in': ids}}]}
+        ).deleted_count
+        # Groups that came back to life in between keep their codes
+        kept = mongo.db.groups.distinct('_id', {'_id': {'$in': ids}})
+        for group_id in kept:
+            del codes[group_id]
+        mongo.db.group_codes.delete_many(
+            {'_id': {'$in': list(codes.values())}}
+        )
+        throttle.pace()
+
+
+@mongo_only
+def sweep(now=None, batch_size=SWEEP_BATCH_SIZE,
+          duty_cycle=SWEEP_DUTY_CYCLE):
+    '''
+    One full clean-up pass, returning counts of what changed
+    '''
+    ensure_indexes()
+    now = now or datetime.now(pytz.utc)
+    # Stored dates keep milliseconds, and voided_at is matched on below
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    throttle = Throttle(duty_cycle)
+    return {
+        'bills_voided': void_stale_bills(now, batch_size, throttle),
+        'links_cleared': clear_dangling_links(now, batch_size, throttle),
+        'groups_deleted': compact_groups(now, batch_size, throttle),
+    }
@@ -0,0 +1,159 @@
+'''
+live split editing for customers viewing a bill
+
+Each bill has an in-process channel. Every customer with the bill open
+holds a WebSocket subscribed to it, and an assignment change goes out to
+all of them as a small JSON delta (the items, their new assignees and the
+shares that moved) rather than a re-rendered page. Bulk splits change
+many items in one update and go out as one delta. Channels live in one
+process, so run a single worker process (threads are fine) or put a
+broker behind `publish` before scaling out.
+'''
+import json
+import queue
+import threading
+
+from app.storage import store
+from app.utils.money import bill_shares
+
+# How often a socket checks its channel while waiting on the client
+POLL_INTERVAL = 0.1
+# Deltas a slow client may fall behind by before it's told to reload
+BACKLOG_LIMIT = 100
+
+_channels = {}
+_lock = threading.Lock()
+
+
+def subscribe(bill_id):
+    '''
+    Queue that receives every delta published for the bill
+    '''
+    subscriber = queue.Queue(maxsize=BACKLOG_LIMIT)
+    with _lock:
+        _channels.setdefault(str(bill_id), set()).add(subscriber)
+    return subscriber
+
+
+def unsubscribe(bill_id, subscriber):
+    with _lock:
+        subscribers = _channels.get(str(bill_id), set())
+        subscribers.discard(subscriber)
+        if not subscribers:
+            _channels.pop(str(bill_id), None)
+
+
+def publish(bill_id, delta):
+    '''
+    Send a delta to everyone viewing the bill, encoded once for all of them
+    '''
+    message = json.dumps(delta)
+    with _lock:
+        subscribers = list(_channels.get(str(bill_id), ()))
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(message)
+        except queue.Full:
+            # Too far behind to catch up on deltas, start it over
+            with subscriber.mutex:
+                subscriber.queue.clear()
+            subscriber.put_nowait(json.dumps({'type': 'reload'}))
+
+
+def pending(subscriber):
+    '''
+    Deltas waiting for a subscriber, without blocking
+    '''
+    while True:
+        try:
+            yield subscriber.get_nowait()
+        except queue.Empty:
+            return
+
+
+def moved_shares(contents, assignments):
+    '''
+    Shares that change when `assignments` ({item_id: user_ids}) are
+    applied to `contents`, and the contents after
+    '''
+    after = [
+        {**item, "assigned_to": assignments[item["_id"]]}
+        if item["_id"] in assignments else item
+        for item in contents
+    ]
+    old_shares, new_shares = bill_shares(contents), bill_shares(after)
+    return {
+        user_id: new_shares.get(user_id, 0)
+        for user_id in old_shares.keys() | new_shares.keys()
+        if old_shares.get(user_id) != new_shares.get(user_id)
+    }
+
+
+def assign_item(key, item_id, user_ids):
+    '''
+    Assign a bill item to `user_ids` and publish the change
+    Returns the delta, or None if the bill isn't open or has no such item
+    '''
+    before = store.bills.assign_item(key, item_id, user_ids)
+    if not before:
+        return None
+
+    delta = {
+        "type": "assign",
+        "item_id": item_id,
+        "assigned_to": user_ids,
+        "shares": moved_shares(before["contents"], {item_id: user_ids}),
+        "version": before.get("version", 0) + 1,
+    }
+    publish(key["_id"], delta)
+    return delta
+
+
+def publish_assignments(key, before, assignments):
+    '''
+    Publish a change to several items at once as one delta
+    '''
+    delta = {
+        "type": "assign_many",
+        "items": assignments,
+        "shares": moved_shares(before["contents"], assignments),
+        "version": before.get("version", 0) + 1,
+    }
+    publish(key["_id"], delta)
+    return delta
+
+
+def assign_items(key, assignments):
+    '''
+    Apply a whole item -> members assignment matrix in one update and
+    publish it, or return None if the bill isn't open or lacks an item
+    '''
+    before = store.bills.assign_items(key, assignments)
+    if not before:
+        return None
+    return publish_assignments(key, before, assignments)
+
+
+def split_evenly(key, user_ids):
+    '''
+    Assign every item on the bill to all of `user_ids`
+    '''
+    before = store.bills.assign_all(key, user_ids)
+    if not before:
+        return None
+    return publish_assignments(key, before, {
+        item["_id"]: user_ids for item in before["contents"]
+    })
+
+
+def claim_unassigned(key, user_id):
+    '''
+    Assign every item nobody has taken yet to `user_id`
+    '''
+    before = store.bills.assign_unassigned(key, [user_id])
+    if not before:
+        return None
+    return publish_assignments(key, before, {
+        item["_id"]: [user_id] for item in before["contents"]
+        if not item.get("assigned_to")
+    })
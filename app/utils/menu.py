@@ -0,0 +1,53 @@
+'''
+menu search
+
+Vendors with large catalogs find items by typing rather than scrolling.
+Whole words in the query go to the text index on name and description,
+and the last word, while it is still being typed, is matched as the start
+of a word, so results narrow with every keystroke. Results come a page at a
+time, with per-category counts for the category filter.
+'''
+from app.storage import store
+
+PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+
+def parse_query(query):
+    '''
+    Split a search box value into whole words and the word being typed
+    "chicken wr" -> (['chicken'], 'wr'), "chicken " -> (['chicken'], None)
+    '''
+    words = query.split()
+    if not words or query[-1].isspace():
+        return words, None
+    return words[:-1], words[-1]
+
+
+def search_menu(vendor_id, query='', category=None, page=1,
+                per_page=PAGE_SIZE):
+    page = max(page, 1)
+    per_page = min(max(per_page, 1), MAX_PAGE_SIZE)
+    words, prefix = parse_query(query)
+    result = store.menu.search(
+        vendor_id, words=words, prefix=prefix, category=category or None,
+        skip=(page - 1) * per_page, limit=per_page
+    )
+    result['page'] = page
+    result['per_page'] = per_page
+    result['has_more'] = page * per_page < result['total']
+    return result
+
+
+def item_json(item):
+    '''
+    What the add-to-bill page needs to show an item, prices in cents
+    '''
+    return {
+        'id': str(item['_id']),
+        'name': item['name'],
+        'description': item.get('description', ''),
+        'category': item.get('category', 'Other'),
+        'price': item['price'],
+        'available': item.get('available', True),
+    }
@@ -0,0 +1,165 @@
+'''
+integer-cent money helpers
+
+Every amount (menu prices, bill subtotals, paid totals, payments) is stored
+as an integer number of cents. Shares are split with largest-remainder
+allocation, so the shares of a bill always add up to its total exactly.
+'''
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+from app import TAX_RATE, mongo
+from app.storage.jobs import mongo_only
+
+
+def to_cents(value):
+    '''
+    Parse a dollar amount like "10.10" into cents
+    Raises ValueError on anything that isn't a number
+    '''
+    try:
+        dollars = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount: {value!r}")
+    if not dollars.is_finite():
+        raise ValueError(f"Invalid amount: {value!r}")
+    return int((dollars * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def format_cents(cents):
+    '''
+    Format cents as dollars without going through floats, e.g. 1010 -> 10.10
+    '''
+    sign = '-' if cents < 0 else ''
+    whole, part = divmod(abs(int(cents)), 100)
+    return f"{sign}{whole}.{part:02d}"
+
+
+def tax_cents(subtotal, rate=TAX_RATE):
+    '''
+    Tax on a subtotal, rounded half up to the cent
+    '''
+    return int(
+        (Decimal(subtotal) * Decimal(rate) / 100)
+        .quantize(Decimal(1), rounding=ROUND_HALF_UP)
+    )
+
+
+def total_cents(subtotal, rate=TAX_RATE):
+    '''
+    Subtotal plus tax
+    '''
+    return subtotal + tax_cents(subtotal, rate)
+
+
+def allocate(total, weights):
+    '''
+    Split `total` cents in proportion to `weights` using largest
+    remainders, ties going to the earliest weight. The parts always
+    sum to `total`.
+    '''
+    weight_sum = sum(weights)
+    if not weight_sum:
+        return [0] * len(weights)
+
+    parts = [total * weight // weight_sum for weight in weights]
+    remainders = [total * weight % weight_sum for weight in weights]
+    leftover = total - sum(parts)
+    order = sorted(range(len(weights)), key=lambda i: (-remainders[i], i))
+    for i in order[:leftover]:
+        parts[i] += 1
+    return parts
+
+
+def line_total(item):
+    '''
+    Price times quantity of a bill line item
+    '''
+    return item["price"] * item["quantity"]
+
+
+def bill_shares(contents, rate=TAX_RATE):
+    '''
+    What each assigned diner owes, tax included, in cents
+
+    Each item is split evenly between its assignees, then the bill total is
+    allocated in proportion to those subtotals. Unassigned items keep their
+    part of the total, so once everything is assigned the shares add up to
+    exactly total_cents(subtotal).
+    '''
+    subtotals = {}
+    unassigned = 0
+    for item in contents:
+        assigned = item.get("assigned_to") or []
+        if not assigned:
+            unassigned += line_total(item)
+            continue
+        parts = allocate(line_total(item), [1] * len(assigned))
+        for user_id, part in zip(assigned, parts):
+            subtotals[user_id] = subtotals.get(user_id, 0) + part
+
+    users = list(subtotals)
+    weights = [subtotals[user_id] for user_id in users] + [unassigned]
+    amounts = allocate(total_cents(sum(weights), rate), weights)
+    return dict(zip(users, amounts))
+
+
+def total_expr(field, rate=TAX_RATE):
+    '''
+    Aggregation expression for total_cents of a non-negative integer-cent
+    field, matching tax_cents' half-up rounding for whole-number rates
+    '''
+    tax = {'$floor': {'$divide': [
+        {'$add': [{'$multiply': [field, rate]}, 50]}, 100
+    ]}}
+    return {'$add': [field, tax]}
+
+
+def cents_expr(field):
+    '''
+    Aggregation expression converting a float dollar field to cents,
+    leaving fields that are already integers alone
+    '''
+    return {'$cond': [
+        {'$eq': [{'$type': field}, 'double']},
+        {'$toLong': {'$round': [{'$multiply': [field, 100]}, 0]}},
+        field
+    ]}
+
+
+@mongo_only
+def migrate_to_cents():
+    '''
+    Convert documents written with float dollars to integer cents
+    Safe to re-run, converted fields are skipped
+    '''
+    is_float = {'$type': 'double'}
+    mongo.db.menu_items.update_many(
+        {'price': is_float}, [{'$set': {'price': cents_expr('$price')}}]
+    )
+    mongo.db.payments.update_many(
+        {'amount': is_float}, [{'$set': {'amount': cents_expr('$amount')}}]
+    )
+    mongo.db.bills.update_many(
+        {'$or': [
+            {'subtotal': is_float},
+            {'paid': is_float},
+            {'contents.price': is_float},
+            {'contents.quantity': is_float},
+        ]},
+        [{'$set': {
+            'subtotal': cents_expr('$subtotal'),
+            'paid': cents_expr('$paid'),
+            'contents': {'$map': {
+                'input': '$contents',
+                'as': 'item',
+                'in': {'$mergeObjects': ['$$item', {
+                    'price': cents_expr('$$item.price'),
+                    'quantity': {'$toInt': '$$item.quantity'},
+                }]}
+            }},
+            'version': {'$add': [{'$ifNull': ['$version', 0]}, 1]},
+        }}]
+    )
+    # Rollups were summed in dollars, rebuild them from scratch
+    mongo.db.daily_revenue.drop()
+    mongo.db.rollup_state.delete_many({})
@@ -0,0 +1,346 @@
+'''
+on-demand stack-sampling profiler for single requests
+
+A request is profiled when it carries a valid signed `X-Profile` header
+(mint one with `flask profile-token`) or is picked at PROFILE_SAMPLE_RATE.
+A background thread samples the request thread's stack every
+PROFILE_INTERVAL seconds, and when the request ends the samples are written
+to PROFILE_DIR as `<endpoint>-<time>-<id>.folded` (collapsed stacks, one
+`frame;frame;frame count` line per stack) and a matching flamegraph `.svg`.
+
+Sampling and writing are paid for out of an overhead budget that refills
+at PROFILE_OVERHEAD seconds per second of wall time. An empty budget stops
+new profiles from starting and cuts running ones short, so the profiler
+can stay on in production at a low sample rate.
+'''
+import html
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+
+from flask import g, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from app import app, basedir
+
+HEADER = 'X-Profile'
+TOKEN_SALT = 'request-profile'
+# Endpoints only worth profiling when someone asks for them
+SKIP_SAMPLED = {'static', 'asset'}
+# Seconds of profiling overhead that can build up while idle
+BUDGET_BURST = 1.0
+
+FLAME_WIDTH = 1200
+FRAME_HEIGHT = 16
+# Frames narrower than this many pixels are left out of the SVG
+MIN_FRAME_WIDTH = 0.5
+
+
+def token_serializer():
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt=TOKEN_SALT)
+
+
+def profile_token(note=''):
+    '''
+    Signed value for the X-Profile header, good for PROFILE_TOKEN_MAX_AGE
+    '''
+    return token_serializer().dumps({'note': note})
+
+
+def requested():
+    '''
+    Whether the request carries a valid, unexpired X-Profile token
+    '''
+    token = request.headers.get(HEADER)
+    if not token:
+        return False
+    try:
+        token_serializer().loads(
+            token, max_age=app.config['PROFILE_TOKEN_MAX_AGE']
+        )
+    except BadSignature:
+        return False
+    return True
+
+
+@lru_cache(maxsize=4096)
+def frame_label(code):
+    '''
+    `function (path:line)` for a code object, paths relative to the repo
+    '''
+    path = code.co_filename
+    if path.startswith(str(basedir)):
+        path = os.path.relpath(path, basedir)
+    else:
+        path = os.path.join(*path.split(os.sep)[-2:])
+    # ';' separates frames in the collapsed format
+    return f"{code.co_name} ({path}:{code.co_firstlineno})".replace(';', ':')
+
+
+class OverheadBudget:
+    '''
+    Token bucket of profiler CPU time, refilled at `rate` seconds per second
+    '''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.available = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(
+            self.burst, self.available + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def has_room(self):
+        with self.lock:
+            self._refill()
+            return self.available > 0
+
+    def charge(self, seconds):
+        '''
+        Spend overhead, returning whether any budget is left afterwards
+        '''
+        with self.lock:
+            self._refill()
+            self.available -= seconds
+            return self.available > 0
+
+
+class Sampler:
+    '''
+    Samples one thread's stack on a background thread until stopped
+    '''
+    def __init__(self, thread_id, interval, max_duration, budget):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_duration = max_duration
+        self.budget = budget
+        self.stacks = {}
+        self.truncated = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name='profiler', daemon=True
+        )
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            began = time.perf_counter()
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            stack = ';'.join(reversed(labels))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            del frame, labels
+
+            out_of_budget = not self.budget.charge(
+                time.perf_counter() - began
+            )
+            too_long = time.monotonic() - self.started > self.max_duration
+            if out_of_budget or too_long:
+                self.truncated = True
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.elapsed = time.monotonic() - self.started
+
+
+def collapsed(stacks):
+    '''
+    Lines of the collapsed-stack format read by flamegraph.pl, speedscope
+    and friends
+    '''
+    for stack, count in sorted(stacks.items()):
+        yield f"{stack} {count}\n"
+
+
+def flamegraph(stacks, title):
+    '''
+    Render collapsed stacks as a standalone flamegraph SVG
+    '''
+    root = {'count': 0, 'children': {}}
+    for stack, count in stacks.items():
+        node = root
+        node['count'] += count
+        for name in stack.split(';'):
+            node = node['children'].setdefault(
+                name, {'count': 0, 'children': {}}
+            )
+            node['count'] += count
+
+    total = root['count'] or 1
+    scale = FLAME_WIDTH / total
+    rects = []
+    depth = 0
+
+    def walk(children, x, level):
+        nonlocal depth
+        for name in sorted(children):
+            node = children[name]
+            width = node['count'] * scale
+            if width >= MIN_FRAME_WIDTH:
+                depth = max(depth, level)
+                rects.append((name, node['count'], x, level, width))
+                walk(node['children'], x, level + 1)
+            x += width
+
+    walk(root['children'], 0.0, 0)
+
+    header = 2 * FRAME_HEIGHT
+    height = header + (depth + 1) * FRAME_HEIGHT
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{FLAME_WIDTH}" '
+        f'height="{height}" font-family="monospace" font-size="11">',
+        f'<text x="4" y="{FRAME_HEIGHT}">{html.escape(title)}</text>',
+    ]
+    for name, count, x, level, width in rects:
+        y = height - (level + 1) * FRAME_HEIGHT
+        hue = zlib.crc32(name.encode()) % 55
+        label = html.escape(name)
+        parts.append(
+            f'<g><title>{label} ({count} samples, '
+            f'{100 * count / total:.1f}%)</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{width:.1f}" '
+            f'height="{FRAME_HEIGHT - 1}" fill="hsl({hue},85%,60%)"/>'
+        )
+        chars = int(width // 7)
+        if chars >= 3:
+            text = name if len(name) <= chars else name[:chars - 2] + '..'
+            parts.append(
+                f'<text x="{x + 2:.1f}" y="{y + FRAME_HEIGHT - 4}">'
+                f'{html.escape(text)}</text>'
+            )
+        parts.append('</g>')
+    parts.append('</svg>\n')
+    return '\n'.join(parts)
+
+
+class RequestProfiler:
+    '''
+    Decides which requests to profile and writes out their samples
+    '''
+    def __init__(self, output_dir, sample_rate, interval, max_duration,
+                 overhead):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_duration = max_duration
+        self.budget = OverheadBudget(overhead, BUDGET_BURST)
+        # Writing happens off the request thread, one profile at a time
+        self.writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='profile-writer'
+        )
+        self.lock = threading.Lock()
+        self.counts = {'profiled': 0, 'skipped_budget': 0, 'truncated': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def wanted(self):
+        if requested():
+            return True
+        return (
+            self.sample_rate > 0
+            and request.endpoint not in SKIP_SAMPLED
+            and random.random() < self.sample_rate
+        )
+
+    def start(self):
+        '''
+        Start sampling the current request if it should be profiled
+        '''
+        if not self.wanted():
+            return
+        if not self.budget.has_room():
+            self.count('skipped_budget')
+            return
+        g.profile_id = '-'.join((
+            request.endpoint or 'unmatched',
+            datetime.now().strftime('%Y%m%dT%H%M%S'),
+            uuid.uuid4().hex[:6],
+        ))
+        g.profile_sampler = Sampler(
+            threading.get_ident(), self.interval, self.max_duration,
+            self.budget
+        )
+        g.profile_sampler.start()
+
+    def finish(self):
+        sampler = g.pop('profile_sampler', None)
+        if sampler is None:
+            return
+        sampler.stop()
+        self.count('profiled')
+        if sampler.truncated:
+            self.count('truncated')
+        title = (
+            f"{request.method} {request.path} - {sampler.elapsed * 1000:.0f}"
+            f" ms, {sum(sampler.stacks.values())} samples"
+            + (' (truncated)' if sampler.truncated else '')
+        )
+        self.writer.submit(self.write, g.profile_id, sampler.stacks, title)
+
+    def write(self, profile_id, stacks, title):
+        began = time.perf_counter()
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, profile_id)
+        with open(path + '.folded', 'w') as output:
+            output.writelines(collapsed(stacks))
+        with open(path + '.svg', 'w') as output:
+            output.write(flamegraph(stacks, title))
+        self.budget.charge(time.perf_counter() - began)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                **self.counts,
+                'sample_rate': self.sample_rate,
+                'budget_seconds': round(self.budget.available, 4),
+            }
+
+
+profiler = RequestProfiler(
+    output_dir=app.config['PROFILE_DIR'],
+    sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+    interval=app.config['PROFILE_INTERVAL'],
+    max_duration=app.config['PROFILE_MAX_DURATION'],
+    overhead=app.config['PROFILE_OVERHEAD'],
+)
+
+
+@app.before_request
+def start_profile():
+    profiler.start()
+
+
+@app.after_request
+def tag_profile(response):
+    if 'profile_id' in g:
+        response.headers['X-Profile-Id'] = g.profile_id
+    return response
+
+
+@app.teardown_request
+def finish_profile(exc):
+    profiler.finish()
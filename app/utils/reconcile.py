@@ -0,0 +1,104 @@
+'''
+subtotal reconciliation
+
+`bill.subtotal` is kept with $inc as items are added and removed, so a bad
+amount on either path leaves it out of step with the bill's contents for
+good. `reconcile_subtotals` recomputes it from the contents of every
+unsettled bill in one aggregation and writes the corrections back with
+bulk_write, RECONCILE_BATCH_SIZE at a time.
+
+Every write to a bill's contents sets `needs_reconcile`, and a run only
+reads flagged bills through a partial index on the flag, so a bill nobody
+touched is not looked at again however many bills there are. Checking a
+bill clears the flag; settled and voided bills have theirs cleared
+without being corrected. The write is conditional on the version the
+aggregation saw, so a bill changed in between keeps its flag for the next
+run. `every=True` checks all unsettled bills, for bills written before the
+flag existed.
+'''
+from pymongo import UpdateOne
+
+from app import mongo
+from app.models import Bill
+from app.storage.jobs import mongo_only
+from app.storage.mongo import ensure_indexes
+
+RECONCILE_BATCH_SIZE = 1000
+
+
+def drifted_bills(batch_size=RECONCILE_BATCH_SIZE, every=False):
+    '''
+    Bills whose contents changed since they were last reconciled (every
+    unsettled bill with `every`), with their stored subtotal and the one
+    their contents add up to
+    '''
+    if every:
+        match = {"status": {"$in": list(Bill.UNSETTLED)}}
+    else:
+        match = {"needs_reconcile": True}
+    return mongo.db.bills.aggregate([
+        {"$match": match},
+        {"$project": {
+            "vendor_id": 1,
+            "table_number": 1,
+            "status": 1,
+            "version": {"$ifNull": ["$version", 0]},
+            "subtotal": {"$ifNull": ["$subtotal", 0]},
+            "computed": {"$sum": {"$map": {
+                "input": {"$ifNull": ["$contents", []]},
+                "as": "item",
+                "in": {"$multiply": ["$$item.price", "$$item.quantity"]}
+            }}}
+        }}
+    ], batchSize=batch_size)
+
+
+@mongo_only
+def reconcile_subtotals(batch_size=RECONCILE_BATCH_SIZE, dry_run=False,
+                        every=False):
+    '''
+    Correct the subtotal of every flagged unsettled bill (every unsettled
+    bill with `every`) that doesn't match its contents, and clear the flag
+    Returns (number of bills checked, the drifted ones as dicts with
+    bill_id, vendor_id, table_number, subtotal, computed and drift)
+    '''
+    ensure_indexes()
+    checked = 0
+    report = []
+    writes = []
+    for bill in drifted_bills(batch_size, every):
+        key = {
+            "vendor_id": bill["vendor_id"], "_id": bill["_id"],
+            "version": bill["version"]
+        }
+        update = {"$unset": {"needs_reconcile": ""}}
+        # Closed bills are history, what was charged stands
+        if bill.get("status") in Bill.UNSETTLED:
+            checked += 1
+            drift = bill["subtotal"] - bill["computed"]
+            if drift:
+                report.append({
+                    "bill_id": str(bill["_id"]),
+                    "vendor_id": bill["vendor_id"],
+                    "table_number": bill.get("table_number"),
+                    "subtotal": bill["subtotal"],
+                    "computed": bill["computed"],
+                    "drift": drift
+                })
+                # A new subtotal is a new version, so cached copies refresh
+                update["$set"] = {
+                    "subtotal": bill["computed"],
+                    "version": bill["version"] + 1
+                }
+        writes.append(UpdateOne(key, update))
+
+        if len(writes) == batch_size:
+            flush(writes, dry_run)
+            writes = []
+    flush(writes, dry_run)
+    return checked, report
+
+
+def flush(writes, dry_run):
+    if writes and not dry_run:
+        mongo.db.bills.bulk_write(writes, ordered=False)
@@ -0,0 +1,136 @@
+'''
+materialized per-vendor, per-day revenue rollups
+
+`rollup_daily_revenue` aggregates settled bills into the `daily_revenue`
+collection with `$merge`. It resumes from the high-water mark stored in
+`rollup_state` and recomputes whole days from the start of the day that
+mark falls in, so re-running it after a crash never double counts.
+'''
+from datetime import datetime, timedelta
+
+import pytz
+
+from app import TAX_RATE, mongo
+from app.models import Bill
+from app.storage import store
+from app.storage.jobs import mongo_only
+from app.storage.mongo import ensure_indexes
+
+ROLLUP_ID = 'daily_revenue'
+TIMEZONE = pytz.timezone('US/Eastern')
+# Leave recently settled bills for the next run so a write that lands
+# with a slightly older completed_at is never skipped
+ROLLUP_LAG = timedelta(seconds=30)
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def day_key(when):
+    '''
+    Local calendar day a timestamp falls in, e.g. 2025-10-20
+    '''
+    return when.astimezone(TIMEZONE).strftime('%Y-%m-%d')
+
+
+def rollup_id(vendor_id, day):
+    '''
+    _id of a vendor's daily_revenue document
+    '''
+    return f"{vendor_id}:{day}"
+
+
+def start_of_day(when):
+    '''
+    Local midnight of the day `when` falls in
+    '''
+    local = when.astimezone(TIMEZONE)
+    return TIMEZONE.localize(
+        datetime(local.year, local.month, local.day)
+    )
+
+
+def rollup_pipeline(start, end):
+    '''
+    Aggregate bills completed in [start, end] and merge the
+    per-vendor, per-day totals into daily_revenue
+    '''
+    day = {'$dateToString': {
+        'format': '%Y-%m-%d', 'date': '$completed_at',
+        'timezone': str(TIMEZONE)
+    }}
+    # Per-bill tax in integer cents, rounded half up like tax_cents()
+    tax = {'$toLong': {'$floor': {'$divide': [
+        {'$add': [{'$multiply': ['$subtotal', TAX_RATE]}, 50]}, 100
+    ]}}}
+    # Distinct diners who had at least one item assigned to them
+    party = {'$size': {'$setUnion': [{'$reduce': {
+        'input': '$contents.assigned_to',
+        'initialValue': [],
+        'in': {'$concatArrays': ['$$value', '$$this']}
+    }}, []]}}
+
+    return [
+        {'$match': {
+            'status': Bill.SETTLED,
+            'completed_at': {'$gte': start, '$lte': end}
+        }},
+        {'$project': {
+            'vendor_id': 1,
+            'day': day,
+            'subtotal': 1,
+            'tax': tax,
+            'party_size': party,
+            'items_sold': {'$sum': '$contents.quantity'},
+        }},
+        {'$group': {
+            '_id': {'$concat': ['$vendor_id', ':', '$day']},
+            'vendor_id': {'$first': '$vendor_id'},
+            'day': {'$first': '$day'},
+            'bills': {'$sum': 1},
+            'subtotal': {'$sum': '$subtotal'},
+            'tax': {'$sum': '$tax'},
+            'items_sold': {'$sum': '$items_sold'},
+            'avg_party_size': {'$avg': '$party_size'},
+        }},
+        {'$set': {
+            'revenue': {'$add': ['$subtotal', '$tax']},
+            'updated_at': '$$NOW',
+        }},
+        {'$merge': {
+            'into': 'daily_revenue',
+            'on': '_id',
+            'whenMatched': 'replace',
+            'whenNotMatched': 'insert',
+        }},
+    ]
+
+
+@mongo_only
+def rollup_daily_revenue(now=None):
+    '''
+    Bring daily_revenue up to date and advance the high-water mark
+    Returns the (start, end) window that was aggregated
+    '''
+    ensure_indexes()
+    now = now or datetime.now(pytz.utc)
+    state = mongo.db.rollup_state.find_one({'_id': ROLLUP_ID}) or {}
+    high_water = state.get('high_water', EPOCH)
+    if high_water.tzinfo is None:
+        high_water = pytz.utc.localize(high_water)
+
+    start = start_of_day(high_water)
+    end = now - ROLLUP_LAG
+    mongo.db.bills.aggregate(rollup_pipeline(start, end))
+
+    mongo.db.rollup_state.update_one(
+        {'_id': ROLLUP_ID}, {'$set': {'high_water': end}}, upsert=True
+    )
+    return start, end
+
+
+def todays_revenue(vendor_id):
+    '''
+    Today's pre-aggregated totals for a vendor, or None before the
+    first completed bill of the day has been rolled up
+    '''
+    today = day_key(datetime.now(pytz.utc))
+    return store.revenue.get(rollup_id(vendor_id, today))
@@ -0,0 +1,427 @@
+'''
+synthetic data for scaling tests
+
+`seed` fills a database with vendors, customers, menus, groups and bills
+shaped like the ones the app writes itself, so the dashboards, code joins
+and membership checks can be tried at production sizes. Every document is
+derived from (seed, kind, index) alone, so worker processes each generate
+and insert_many their own slices and still agree on who is in which group
+and which bill a group is on. Ids are ObjectIds built from the index, and
+codes are the index mapped one-to-one onto the code space with a check
+character added, so they are unique without retries. Seed into an empty
+database, codes already in use would be rejected by the unique indexes.
+
+Bills go to vendors with Zipf weights (`vendor_skew`, 0 for uniform), so a
+few vendors are very busy, and a `large_group_rate` share of groups have
+`large_group_size` members. The most recent `open_fraction` of bills are
+open, one per group, and the rest are settled with their payments.
+'''
+import multiprocessing
+import random
+import time
+import uuid
+from bisect import bisect
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import accumulate
+
+import pytz
+from bson import ObjectId
+from pymongo import MongoClient
+from werkzeug.security import generate_password_hash
+
+from app import app, mongo
+from app.models import Bill
+from app.storage.jobs import mongo_only
+from app.storage.mongo import ensure_indexes
+from app.utils.code_generator import ALPHABET, CODE_LENGTH, check_character
+from app.utils.money import bill_shares, total_cents
+
+SEED_BATCH_SIZE = 1000
+# Documents one worker task generates before handing back its counts
+SEED_CHUNK_SIZE = 20000
+
+VENDOR, CUSTOMER, MENU_ITEM, GROUP, BILL = range(1, 6)
+CATEGORIES = ['Starters', 'Mains', 'Sides', 'Desserts', 'Drinks']
+DISHES = {
+    'Starters': ['Soup', 'Salad', 'Wings', 'Bruschetta', 'Dumplings'],
+    'Mains': ['Burger', 'Steak', 'Pasta', 'Curry', 'Tacos', 'Risotto'],
+    'Sides': ['Fries', 'Rice', 'Slaw', 'Greens', 'Bread'],
+    'Desserts': ['Cake', 'Pie', 'Sundae', 'Tart', 'Mousse'],
+    'Drinks': ['Soda', 'Lemonade', 'Coffee', 'Tea', 'Beer', 'Wine'],
+}
+STYLES = ['House', 'Spicy', 'Classic', 'Garden', 'Smoked', 'Grilled']
+PRICE_RANGES = {
+    'Starters': (500, 1400), 'Mains': (1200, 3800), 'Sides': (300, 800),
+    'Desserts': (500, 1200), 'Drinks': (200, 1100),
+}
+# Stride of the walk over the code space, coprime to its size
+CODE_STRIDE = 1000003
+
+
+@dataclass(frozen=True)
+class Scale:
+    '''
+    How much to generate and how skewed it is
+    '''
+    vendors: int = 100
+    customers: int = 2000
+    groups: int = 500
+    bills: int = 20000
+    menu_size: int = 40
+    items_per_bill: int = 6
+    open_fraction: float = 0.02
+    vendor_skew: float = 1.1
+    large_group_rate: float = 0.001
+    large_group_size: int = 500
+    days: int = 365
+    seed: int = 0
+    password_hash: str = ''
+    # Epoch seconds the history ends at, the same in every worker
+    now: float = 0.0
+
+    @property
+    def open_bills(self):
+        return min(round(self.bills * self.open_fraction), self.groups)
+
+    @property
+    def first_open(self):
+        return self.bills - self.open_bills
+
+
+def object_id(kind, index, created):
+    '''
+    ObjectId for the `index`th document of `kind`, timestamped `created`
+    '''
+    return ObjectId(
+        int(created).to_bytes(4, 'big') + bytes([kind])
+        + index.to_bytes(7, 'big')
+    )
+
+
+def rng(scale, kind, index):
+    return random.Random(f"{scale.seed}:{kind}:{index}")
+
+
+def code_for(index):
+    '''
+    The `index`th code of a walk that visits every code once
+    '''
+    space = len(ALPHABET) ** (CODE_LENGTH - 1)
+    value = (index * CODE_STRIDE + 7) % space
+    body = ''
+    for _ in range(CODE_LENGTH - 1):
+        value, digit = divmod(value, len(ALPHABET))
+        body += ALPHABET[digit]
+    return body + check_character(body)
+
+
+def started(scale):
+    return scale.now - scale.days * 86400
+
+
+def user_id(scale, kind, index):
+    return str(object_id(kind, index, started(scale)))
+
+
+def user_docs(scale, kind, start, stop):
+    for index in range(start, stop):
+        _id = object_id(kind, index, started(scale))
+        if kind == VENDOR:
+            yield {
+                '_id': _id,
+                'username': f"vendor{index}",
+                'email': f"vendor{index}@seed.example",
+                'password_hash': scale.password_hash,
+                'user_type': 'vendor',
+                'vendor_name': f"Kitchen {index}",
+            }
+        else:
+            yield {
+                '_id': _id,
+                'username': f"customer{index}",
+                'email': f"customer{index}@seed.example",
+                'password_hash': scale.password_hash,
+                'user_type': 'customer',
+                'payment_methods': [],
+            }
+
+
+@lru_cache(maxsize=256)
+def menu(scale, vendor):
+    '''
+    A vendor's menu items, the same every time for the same vendor
+    '''
+    draw = rng(scale, MENU_ITEM, vendor)
+    vendor_id = user_id(scale, VENDOR, vendor)
+    items = []
+    for number in range(scale.menu_size):
+        category = draw.choice(CATEGORIES)
+        dish = draw.choice(DISHES[category])
+        low, high = PRICE_RANGES[category]
+        items.append({
+            '_id': object_id(
+                MENU_ITEM, vendor * scale.menu_size + number, started(scale)
+            ),
+            'vendor_id': vendor_id,
+            'name': f"{draw.choice(STYLES)} {dish} {number}",
+            'price': draw.randrange(low, high, 5),
+            'description': f"{dish.lower()} made the {category.lower()} way",
+            'category': category,
+            'available': True,
+        })
+    return items
+
+
+@lru_cache(maxsize=1)
+def vendor_weights(scale):
+    return list(accumulate(
+        1 / (rank + 1) ** scale.vendor_skew for rank in range(scale.vendors)
+    ))
+
+
+@lru_cache(maxsize=4096)
+def group_members(scale, group):
+    '''
+    Customer indexes in a group, its creator first
+    '''
+    draw = rng(scale, GROUP, group)
+    if draw.random() < scale.large_group_rate:
+        size = scale.large_group_size
+    else:
+        size = draw.randint(2, 6)
+    return tuple(draw.sample(range(scale.customers),
+                             min(size, scale.customers)))
+
+
+def group_docs(scale, start, stop):
+    span = scale.days * 86400
+    for group in range(start, stop):
+        members = [user_id(scale, CUSTOMER, c)
+                   for c in group_members(scale, group)]
+        created = started(scale) + span * group / scale.groups
+        last_active = created
+        active_bill_id = None
+        if group < scale.open_bills:
+            active_bill_id = bill_id(scale, scale.first_open + group)
+            # Attaching its open bill is the group's latest activity
+            last_active = bill_created(scale, scale.first_open + group)
+        yield {
+            '_id': object_id(GROUP, group, created),
+            'name': f"Group {group}",
+            'creator_id': members[0],
+            'members': members,
+            'active_bill_id': active_bill_id,
+            'active': True,
+            'created_at': None,
+            'last_active_at': datetime.fromtimestamp(last_active, pytz.utc),
+            'version': 0,
+            'code': code_for(group),
+        }
+
+
+def bill_created(scale, bill):
+    if bill >= scale.first_open:
+        # Open bills are from the last hour, so the sweeper leaves them be
+        return scale.now - 3600 * (scale.bills - bill) / scale.open_bills
+    return started(scale) + scale.days * 86400 * bill / scale.first_open
+
+
+def bill_id(scale, bill):
+    return object_id(BILL, bill, bill_created(scale, bill))
+
+
+def bill_docs(scale, start, stop):
+    '''
+    Bills with their directory entries and, once settled, payments
+    '''
+    weights = vendor_weights(scale)
+    for bill in range(start, stop):
+        draw = rng(scale, BILL, bill)
+        vendor = bisect(weights, draw.random() * weights[-1])
+        vendor = min(vendor, scale.vendors - 1)
+        vendor_id = user_id(scale, VENDOR, vendor)
+        is_open = bill >= scale.first_open
+        group = (bill - scale.first_open if is_open
+                 else draw.randrange(scale.groups))
+        usernames = {
+            user_id(scale, CUSTOMER, c): f"customer{c}"
+            for c in group_members(scale, group)
+        }
+        members = list(usernames)
+        _id = bill_id(scale, bill)
+        created = datetime.fromtimestamp(bill_created(scale, bill), pytz.utc)
+
+        contents = []
+        for _ in range(draw.randint(1, 2 * scale.items_per_bill - 1)):
+            item = draw.choice(menu(scale, vendor))
+            # Settled bills were split in full, open ones only partly
+            assigned_to = []
+            if not is_open or draw.random() < 0.5:
+                assigned_to = draw.sample(
+                    members, 1 if draw.random() < 0.8
+                    else draw.randint(1, len(members))
+                )
+            contents.append({
+                '_id': str(uuid.UUID(int=draw.getrandbits(128), version=4)),
+                'item_id': str(item['_id']),
+                'name': item['name'],
+                'price': item['price'],
+                'quantity': draw.choice((1, 1, 1, 2, 2, 3)),
+                'bill_id': str(_id),
+                'assigned_to': assigned_to,
+            })
+        subtotal = sum(item['price'] * item['quantity'] for item in contents)
+        completed = created + timedelta(minutes=draw.randint(20, 150))
+
+        doc = {
+            '_id': _id,
+            'vendor_id': vendor_id,
+            'table_number': str(draw.randint(1, 40)),
+            'contents': contents,
+            'subtotal': subtotal,
+            'status': Bill.OPEN if is_open else Bill.SETTLED,
+            'paid': 0 if is_open else total_cents(subtotal),
+            'members': members,
+            'version': len(contents) * 2,
+            'session_code': code_for(bill),
+            'created_at': created,
+        }
+        entry = {'_id': _id, 'vendor_id': vendor_id}
+        payments = []
+        if is_open:
+            entry['session_code'] = doc['session_code']
+        else:
+            doc['completed_at'] = completed
+            payments = list(
+                payment_docs(_id, contents, completed, usernames)
+            )
+        yield doc, entry, payments
+
+
+def payment_docs(bill_id, contents, completed, usernames):
+    for member, amount in bill_shares(contents).items():
+        if not amount:
+            continue
+        yield {
+            'bill_id': bill_id,
+            'user_id': member,
+            'username': usernames[member],
+            'amount': amount,
+            'status': 'completed',
+            'payment_method': {'type': 'card', 'last_four': '4242'},
+            'items_paid': [
+                item['_id'] for item in contents
+                if member in item['assigned_to']
+            ],
+            'completed_at': completed,
+        }
+
+
+def tasks(scale):
+    '''
+    (kind, start, stop) slices covering everything to generate
+    '''
+    sizes = [(VENDOR, scale.vendors), (CUSTOMER, scale.customers),
+             (MENU_ITEM, scale.vendors), (GROUP, scale.groups),
+             (BILL, scale.bills)]
+    for kind, total in sizes:
+        # Menus are generated a vendor at a time
+        step = max(1, SEED_CHUNK_SIZE // (
+            scale.menu_size if kind == MENU_ITEM else 1
+        ))
+        for start in range(0, total, step):
+            yield kind, start, min(start + step, total)
+
+
+def seed_slice(scale, kind, start, stop, batch_size, db=None):
+    '''
+    Generate and insert one slice, returning documents inserted per
+    collection
+    '''
+    if db is None:
+        # Runs in a fresh process, with a client of its own
+        db = MongoClient(app.config['MONGO_URI']).get_default_database()
+    counts = {}
+    batches = {}
+
+    def add(collection, doc):
+        batch = batches.setdefault(collection, [])
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            flush(collection)
+
+    def flush(collection):
+        batch = batches.pop(collection, None)
+        if batch:
+            db[collection].insert_many(batch, ordered=False)
+            counts[collection] = counts.get(collection, 0) + len(batch)
+
+    if kind in (VENDOR, CUSTOMER):
+        for doc in user_docs(scale, kind, start, stop):
+            add('users', doc)
+    elif kind == MENU_ITEM:
+        for vendor in range(start, stop):
+            for item in menu(scale, vendor):
+                add('menu_items', item)
+    elif kind == GROUP:
+        for doc in group_docs(scale, start, stop):
+            add('groups', doc)
+            add('group_codes', {'_id': doc['code'], 'group_id': doc['_id']})
+    else:
+        for doc, entry, payments in bill_docs(scale, start, stop):
+            add('bills', doc)
+            add('bill_directory', entry)
+            for payment in payments:
+                add('payments', payment)
+
+    for collection in list(batches):
+        flush(collection)
+    return counts
+
+
+@mongo_only
+def seed(scale, password, workers=1, batch_size=SEED_BATCH_SIZE,
+         progress=None):
+    '''
+    Generate `scale` worth of data with `workers` processes, calling
+    `progress(counts)` as slices finish. Returns documents inserted per
+    collection
+    '''
+    if mongo.db.users.estimated_document_count():
+        raise ValueError("the database already has users")
+    space = len(ALPHABET) ** (CODE_LENGTH - 1)
+    if max(scale.groups, scale.bills) > space:
+        raise ValueError(f"only {space} distinct codes, use fewer")
+    if not (scale.vendors and scale.customers and scale.groups):
+        raise ValueError("need at least one vendor, customer and group")
+
+    scale = replace(
+        scale, password_hash=generate_password_hash(password), now=time.time()
+    )
+    totals = {}
+
+    def tally(counts):
+        for collection, n in counts.items():
+            totals[collection] = totals.get(collection, 0) + n
+        if progress:
+            progress(totals)
+
+    if workers <= 1:
+        for kind, start, stop in tasks(scale):
+            tally(seed_slice(scale, kind, start, stop, batch_size, mongo.db))
+    else:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(workers, mp_context=context) as executor:
+            futures = [
+                executor.submit(seed_slice, scale, *task, batch_size)
+                for task in tasks(scale)
+            ]
+            for future in as_completed(futures):
+                tally(future.result())
+
+    # Indexes are built once over the loaded data, not kept up per insert
+    ensure_indexes()
+    return totals
@@ -0,0 +1,24 @@
+'''
+Tests run against the in-memory storage backend, no MongoDB needed
+'''
+import os
+
+import pytest
+
+os.environ['STORAGE_BACKEND'] = 'memory'
+os.environ.setdefault('SECRET_KEY', 'test')
+os.environ.setdefault(
+    'MONGO_URI', 'mongodb://localhost:1/test?serverSelectionTimeoutMS=200'
+)
+
+from app import app  # noqa: E402
+
+# .env is loaded with override=True, so it can switch the backend back
+if app.config['STORAGE_BACKEND'] != 'memory':
+    pytest.exit('tests need STORAGE_BACKEND=memory, remove it from .env')
+
+
+@pytest.fixture
+def request_context():
+    with app.test_request_context():
+        yield
@@ -0,0 +1,73 @@
+import uuid
+
+import pytest
+
+from app import app
+from app.models import User
+from app.storage import store
+
+
+def client_for(user_type):
+    '''
+    A test client logged in through the API as a new user
+    '''
+    email = f"{user_type}-{uuid.uuid4()}@test"
+    store.users.create(User.create_user_dict(
+        email, email, 'secret', user_type, vendor_name='Diner'
+    ))
+    client = app.test_client()
+    response = client.post(
+        '/api/v1/login', json={'email': email, 'password': 'secret'}
+    )
+    assert response.status_code == 200
+    return client
+
+
+@pytest.fixture
+def vendor():
+    return client_for('vendor')
+
+
+@pytest.fixture
+def bill_id(vendor):
+    response = vendor.post('/api/v1/bills', json={'table_number': 1})
+    return response.get_json()['id']
+
+
+@pytest.mark.parametrize('menu_item_id', [None, 7, ['x'], 'nonsense',
+                                          '0' * 24])
+def test_unknown_menu_items_are_not_found(vendor, bill_id, menu_item_id):
+    response = vendor.post(f'/api/v1/bills/{bill_id}/items',
+                           json={'menu_item_id': menu_item_id})
+    assert response.status_code == 404
+
+
+def test_body_must_be_an_object(vendor, bill_id):
+    response = vendor.post(f'/api/v1/bills/{bill_id}/items', json=['x'])
+    assert response.status_code == 400
+
+
+def test_login_rejects_non_string_credentials():
+    response = app.test_client().post(
+        '/api/v1/login', json={'email': {'$ne': None}, 'password': 1}
+    )
+    assert response.status_code == 401
+
+
+@pytest.mark.parametrize('payment', [
+    {'token': 7},
+    {'token': ['tok']},
+    {'card': {'card_number': 4242424242424242, 'expiry_date': '12/30',
+              'cardholder_name': 'Ann'}},
+    {'card': {'card_number': '4242424242424242'}},
+])
+def test_pay_rejects_malformed_cards(vendor, bill_id, payment):
+    customer = client_for('customer')
+    group = customer.post('/api/v1/groups', json={'name': 'table'})
+    group_id = group.get_json()['id']
+    code = vendor.get(f'/api/v1/bills/{bill_id}').get_json()['session_code']
+    customer.post(f'/api/v1/groups/{group_id}/bill',
+                  json={'session_code': code})
+    response = customer.post(f'/api/v1/groups/{group_id}/bill/pay',
+                             json={**payment, 'cvc': '123'})
+    assert response.status_code == 400
@@ -0,0 +1,186 @@
+import uuid
+from datetime import datetime
+
+import pytest
+import pytz
+
+from app.models import Bill, BillCharge, Group, User
+from app.payment import PaymentError, payment_gateway
+from app.storage import store
+from app.utils import actions
+from app.utils.directory import bill_key
+from app.utils.ledger import bill_payments, payment_history
+from app.utils.money import total_cents
+
+NOW = datetime(2026, 1, 1, tzinfo=pytz.utc)
+
+
+def order_item(item_id, price, assigned_to):
+    return {'_id': item_id, 'item_id': item_id, 'name': item_id,
+            'price': price, 'quantity': 1, 'assigned_to': assigned_to}
+
+
+@pytest.fixture
+def users():
+    ids = []
+    for name in ('ann', 'ben'):
+        user = {'username': name, 'email': f"{name}-{uuid.uuid4()}@test",
+                'user_type': 'customer'}
+        store.users.create(user)
+        ids.append(str(user['_id']))
+    return [store.users.get(user_id, User) for user_id in ids]
+
+
+@pytest.fixture
+def group(users):
+    group_id = actions.create_group('table', users[0].id)
+    store.groups.add_member(group_id, users[1].id)
+    return store.groups.get(group_id, Group)
+
+
+@pytest.fixture
+def key(users, group):
+    '''
+    An open bill of 10.00 for each of the two users, their group on it
+    '''
+    key = bill_key(actions.open_bill('vendor', '7'))
+    for user, item_id in zip(users, ('soup', 'salad')):
+        store.bills.add_item(key, order_item(item_id, 1000, [user.id]), 1000)
+    actions.attach_group(key, group)
+    return key
+
+
+@pytest.fixture
+def charges(monkeypatch):
+    charged = []
+
+    def make_payment(card, cvc, amount):
+        charged.append(amount)
+        return amount
+    monkeypatch.setattr(payment_gateway, 'make_payment', make_payment)
+    return charged
+
+
+def test_first_payment_moves_the_bill_to_settling(key, users):
+    state = store.bills.pay(key, users[0].id, 1080, NOW)
+    assert state['status'] == Bill.SETTLING
+    assert state['paid'] == 1080
+
+
+def test_paying_in_full_settles_the_bill(key, users):
+    store.bills.pay(key, users[0].id, 1080, NOW)
+    state = store.bills.pay(key, users[1].id, 1080, NOW)
+    assert state['status'] == Bill.SETTLED
+    assert state['paid'] == total_cents(2000)
+
+
+def test_settled_bills_take_no_more_payments(key, users):
+    store.bills.pay(key, users[0].id, total_cents(2000), NOW)
+    assert store.bills.pay(key, users[1].id, 1, NOW) is None
+
+
+def test_only_members_can_pay(key):
+    assert store.bills.pay(key, 'stranger', 1080, NOW) is None
+    assert store.bills.get(key).status == Bill.OPEN
+
+
+def test_unpay_reopens_the_bill(key, users):
+    store.bills.pay(key, users[0].id, 1080, NOW)
+    store.bills.pay(key, users[1].id, 1080, NOW)
+    state = store.bills.unpay(key, users[1].id, 1080)
+    assert state['status'] == Bill.SETTLING
+    state = store.bills.unpay(key, users[0].id, 1080)
+    assert state['status'] == Bill.OPEN
+    assert state['paid'] == 0
+
+
+def test_unpay_never_takes_paid_below_zero(key, users):
+    store.bills.pay(key, users[0].id, 100, NOW)
+    assert store.bills.unpay(key, users[0].id, 200) is None
+
+
+def test_void_only_open_unpaid_bills(key, users):
+    store.bills.pay(key, users[0].id, 100, NOW)
+    assert not actions.void_bill(key)
+    store.bills.unpay(key, users[0].id, 100)
+    assert actions.void_bill(key)
+    assert store.bills.get(key).status == Bill.VOIDED
+    assert store.bills.pay(key, users[0].id, 100, NOW) is None
+
+
+def test_void_releases_groups_and_code(key, group):
+    actions.void_bill(key)
+    assert store.groups.get(group.id).active_bill_id is None
+    assert store.directory.get(key['_id']).get('session_code') is None
+
+
+def test_pay_share_charges_the_share_and_records_it(key, users, group,
+                                                    charges):
+    bill = store.bills.for_payer(key, users[0].id, BillCharge)
+    paid, state = actions.pay_share(key, bill, users[0], 'tok', '123')
+    assert paid == 1080 and charges == [1080]
+    assert state == {'_id': key['_id'], 'status': Bill.SETTLING,
+                     'paid': 1080}
+    [payment] = bill_payments(key['_id'])
+    assert payment.amount == 1080
+    assert payment.items_paid == ['soup']
+    assert payment_history(users[0].id)[0].amount == 1080
+
+
+def test_last_share_settles_and_releases_the_group(key, users, group,
+                                                   charges):
+    for user in users:
+        bill = store.bills.for_payer(key, user.id, BillCharge)
+        paid, state = actions.pay_share(key, bill, user, 'tok', '123')
+    assert state['status'] == Bill.SETTLED
+    assert sum(p.amount for p in bill_payments(key['_id'])) == 2160
+    assert store.groups.get(group.id).active_bill_id is None
+    assert store.directory.get(key['_id']).get('session_code') is None
+
+
+def test_settling_releases_only_the_groups_on_the_bill(key, users, group,
+                                                       charges):
+    other = store.groups.get(actions.create_group('other', users[0].id))
+    actions.attach_group(key, other)
+    elsewhere = store.groups.get(actions.create_group('bar', users[1].id))
+    actions.attach_group(bill_key(actions.open_bill('vendor', '8')),
+                         elsewhere)
+
+    for user in users:
+        bill = store.bills.for_payer(key, user.id, BillCharge)
+        actions.pay_share(key, bill, user, 'tok', '123')
+    assert store.groups.get(group.id).active_bill_id is None
+    assert store.groups.get(other.id).active_bill_id is None
+    assert store.groups.get(elsewhere.id).active_bill_id is not None
+
+
+def test_failed_charge_leaves_the_bill_as_it_was(key, users, group,
+                                                 monkeypatch):
+    def decline(card, cvc, amount):
+        raise PaymentError('declined')
+    monkeypatch.setattr(payment_gateway, 'make_payment', decline)
+
+    bill = store.bills.for_payer(key, users[0].id, BillCharge)
+    with pytest.raises(PaymentError):
+        actions.pay_share(key, bill, users[0], 'tok', '123')
+    after = store.bills.get(key)
+    assert after.status == Bill.OPEN and after.paid == 0
+    assert bill_payments(key['_id']) == []
+
+
+def test_nothing_to_pay_leaves_the_bill_open(key, users, charges):
+    # ann's soup is taken off, leaving her nothing to pay for
+    store.bills.remove_item(key, 'soup', 1000)
+    bill = store.bills.for_payer(key, users[0].id, BillCharge)
+    with pytest.raises(ValueError):
+        actions.pay_share(key, bill, users[0], 'tok', '123')
+    after = store.bills.get(key)
+    assert after.status == Bill.OPEN and after.paid == 0
+    assert charges == [] and bill_payments(key['_id']) == []
+
+
+def test_closed_bill_is_not_charged(key, users, group, charges):
+    bill = store.bills.for_payer(key, users[0].id, BillCharge)
+    actions.void_bill(key)
+    assert actions.pay_share(key, bill, users[0], 'tok', '123') == (0, None)
+    assert charges == []
@@ -0,0 +1,122 @@
+import random
+
+from app.utils.code_filter import BloomFilter, CodeFilter
+from app.utils.code_generator import (ALPHABET, CODE_LENGTH, check_character,
+                                      generate_code, valid_code)
+
+
+def test_generated_codes_are_valid():
+    for _ in range(200):
+        code = generate_code()
+        assert len(code) == CODE_LENGTH
+        assert valid_code(code)
+
+
+def test_check_character_is_stable():
+    assert check_character('ABCDE') == check_character('ABCDE')
+    assert check_character('ABCDE') in ALPHABET
+
+
+def test_any_one_mistyped_character_is_caught():
+    code = generate_code()
+    for position in range(CODE_LENGTH):
+        for char in ALPHABET:
+            if char != code[position]:
+                typo = code[:position] + char + code[position + 1:]
+                assert not valid_code(typo), typo
+
+
+def test_almost_every_swap_of_neighbours_is_caught():
+    draw = random.Random(0)
+    swaps = missed = 0
+    while swaps < 5000:
+        body = ''.join(draw.choice(ALPHABET) for _ in range(CODE_LENGTH - 1))
+        code = body + check_character(body)
+        position = draw.randrange(CODE_LENGTH - 1)
+        first, second = code[position], code[position + 1]
+        if first == second:
+            continue
+        swaps += 1
+        missed += valid_code(
+            code[:position] + second + first + code[position + 2:]
+        )
+    assert missed / swaps < 0.01
+
+
+def test_malformed_codes_are_invalid():
+    code = generate_code()
+    assert not valid_code(code[:-1])
+    assert not valid_code(code + 'A')
+    assert not valid_code(code.lower())
+    assert not valid_code('')
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, 0.01)
+    codes = [generate_code() for _ in range(1000)]
+    for code in codes:
+        bloom.add(code)
+    assert all(code in bloom for code in codes)
+
+
+def test_bloom_filter_false_positive_rate():
+    bloom = BloomFilter(1000, 0.01)
+    for n in range(1000):
+        bloom.add(f"in-{n}")
+    false_positives = sum(f"out-{n}" in bloom for n in range(10000))
+    assert false_positives < 300
+
+
+def test_bloom_filter_counts_distinct_values():
+    bloom = BloomFilter(100, 0.01)
+    bloom.add('ABCDEF')
+    bloom.add('ABCDEF')
+    assert bloom.count == 1
+
+
+def code_filter(codes, refresh_interval=0):
+    loads = []
+
+    def load(since=None):
+        loads.append(since)
+        return list(codes)
+    return CodeFilter(load, refresh_interval, 600, 0.01), loads
+
+
+def test_code_filter_rejects_without_a_lookup():
+    live = generate_code()
+    gate, _ = code_filter([live], refresh_interval=600)
+    assert gate.might_exist(live)
+    assert not gate.might_exist(live[:-1] + 'x')
+    missing = next(code for code in iter(generate_code, None)
+                   if code != live and code not in gate.bloom)
+    assert not gate.might_exist(missing)
+    counts = gate.snapshot()
+    assert counts['passed'] == 1
+    assert counts['rejected_malformed'] == 1
+    assert counts['rejected_filter'] == 1
+
+
+def test_code_filter_keeps_legacy_codes():
+    gate, _ = code_filter(['legacy'], refresh_interval=600)
+    assert gate.might_exist('legacy')
+    assert gate.snapshot()['legacy_codes'] == 1
+
+
+def test_code_filter_picks_up_codes_from_other_workers_on_a_miss():
+    codes = []
+    gate, loads = code_filter(codes)
+    assert not gate.might_exist(generate_code())
+    # Another worker issues a code, the next miss refreshes
+    issued = generate_code()
+    codes.append(issued)
+    assert gate.might_exist(issued)
+    assert len(loads) == 3
+    assert loads[2] is not None
+
+
+def test_code_filter_adds_its_own_codes():
+    gate, _ = code_filter([], refresh_interval=600)
+    issued = generate_code()
+    gate.add(issued)
+    assert gate.might_exist(issued)
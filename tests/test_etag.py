@@ -0,0 +1,38 @@
+import hashlib
+
+import pytest
+
+from app import app
+from app.utils.etag import template_digest
+
+EMPTY = hashlib.blake2b(digest_size=8).hexdigest()
+
+
+@pytest.fixture
+def digest():
+    '''
+    template_digest without its per-process cache
+    '''
+    def fresh():
+        template_digest.cache_clear()
+        return template_digest()
+    yield fresh
+    template_digest.cache_clear()
+
+
+def test_digest_covers_the_app_templates(request_context, digest,
+                                         monkeypatch, tmp_path):
+    # From anywhere, not just the directory the templates are under
+    monkeypatch.chdir(tmp_path)
+    assert digest() != EMPTY
+
+
+def test_digest_changes_with_a_template(request_context, digest,
+                                        monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'template_folder', str(tmp_path))
+    template = tmp_path / 'bills' / 'bill.html'
+    template.parent.mkdir()
+    template.write_text('<p>{{ bill.total }}</p>')
+    before = digest()
+    template.write_text('<p>Total {{ bill.total }}</p>')
+    assert digest() != before
@@ -0,0 +1,65 @@
+import uuid
+
+import pytest
+
+from app.models import Member, User, Wallet
+from app.storage import store
+
+
+@pytest.fixture
+def user_id():
+    user = {'username': 'ann', 'email': f"ann-{uuid.uuid4()}@test",
+            'user_type': 'customer', 'payment_methods': []}
+    store.users.create(user)
+    return str(user['_id'])
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    '''
+    Models read from the users backend, in order
+    '''
+    backend = store.users.repository
+    models = []
+    get = backend.get
+
+    def counted(user_id, model=User):
+        models.append(model)
+        return get(user_id, model)
+    monkeypatch.setattr(backend, 'get', counted)
+    return models
+
+
+def test_repeat_reads_in_a_request_hit_the_map(request_context, user_id,
+                                               reads):
+    first = store.users.get(user_id)
+    assert store.users.get(user_id) is first
+    assert reads == [User]
+
+
+def test_wider_reads_serve_narrower_ones(request_context, user_id, reads):
+    user = store.users.get(user_id, User)
+    assert store.users.get(user_id, Member) is user
+    assert reads == [User]
+
+
+def test_narrower_reads_dont_serve_wider_ones(request_context, user_id,
+                                              reads):
+    store.users.get(user_id, Member)
+    assert store.users.get(user_id, User).email.endswith('@test')
+    assert reads == [Member, User]
+
+
+def test_writes_drop_the_collection(request_context, user_id, reads):
+    assert store.users.get(user_id, Wallet).payment_methods == []
+    store.users.add_payment_method(user_id, {'token': 'tok'})
+    assert store.users.get(user_id, Wallet).payment_methods == [
+        {'token': 'tok'}
+    ]
+    assert reads == [Wallet, Wallet]
+
+
+def test_no_map_outside_a_request(user_id, reads):
+    store.users.get(user_id)
+    store.users.get(user_id)
+    assert reads == [User, User]
@@ -0,0 +1,21 @@
+import pytest
+
+from app.models import Bill, BillVersion, Member, NotLoaded, User
+
+
+def test_reading_a_field_outside_the_projection_fails():
+    member = Member({'_id': '0' * 24, 'username': 'ann', 'email': 'a@test'})
+    assert member.username == 'ann'
+    with pytest.raises(NotLoaded):
+        member.email
+
+
+def test_unknown_attributes_are_attribute_errors():
+    with pytest.raises(AttributeError):
+        User({}).nonsense
+
+
+def test_defaults_fill_missing_fields():
+    bill = BillVersion({'_id': '0' * 24, 'vendor_id': 'v'})
+    assert bill.version == 0
+    assert Bill({}).contents == []
@@ -0,0 +1,77 @@
+import pytest
+
+from app.utils.money import (allocate, bill_shares, format_cents, tax_cents,
+                             to_cents, total_cents)
+
+
+def item(price, quantity=1, assigned_to=()):
+    return {'price': price, 'quantity': quantity,
+            'assigned_to': list(assigned_to)}
+
+
+def test_allocate_sums_to_total():
+    for total in (0, 1, 99, 100, 1001, 123457):
+        for weights in ([1], [1, 1, 1], [3, 5, 7], [1, 0, 2], [10, 1]):
+            assert sum(allocate(total, weights)) == total
+
+
+def test_allocate_gives_leftover_cents_to_largest_remainders():
+    # 100 * 1/6 = 16.67, 100 * 2/6 = 33.33, 100 * 3/6 = 50
+    assert allocate(100, [1, 2, 3]) == [17, 33, 50]
+
+
+def test_allocate_breaks_ties_in_order():
+    assert allocate(100, [1, 1, 1]) == [34, 33, 33]
+    assert allocate(2, [1, 1, 1]) == [1, 1, 0]
+
+
+def test_allocate_without_weight():
+    assert allocate(100, [0, 0]) == [0, 0]
+
+
+def test_tax_rounds_half_up():
+    # 8% of 1006 is 80.48, of 1044 is 83.52
+    assert tax_cents(1006) == 80
+    assert tax_cents(1044) == 84
+    # 5% of 1050 is exactly 52.5
+    assert tax_cents(1050, rate=5) == 53
+    assert total_cents(1000) == 1080
+
+
+def test_bill_shares_split_an_item_evenly():
+    # 334, 334 and 333 cents of the item, then 1081 in that proportion
+    shares = bill_shares([item(1001, assigned_to=['a', 'b', 'c'])])
+    assert shares == {'a': 361, 'b': 361, 'c': 359}
+    assert sum(shares.values()) == total_cents(1001)
+
+
+def test_bill_shares_add_up_to_the_total():
+    contents = [
+        item(1299, 2, ['a']),
+        item(350, 3, ['a', 'b']),
+        item(999, 1, ['b', 'c', 'd']),
+        item(1, 1, ['d']),
+    ]
+    subtotal = sum(i['price'] * i['quantity'] for i in contents)
+    shares = bill_shares(contents)
+    assert set(shares) == {'a', 'b', 'c', 'd'}
+    assert sum(shares.values()) == total_cents(subtotal)
+
+
+def test_bill_shares_leave_unassigned_items_unpaid():
+    shares = bill_shares([item(1000, assigned_to=['a']), item(1000)])
+    assert shares == {'a': 1080}
+
+
+def test_format_cents():
+    assert format_cents(1010) == '10.10'
+    assert format_cents(5) == '0.05'
+    assert format_cents(-5) == '-0.05'
+    assert format_cents(-1010) == '-10.10'
+
+
+def test_to_cents():
+    assert to_cents('10.1') == 1010
+    assert to_cents('0.005') == 1
+    with pytest.raises(ValueError):
+        to_cents('ten')
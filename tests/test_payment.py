@@ -0,0 +1,40 @@
+import pytest
+
+from app.payment import PaymentUnavailable, RemoteCardNetwork
+
+
+class Response:
+    status_code = 200
+
+    def json(self):
+        return {'amount': 100}
+
+
+@pytest.fixture
+def network(monkeypatch):
+    network = RemoteCardNetwork('http://network', 1, timeout=5)
+    network.timeouts = []
+
+    def post(url, json, timeout):
+        network.timeouts.append(timeout)
+        return Response()
+    monkeypatch.setattr(network.session, 'post', post)
+    return network
+
+
+def test_authorize_waits_the_network_timeout_by_default(network):
+    assert network.authorize('tok', 100) == 100
+    assert network.timeouts == [5]
+
+
+def test_authorize_waits_at_most_what_is_left_of_a_deadline(network):
+    network.authorize('tok', 100, timeout=0.25)
+    network.authorize('tok', 100, timeout=60)
+    assert network.timeouts == [0.25, 5]
+
+
+@pytest.mark.parametrize('timeout', [0, -0.1])
+def test_authorize_fails_fast_past_the_deadline(network, timeout):
+    with pytest.raises(PaymentUnavailable):
+        network.authorize('tok', 100, timeout=timeout)
+    assert network.timeouts == []
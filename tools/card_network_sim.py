@@ -0,0 +1,178 @@
+'''
+Stand-in card network for load tests
+
+Runs as its own process and answers authorization requests the way a slow,
+flaky processor would: configurable latency distribution, error and decline
+rates, a requests-per-second throttle and a concurrency limit. Point the app
+at it with CARD_NETWORK_URL=http://localhost:8765
+
+    python tools/card_network_sim.py --latency lognormal:600,0.5 \\
+        --error-rate 0.02 --max-rps 50
+'''
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def latency_sampler(spec):
+    '''
+    Build a function returning a delay in seconds from a spec like
+    fixed:300, uniform:300,2000 or lognormal:600,0.5 (median ms, sigma)
+    '''
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(',') if v]
+    if kind == 'fixed':
+        return lambda: values[0] / 1000
+    if kind == 'uniform':
+        return lambda: random.uniform(*values) / 1000
+    if kind == 'lognormal':
+        median, sigma = values
+        return lambda: random.lognormvariate(math.log(median), sigma) / 1000
+    raise argparse.ArgumentTypeError(f"unknown latency spec {spec!r}")
+
+
+class TokenBucket:
+    '''
+    Allows `rate` requests per second with bursts up to `rate`
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class Stats:
+    '''
+    Outcome counters, served on GET /stats
+    '''
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.counts = {}
+        self.in_flight = 0
+
+    def count(self, outcome):
+        with self.lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+
+
+class CardNetworkHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the app's pooled client reuses connections
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        if self.server.config.verbose:
+            super().log_message(*args)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.reply(404, {'error': 'Not found'})
+        stats = self.server.stats
+        with stats.lock:
+            snapshot = {'in_flight': stats.in_flight, **stats.counts}
+        return self.reply(200, snapshot)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        if self.path != '/authorize':
+            return self.reply(404, {'error': 'Not found'})
+
+        config, stats = self.server.config, self.server.stats
+        if config.max_rps and not self.server.bucket.take():
+            stats.count('throttled')
+            return self.reply(429, {'error': 'Too many requests'})
+
+        with stats.lock:
+            overloaded = config.max_concurrent and (
+                stats.in_flight >= config.max_concurrent
+            )
+            if overloaded:
+                stats.count('overloaded')
+            else:
+                stats.in_flight += 1
+        if overloaded:
+            return self.reply(503, {'error': 'Network overloaded'})
+
+        try:
+            time.sleep(config.latency())
+            roll = random.random()
+            if roll < config.error_rate:
+                stats.count('error')
+                return self.reply(500, {'error': 'Issuer unavailable'})
+            if roll < config.error_rate + config.decline_rate:
+                stats.count('declined')
+                return self.reply(402, {'error': 'Card declined'})
+
+            stats.count('approved')
+            return self.reply(200, {
+                'approved': True,
+                'amount': payload.get('amount'),
+                'authorization': str(uuid.uuid4())
+            })
+        finally:
+            with stats.lock:
+                stats.in_flight -= 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=latency_sampler,
+                        default='uniform:300,2000',
+                        help='fixed:MS, uniform:MIN,MAX or '
+                             'lognormal:MEDIAN,SIGMA')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with a 500')
+    parser.add_argument('--decline-rate', type=float, default=0.0,
+                        help='fraction of requests declined with a 402')
+    parser.add_argument('--max-rps', type=float, default=0,
+                        help='throttle with 429s above this rate, 0 = off')
+    parser.add_argument('--max-concurrent', type=int, default=0,
+                        help='answer 503 above this many in-flight '
+                             'requests, 0 = off')
+    parser.add_argument('--verbose', action='store_true')
+    config = parser.parse_args()
+
+    server = ThreadingHTTPServer((config.host, config.port),
+                                 CardNetworkHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.stats = Stats()
+    server.bucket = TokenBucket(config.max_rps) if config.max_rps else None
+
+    print(f"Card network simulator on http://{config.host}:{config.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+'''
+Restaurant-night traffic simulator for concurrency testing
+
+Plays out a dinner service against a running app over HTTP. Tables arrive
+at random; for each one a waiter opens a bill and several waiters add items
+at once, the party signs up, forms a group and attaches the bill by its
+payment code, members split items concurrently and then everyone pays at
+the same time. Afterwards each bill is read back to count lost updates
+(items or splits that were written but aren't there) and settlement
+mismatches (paid total, payments and bill total that don't agree).
+
+    python tools/restaurant_night.py --base-url http://localhost:5000 \\
+        --tables 40 --party-size 4 --arrival-rate 2
+'''
+import argparse
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+
+MENU = [
+    ('Burger', '12.50'), ('Fries', '4.25'), ('Salad', '9.99'),
+    ('Steak', '27.00'), ('Soup', '6.75'), ('Soda', '2.49'),
+    ('Pasta', '15.30'), ('Cake', '7.15'),
+]
+PASSWORD = 'night-service'
+CARD = {
+    'payment_option': 'new',
+    'card_number': '4242424242424242',
+    'expiry_date': '2099-12',
+    'cardholder_name': 'Guest',
+    'cvc': '123',
+}
+
+OBJECT_ID = r'[0-9a-f]{24}'
+MENU_ITEM_RE = re.compile(rf'/vendor/menu/({OBJECT_ID})/delete')
+GROUP_LINK_RE = re.compile(rf'/customer/group/({OBJECT_ID})"')
+GROUP_CODE_RE = re.compile(r'id="groupId" value="(\w+)"')
+PAYMENT_CODE_RE = re.compile(r'Payment Code:</strong> (\w+)<')
+ITEM_ROW_RE = re.compile(r'<tr data-item-id="([\w-]+)"')
+SPLIT_BOX_RE = re.compile(
+    rf'value="({OBJECT_ID})"\s+id="split-(.+?)-\d+"\s*(checked)?'
+)
+AMOUNT_RE = {
+    name: re.compile(rf'{name}:</strong> \$(-?\d+\.\d\d)')
+    for name in ('Subtotal', 'Total')
+}
+PAID_RE = re.compile(r'Paid: \$(-?\d+\.\d\d)')
+PAYMENT_ROW_RE = re.compile(r'<span>\$(-?\d+\.\d\d)</span>')
+
+
+def cents(dollars):
+    whole, part = dollars.lstrip('-').split('.')
+    value = int(whole) * 100 + int(part)
+    return -value if dollars.startswith('-') else value
+
+
+def percentile(values, fraction):
+    '''
+    Nearest-rank percentile of a sorted list
+    '''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Recorder:
+    '''
+    Latencies and failures per step, plus the consistency checks
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.failures = {}
+        self.lost_items = 0
+        self.lost_splits = 0
+        self.mismatches = []
+        self.tables_done = 0
+
+    def observe(self, step, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(step, []).append(seconds)
+            if not ok:
+                self.failures[step] = self.failures.get(step, 0) + 1
+
+    def mismatch(self, table, problem):
+        with self.lock:
+            self.mismatches.append(f"table {table}: {problem}")
+
+    def report(self, elapsed):
+        requests_made = sum(len(v) for v in self.latencies.values())
+        print(f"\n{self.tables_done} tables, {requests_made} requests in "
+              f"{elapsed:.1f}s ({requests_made / elapsed:.1f} req/s)\n")
+        print(f"{'step':<16}{'count':>7}{'failed':>8}"
+              f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+        for step, values in self.latencies.items():
+            values = sorted(values)
+            print(f"{step:<16}{len(values):>7}"
+                  f"{self.failures.get(step, 0):>8}"
+                  + ''.join(f"{1000 * percentile(values, p):>9.0f}"
+                            for p in (0.5, 0.95, 0.99))
+                  + f"{1000 * values[-1]:>9.0f}")
+        print(f"\nlost item adds:        {self.lost_items}")
+        print(f"lost split updates:    {self.lost_splits}")
+        print(f"settlement mismatches: {len(self.mismatches)}")
+        for problem in self.mismatches[:20]:
+            print(f"  {problem}")
+
+
+class Client:
+    '''
+    One browser session, timing every request against a step name
+    '''
+    def __init__(self, base_url, recorder, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def call(self, step, method, path, expect=None, **kwargs):
+        '''
+        Make a request without following redirects. It counts as failed if
+        it errors, or if `expect` is given and the redirect doesn't go to a
+        path starting with it, since the app reports most errors as a flash
+        and a redirect
+        '''
+        started = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, self.base_url + path, allow_redirects=False,
+                timeout=self.timeout, **kwargs
+            )
+        except requests.RequestException:
+            self.recorder.observe(step, time.perf_counter() - started, False)
+            return None
+        location = urlsplit(response.headers.get('Location', '')).path
+        ok = response.status_code < 400 and (
+            expect is None or location.startswith(expect)
+        )
+        self.recorder.observe(step, time.perf_counter() - started, ok)
+        return response if ok else None
+
+    def signup(self, username, user_type):
+        return self.call('signup', 'POST', '/signup', expect='/index', data={
+            'username': username,
+            'email': f"{username}@night.test",
+            'password': PASSWORD,
+            'confirm_password': PASSWORD,
+            'user_type': user_type,
+            'vendor_name': username,
+        })
+
+    def login(self, username):
+        return self.call('login', 'POST', '/login', expect='/index', data={
+            'email': f"{username}@night.test", 'password': PASSWORD
+        })
+
+
+def set_up_vendor(config, recorder):
+    '''
+    Sign up the vendor and fill the menu, returning [(item_id, cents)]
+    '''
+    vendor = Client(config.base_url, recorder, config.timeout)
+    if not vendor.signup(config.vendor, 'vendor'):
+        raise SystemExit(f"could not sign up vendor {config.vendor}")
+    for name, price in MENU:
+        vendor.call('add_menu_item', 'POST', '/vendor/menu/add', data={
+            'name': name, 'price': price, 'category': 'Main'
+        })
+    page = vendor.call('menu', 'GET', '/vendor/menu')
+    item_ids = MENU_ITEM_RE.findall(page.text) if page else []
+    if len(item_ids) != len(MENU):
+        raise SystemExit("could not read back the vendor's menu")
+    # The menu page lists items in insertion order
+    return [(item_id, cents(price))
+            for item_id, (_, price) in zip(item_ids, MENU)]
+
+
+class Table:
+    def __init__(self, number, config, recorder, menu):
+        self.number = number
+        self.config = config
+        self.recorder = recorder
+        self.menu = menu
+        self.pool = ThreadPoolExecutor(
+            max_workers=config.party_size + 1 + config.items
+        )
+
+    def client(self):
+        return Client(self.config.base_url, self.recorder, self.config.timeout)
+
+    def concurrently(self, calls):
+        '''
+        Start every call together and wait for all of them
+        '''
+        return list(self.pool.map(lambda call: call(), calls))
+
+    def serve(self):
+        try:
+            self.play()
+        finally:
+            self.pool.shutdown()
+            with self.recorder.lock:
+                self.recorder.tables_done += 1
+
+    def play(self):
+        config, number = self.config, self.number
+
+        # Waiters log in on their own devices and open the bill
+        waiters = [self.client() for _ in range(config.waiters)]
+        self.concurrently([
+            lambda w=w: w.login(config.vendor) for w in waiters
+        ])
+        opened = waiters[0].call(
+            'create_bill', 'POST', '/vendor/bill/create',
+            expect='/vendor/bill/detail/', data={'table_number': number}
+        )
+        if not opened:
+            return
+        bill_id = opened.headers['Location'].rsplit('/', 1)[1]
+        page = waiters[0].call(
+            'vendor_bill', 'GET', f'/vendor/bill/detail/{bill_id}'
+        )
+        payment_code = page and PAYMENT_CODE_RE.search(page.text)
+        if not payment_code:
+            return
+
+        # The party sits down while orders go in from every waiter
+        size = max(1, random.randint(config.party_size - 1,
+                                     config.party_size + 1))
+        party = [self.client() for _ in range(size)]
+        orders = [random.choice(self.menu) + (random.randint(1, 3),)
+                  for _ in range(config.items)]
+        expected_subtotal = sum(price * qty for _, price, qty in orders)
+        signed_up = self.concurrently(
+            [lambda c=c, s=s: c.signup(f"{config.run}-t{number}-s{s}",
+                                       'customer')
+             for s, c in enumerate(party)]
+            + [lambda w=waiters[i % len(waiters)], o=o: w.call(
+                'add_to_bill', 'POST', f'/vendor/bill/add/{bill_id}/{o[0]}',
+                expect='/vendor/bill/detail/', data={'qty': o[2]}
+            ) for i, o in enumerate(orders)]
+        )[:size]
+        party = [c for c, ok in zip(party, signed_up) if ok]
+        if not party:
+            return
+        host, guests = party[0], party[1:]
+
+        if not host.call('create_group', 'POST', '/customer/group/create',
+                         expect='/customer/dashboard',
+                         data={'group_name': f"Table {number}"}):
+            return
+        dashboard = host.call('dashboard', 'GET', '/customer/dashboard')
+        group_id = dashboard and GROUP_LINK_RE.search(dashboard.text)
+        if not group_id:
+            return
+        group_id = group_id.group(1)
+        page = host.call('group', 'GET', f'/customer/group/{group_id}')
+        group_code = page and GROUP_CODE_RE.search(page.text)
+        if not group_code:
+            return
+        joined = self.concurrently([
+            lambda g=g: g.call('join_group', 'POST', '/customer/group/join',
+                               expect='/customer/dashboard',
+                               data={'group_id': group_code.group(1)})
+            for g in guests
+        ])
+        party = [host] + [g for g, ok in zip(guests, joined) if ok]
+
+        if not host.call('join_by_code', 'POST', '/customer/bill/join-by-code',
+                         expect='/customer/bill/display/',
+                         data={'session_code': payment_code.group(1),
+                               'group_id': group_id}):
+            return
+
+        page = host.call('display_bill', 'GET',
+                         f'/customer/bill/display/{group_id}')
+        if not page:
+            return
+        item_ids = ITEM_ROW_RE.findall(page.text)
+        member_ids = list(dict.fromkeys(
+            user_id for user_id, _, _ in SPLIT_BOX_RE.findall(page.text)
+        ))
+        with self.recorder.lock:
+            self.recorder.lost_items += max(0, len(orders) - len(item_ids))
+
+        # Every item goes to at least one member, everyone splitting at once
+        splits = {}
+        for i, item_id in enumerate(item_ids):
+            owners = {member_ids[i % len(member_ids)]} | set(random.sample(
+                member_ids, random.randint(0, len(member_ids) - 1)
+            ))
+            splits[item_id] = sorted(owners)
+        self.concurrently([
+            lambda c=random.choice(party), i=i, u=u: c.call(
+                'split', 'POST',
+                f'/customer/bill/split/{group_id}/{bill_id}/{i}',
+                expect='/customer/bill/display/', data={'user_ids': u}
+            ) for i, u in splits.items()
+        ])
+
+        page = host.call('display_bill', 'GET',
+                         f'/customer/bill/display/{group_id}')
+        if page:
+            stored = {}
+            for user_id, item_id, checked in SPLIT_BOX_RE.findall(page.text):
+                if checked:
+                    stored.setdefault(item_id, []).append(user_id)
+            with self.recorder.lock:
+                self.recorder.lost_splits += sum(
+                    sorted(stored.get(i, [])) != u for i, u in splits.items()
+                )
+
+        # Everyone pays at the same time
+        paid = self.concurrently([
+            lambda c=c: c.call(
+                'pay_bill', 'POST',
+                f'/customer/bill/pay_bill/{group_id}/{bill_id}',
+                expect='/customer/dashboard', data=CARD
+            ) for c in party
+        ])
+        self.check_settlement(
+            waiters[0], bill_id, expected_subtotal, all(paid)
+        )
+
+    def check_settlement(self, waiter, bill_id, expected_subtotal,
+                         fully_paid):
+        page = waiter.call('vendor_bill', 'GET',
+                           f'/vendor/bill/detail/{bill_id}')
+        if not page:
+            self.recorder.mismatch(self.number, 'bill could not be read')
+            return
+        subtotal, total = (
+            cents(AMOUNT_RE[name].search(page.text).group(1))
+            for name in ('Subtotal', 'Total')
+        )
+        paid = cents(PAID_RE.search(page.text).group(1))
+        ledger = sum(cents(a) for a in PAYMENT_ROW_RE.findall(page.text))
+        if subtotal != expected_subtotal:
+            self.recorder.mismatch(
+                self.number,
+                f"subtotal {subtotal} != ordered {expected_subtotal}"
+            )
+        # Failed payments are already counted against pay_bill
+        if fully_paid and paid != total:
+            self.recorder.mismatch(
+                self.number, f"paid {paid} != total {total}"
+            )
+        if ledger != paid:
+            self.recorder.mismatch(
+                self.number, f"payments sum to {ledger}, bill says {paid}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--tables', type=int, default=40,
+                        help='tables served over the night')
+    parser.add_argument('--party-size', type=int, default=4,
+                        help='average guests per table, varies by one')
+    parser.add_argument('--arrival-rate', type=float, default=2.0,
+                        help='tables arriving per second, Poisson')
+    parser.add_argument('--items', type=int, default=6,
+                        help='items ordered per table')
+    parser.add_argument('--waiters', type=int, default=3,
+                        help='waiters adding items to a bill at once')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='seconds before a request counts as failed')
+    parser.add_argument('--seed', type=int)
+    config = parser.parse_args()
+
+    random.seed(config.seed)
+    config.run = uuid.uuid4().hex[:8]
+    config.vendor = f"{config.run}-kitchen"
+    recorder = Recorder()
+    menu = set_up_vendor(config, recorder)
+
+    print(f"Run {config.run}: {config.tables} tables at "
+          f"{config.arrival_rate}/s against {config.base_url}")
+    started = time.perf_counter()
+    threads = []
+    for number in range(1, config.tables + 1):
+        table = Table(number, config, recorder, menu)
+        thread = threading.Thread(target=table.serve, daemon=True)
+        thread.start()
+        threads.append(thread)
+        time.sleep(random.expovariate(config.arrival_rate))
+    for thread in threads:
+        thread.join()
+    recorder.report(time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    main()